@@ -93,9 +93,10 @@ class BridgeServer {
                 return res.json({ status: 'cancelled' });
             }
             if (this.currentJob && this.currentJob.id === jobId) {
-                // We don't support hard killing python but we can clear it from bridge
                 this.currentJob.cancelled = true;
-                return res.json({ status: 'cancelling', note: 'Will skip next broadcast' });
+                // Still submitting: runBackendJob sends the cancel once the backend id is known
+                this.cancelBackendJob(this.currentJob);
+                return res.json({ status: 'cancelling' });
             }
             res.status(404).json({ error: 'Job not found or already finished' });
         });
@@ -104,6 +105,20 @@ class BridgeServer {
         this.app.get('/api/styles', (req, res) => this.proxyToPython(req, res, '/styles'));
         this.app.get('/api/models', (req, res) => this.proxyToPython(req, res, '/models'));
         this.app.post('/api/models/switch', (req, res) => this.proxyToPython(req, res, '/models/switch', 'POST'));
+
+        // 5. In-memory images (zero-disk mode): stream the bytes straight from the backend
+        this.app.get('/api/images/:id', async (req, res) => {
+            try {
+                const response = await axios.get(`http://127.0.0.1:8000/images/${encodeURIComponent(req.params.id)}`, {
+                    headers: { 'X-Bridge-Token': this.getToken() },
+                    responseType: 'stream'
+                });
+                res.set('Content-Type', response.headers['content-type']);
+                response.data.pipe(res);
+            } catch (error) {
+                res.status(error.response?.status || 500).json({ error_code: 'IMAGE_NOT_FOUND', message: error.message });
+            }
+        });
     }
 
     setupWebSocket() {
@@ -154,19 +169,17 @@ class BridgeServer {
         this.broadcast({ event: 'job_started', job_id: this.currentJob.id });
 
         try {
-            const endpoint = `/${this.currentJob.type}`;
-            const response = await axios.post(`http://127.0.0.1:8000${endpoint}`, this.currentJob.params, {
-                headers: { 'X-Bridge-Token': this.getToken() },
-                timeout: 300000 // 5 minute timeout for local inference
-            });
-            
-            let result = response.data;
+            let result = await this.runBackendJob(this.currentJob);
             if (result && result.image_url) {
                 const fileName = path.basename(result.image_url);
                 result.image_url = `http://localhost:${this.port}/outputs/${fileName}`;
+            } else if (result && result.image_id) {
+                result.image_url = `http://localhost:${this.port}/api/images/${result.image_id}`;
             }
 
-            if (!this.currentJob.cancelled) {
+            if (this.currentJob.cancelled) {
+                this.completedJobs[this.currentJob.id] = { status: 'cancelled' };
+            } else {
                 this.completedJobs[this.currentJob.id] = { status: 'completed', result };
                 this.broadcast({ event: 'job_completed', job_id: this.currentJob.id, result });
             }
@@ -189,6 +202,49 @@ class BridgeServer {
         }
     }
 
+    cancelBackendJob(job) {
+        // The backend stops the run within one denoising step; sent at most once per job
+        if (!job.backendJobId || job.backendCancelSent) return;
+        job.backendCancelSent = true;
+        axios.delete(`http://127.0.0.1:8000/jobs/${job.backendJobId}`, {
+            headers: { 'X-Bridge-Token': this.getToken() }
+        }).catch(e => console.error(`[Job ${job.id}] Cancel failed:`, e.message));
+    }
+
+    async runBackendJob(job) {
+        // Submit to the backend job queue and poll until it finishes, relaying step progress
+        const base = 'http://127.0.0.1:8000';
+        const config = { headers: { 'X-Bridge-Token': this.getToken() } };
+        const submitted = await axios.post(`${base}/jobs`, job.params, config);
+        job.backendJobId = submitted.data.job_id;
+
+        const deadline = Date.now() + 300000; // 5 minute timeout for local inference
+        let lastStep = null;
+        while (Date.now() < deadline) {
+            // Covers a cancel that arrived while the submit was in flight
+            if (job.cancelled) this.cancelBackendJob(job);
+            const { data: status } = await axios.get(`${base}/jobs/${job.backendJobId}`, config);
+            if (status.progress && status.progress.step !== lastStep) {
+                lastStep = status.progress.step;
+                this.broadcast({ event: 'job_progress', job_id: job.id, progress: status.progress });
+            }
+            if (status.status === 'completed') {
+                const response = await axios.get(`${base}/jobs/${job.backendJobId}/result`, config);
+                return response.data;
+            }
+            if (status.status === 'failed') {
+                const error = new Error(status.error?.message || 'Backend job failed');
+                error.response = { data: { detail: status.error } };
+                throw error;
+            }
+            if (status.status === 'cancelled') return null;
+            await new Promise(resolve => setTimeout(resolve, 250));
+        }
+        // Do not leave the backend working on a job nobody waits for
+        this.cancelBackendJob(job);
+        throw new Error('Timed out waiting for backend job');
+    }
+
     async proxyToPython(req, res, endpoint, method = 'GET') {
         try {
             const config = {
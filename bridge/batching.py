@@ -0,0 +1,116 @@
+import threading
+import time
+from concurrent.futures import Future
+
+try:
+    from scheduler_pool import scheduler_family
+except ImportError:
+    from bridge.scheduler_pool import scheduler_family
+
+
+def batch_key(model_id, width, height, steps, guidance):
+    """
+    Requests with the same key can share one batched pipeline call.
+    """
+    return (model_id, width, height, steps, scheduler_family(steps), guidance)
+
+
+class MicroBatcher:
+    """
+    Collects compatible /generate requests arriving within a short window and
+    runs them as a single batched `FooocusConnector.generate` call.
+    """
+
+    def __init__(self, connector, window_ms: int = 50, max_batch_size: int = 4):
+        """
+        Args:
+            connector: FooocusConnector used to run the batches
+            window_ms: How long the first request of a batch waits for company
+            max_batch_size: Hard cap, further limited by VRAM headroom per batch
+        """
+        self.connector = connector
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.pending = []
+        self.cond = threading.Condition()
+        self.worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self.worker.start()
+
+    def submit(self, prompt, negative_prompt="", width=1024, height=1024, steps=20, guidance=7.5, seed=None):
+        """
+        Queue a request and block until its image is ready. Returns the same
+        result dict as `FooocusConnector.generate`.
+        """
+        future = Future()
+        item = {
+            "key": batch_key(self.connector.current_model_id, width, height, steps, guidance),
+            "arrived": time.monotonic(),
+            "future": future,
+            "params": {
+                "prompt": prompt,
+                "negative_prompt": negative_prompt,
+                "width": width,
+                "height": height,
+                "steps": steps,
+                "guidance": guidance,
+                "seed": seed,
+            },
+        }
+        with self.cond:
+            self.pending.append(item)
+            self.cond.notify()
+        result = future.result()
+        # The worker hands over a Future when the image is still being written
+        return result.result() if isinstance(result, Future) else result
+
+    def _batch_limit(self, params):
+        vram_limit = self.connector.vram_manager.max_batch_size(params["width"], params["height"], self.max_batch_size,
+                                                                pipe=self.connector.pipe)
+        return max(1, min(self.max_batch_size, vram_limit))
+
+    def _take_batch(self):
+        """
+        Wait for the oldest request's window to close (or its batch to fill)
+        and pop every compatible request, oldest first.
+        """
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+
+            head = self.pending[0]
+            limit = self._batch_limit(head["params"])
+            deadline = head["arrived"] + self.window
+            while True:
+                matching = [item for item in self.pending if item["key"] == head["key"]]
+                remaining = deadline - time.monotonic()
+                if len(matching) >= limit or remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            batch = matching[:limit]
+            for item in batch:
+                self.pending.remove(item)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            params = batch[0]["params"]
+            try:
+                results = self.connector.generate(
+                    prompt=[item["params"]["prompt"] for item in batch],
+                    negative_prompt=[item["params"]["negative_prompt"] for item in batch],
+                    width=params["width"],
+                    height=params["height"],
+                    steps=params["steps"],
+                    guidance=params["guidance"],
+                    seed=[item["params"]["seed"] for item in batch],
+                    wait_for_output=False,
+                )
+            except Exception as e:
+                for item in batch:
+                    item["future"].set_exception(e)
+                continue
+
+            for item, result in zip(batch, results):
+                item["future"].set_result(result)
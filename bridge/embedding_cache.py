@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of SDXL text-encoder outputs with a byte budget.
+
+    Entries are keyed by (model id, prompt, negative prompt) and hold
+    `(prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds,
+    negative_pooled_prompt_embeds)` for a single prompt, stored on CPU so the
+    cache never competes with the UNet for VRAM.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024**2):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _nbytes(embeds):
+        return sum(t.numel() * t.element_size() for t in embeds if t is not None)
+
+    def get(self, key):
+        with self.lock:
+            embeds = self.entries.get(key)
+            if embeds is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return embeds
+
+    def put(self, key, embeds):
+        embeds = tuple(t.detach().to("cpu") if t is not None else None for t in embeds)
+        size = self._nbytes(embeds)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self._nbytes(self.entries.pop(key))
+            self.entries[key] = embeds
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= self._nbytes(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
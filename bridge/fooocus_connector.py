@@ -1,22 +1,91 @@
 import os
 import torch
+import psutil
 import sys
 import time
+import copy
+import random
+import threading
+import weakref
 
 # Ensure we can import from optimization
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from optimization.vram_manager import VRAMManager
+from optimization.vram_manager import VRAMManager, is_out_of_memory
+from optimization.compiled import ShapeBucketCompiler
+from optimization.onnx_backend import load_onnx_pipeline, onnx_export_dir
+from optimization.model_io import custom_components, load_custom_pipeline, load_mapped_pipeline, is_cpu_quantized
+try:
+    from embedding_cache import PromptEmbeddingCache
+    from scheduler_pool import SchedulerPool, scheduler_family
+    from progress import GenerationCancelled
+    from model_residency import ModelResidencyManager, resolve_model_dir
+    from instrumentation import Instrumentation
+    from output_writer import OutputWriter, chain, resolved
+except ImportError:
+    from bridge.embedding_cache import PromptEmbeddingCache
+    from bridge.scheduler_pool import SchedulerPool, scheduler_family
+    from bridge.progress import GenerationCancelled
+    from bridge.model_residency import ModelResidencyManager, resolve_model_dir
+    from bridge.instrumentation import Instrumentation
+    from bridge.output_writer import OutputWriter, chain, resolved
 from diffusers import StableDiffusionXLPipeline, DPMSolverMultistepScheduler
 
 class FooocusConnector:
-    def __init__(self):
+    def __init__(self, embedding_cache_mb: int = 256, vram_budget_gb=None, ram_budget_gb=None,
+                 instrument=False, profile_request=0, trace_dir=None, output_format="png", compress_level=6,
+                 output_quality=90, output_workers=2, result_store=None, persist_outputs=True, mapped_loading=True,
+                 load_workers=8, compile_buckets=(), compile_cache_dir=None, compile_backend="inductor",
+                 compile_snap=False, onnx_models=(), onnx_providers=None):
         print("Initializing Fooocus Connector...")
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.vram_manager = VRAMManager(self.device)
         self.pipe = None
         self.current_model_id = None
+        # Serializes access to the shared pipeline (generation vs. model switching)
+        self.lock = threading.RLock()
+        # Text-encoder outputs for repeated prompts (preset suffixes, re-rolls)
+        self.embedding_cache = PromptEmbeddingCache(embedding_cache_mb * 1024**2)
+        self.scheduler_pool = None
+        # Pipelines kept hot on the GPU / parked in RAM, evicted by LRU
+        if vram_budget_gb is None:
+            vram_budget_gb = self.vram_manager.vram_limit_gb
+        if ram_budget_gb is None:
+            ram_budget_gb = psutil.virtual_memory().total / 1024**3 / 2
+        self.residency = ModelResidencyManager(
+            self.load_from_disk, self.activate_pipeline,
+            int(vram_budget_gb * 1024**3), int(ram_budget_gb * 1024**3)
+        )
+        # Readiness for load balancers: idle -> loading -> warming -> ready (or error)
+        self.state = "idle"
+        # Resolutions warmed up after every model load (empty disables warm-up)
+        self.warmup_resolutions = ()
+        self.warmup_steps = 2
+        # Per-stage timings in the response metadata and /metrics, plus an optional profiler trace
+        self.instrumentation = Instrumentation(instrument, profile_request, trace_dir)
+        # Images are encoded off the GPU thread, then written to outputs/ and/or kept in the result store
+        self.output_writer = OutputWriter(
+            os.path.join(os.path.dirname(os.path.dirname(__file__)), "outputs"), output_format, compress_level,
+            output_quality, output_workers, observe=self.instrumentation.observe_stage,
+            store=result_store, persist=persist_outputs
+        )
+        # Dynamic-INT8 pipelines pinned to the CPU (no VRAM planning)
+        self.cpu_only_pipes = weakref.WeakSet()
+        # Settings that got past an OOM, per (model, width, height): later requests start there
+        self.oom_fallbacks = {}
+        # Build model components from memory-mapped safetensors, reading tensors on `load_workers` threads
+        self.mapped_loading = mapped_loading
+        self.load_workers = load_workers
         self.models_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "models")
+        # Compiled UNet / VAE decoder for fixed (width, height, batch) buckets, artifacts cached on disk
+        self.compiler = ShapeBucketCompiler(
+            compile_buckets, compile_cache_dir or os.path.join(self.models_dir, ".compile_cache"),
+            backend=compile_backend, snap=compile_snap
+        ) if compile_buckets else None
+        # Models served by ONNX Runtime from their export in <model dir>/onnx ("*": every exported model)
+        self.onnx_models = set(onnx_models)
+        self.onnx_providers = onnx_providers
+        self.onnx_pipes = weakref.WeakSet()
         
         # Initial Load (Lazy or Default)
         # For prototype, we won't load immediately to save time until requested or use a lightweight check
@@ -29,134 +98,467 @@ class FooocusConnector:
     def load_optimized_pipeline(self, model_id="stabilityai/stable-diffusion-xl-base-1.0"):
         """
         Loads the pipeline with all Prunejuice optimizations.
+        Recently used models are kept resident, so switching back is fast.
         """
-        if self.pipe is not None and self.current_model_id == model_id:
-            return self.pipe
+        with self.lock:
+            if self.pipe is not None and self.current_model_id == model_id:
+                return self.pipe
             
-        print(f"Loading model {model_id}...")
+            print(f"Loading model {model_id}...")
+            self.state = "loading"
         
-        # 1. Clean up previous
-        if self.pipe is not None:
-            del self.pipe
-            self.vram_manager.post_generation_cleanup()
+            # 1. Release the previous model (the residency manager may keep it parked)
+            self.pipe = None
+            self.embedding_cache.clear()
+            self.scheduler_pool = None
 
-        # 2. Load Pipeline (Simulate loading pruned/quantized if available)
-        # In a real run, we would load 'models/pruned_sdxl.safetensors'
-        # For now, we load standard and apply optimizations on fly
-        
+            try:
+                # 2. Promote a resident copy or load from disk
+                # An ONNX export has no component fingerprints, so nothing is shared with torch pipelines
+                self.pipe = self.residency.acquire(model_id, self.onnx_dir(model_id) or self.resolve_load_path(model_id))
+                if self.pipe is None:
+                    raise RuntimeError(f"Could not load {model_id}")
+                # Release whatever the residency manager just parked or evicted
+                self.vram_manager.cleanup("model_switch")
+
+                # Prebuilt per-request schedulers for this model
+                self.scheduler_pool = SchedulerPool(self.pipe.scheduler.config, device=self.device)
+            
+                self.current_model_id = model_id
+                print(f"Model {model_id} loaded and optimized.")
+                if self.warmup_shapes():
+                    self.warmup()
+                self.state = "ready"
+                return self.pipe
+            
+            except Exception as e:
+                print(f"Error loading model: {e}")
+                self.current_model_id = None
+                self.state = "error"
+                return None
+
+    def resolve_load_path(self, model_id):
         # Check for local pruned model
         local_path = os.path.join(self.models_dir, model_id)
         if os.path.exists(local_path):
-            load_path = local_path
-        else:
-            load_path = model_id # Fallback to HF
+            return local_path
+        return model_id # Fallback to HF
+
+    def onnx_dir(self, model_id):
+        """ONNX export to run `model_id` from, or None to run it on torch."""
+        if model_id not in self.onnx_models and "*" not in self.onnx_models:
+            return None
+        model_dir = resolve_model_dir(self.resolve_load_path(model_id))
+        export_dir = onnx_export_dir(model_dir) if model_dir else None
+        if export_dir is None and model_id in self.onnx_models:
+            raise FileNotFoundError(f"No ONNX export of {model_id} (run scripts/export-onnx.py on it first)")
+        return export_dir
 
-        try:
-            # OPTIMIZATION: Use Native SDPA (Scaled Dot Product Attention) in Torch 2.6+
-            print("Activating Native SDPA Backends...")
-            torch.backends.cuda.enable_flash_sdp(True)
-            torch.backends.cuda.enable_mem_efficient_sdp(True)
-            torch.backends.cuda.enable_math_sdp(False) # Disable slow fallback math kernel
+    def backend(self, pipe=None):
+        pipe = self.pipe if pipe is None else pipe
+        return "onnx" if pipe is not None and pipe in self.onnx_pipes else "torch"
 
-            self.pipe = StableDiffusionXLPipeline.from_pretrained(
+    def load_from_disk(self, model_id, shared_components=None):
+        """
+        Load a pipeline from disk (or the HF cache) onto the CPU, reusing any
+        already-resident components with identical weights.
+        """
+        # 2. Load Pipeline (Simulate loading pruned/quantized if available)
+        # In a real run, we would load 'models/pruned_sdxl.safetensors'
+        # For now, we load standard and apply optimizations on fly
+        load_path = self.resolve_load_path(model_id)
+        onnx_dir = self.onnx_dir(model_id)
+        if onnx_dir:
+            # Same pipeline and denoising loop; the text encoders, UNet and VAE decoder run on ONNX Runtime
+            pipe = load_onnx_pipeline(StableDiffusionXLPipeline, onnx_dir, providers=self.onnx_providers)
+            pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config, use_karras_sigmas=True)
+            self.onnx_pipes.add(pipe)
+            return pipe
+
+        # OPTIMIZATION: Use Native SDPA (Scaled Dot Product Attention) in Torch 2.6+
+        print("Activating Native SDPA Backends...")
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
+        torch.backends.cuda.enable_math_sdp(False) # Disable slow fallback math kernel
+
+        mapped_dir = resolve_model_dir(load_path) if self.mapped_loading else None
+        if mapped_dir and not os.path.exists(os.path.join(mapped_dir, "model_index.json")):
+            mapped_dir = None
+        if custom_components(load_path):
+            # Pruned (sparse/structured) or INT8 checkpoint, built layer by layer
+            print(f"Loading optimized checkpoint ({', '.join(custom_components(load_path))})...")
+            pipe = load_custom_pipeline(
+                StableDiffusionXLPipeline,
                 load_path,
                 torch_dtype=torch.float16,
                 use_safetensors=True,
-                variant="fp16" # Ensure we try to get fp16 weights
+                **(shared_components or {})
+            )
+        elif mapped_dir:
+            # Weights mapped from the page cache instead of deserialized and copied
+            pipe = load_mapped_pipeline(
+                StableDiffusionXLPipeline,
+                mapped_dir,
+                torch_dtype=torch.float16,
+                variant="fp16",
+                workers=self.load_workers,
+                **(shared_components or {})
+            )
+        else:
+            pipe = StableDiffusionXLPipeline.from_pretrained(
+                load_path,
+                torch_dtype=torch.float16,
+                use_safetensors=True,
+                variant="fp16", # Ensure we try to get fp16 weights
+                **(shared_components or {})
             )
             
-            # Additional ML Quality/Speed tweaks
-            # self.pipe.enable_freeu(s1=0.9, s2=0.2, b1=1.2, b2=1.4) 
-            
-            # Scheduler
-            self.pipe.scheduler = DPMSolverMultistepScheduler.from_config(self.pipe.scheduler.config, use_karras_sigmas=True)
-            
-            # 3. Apply VRAM Optimizations (The Secret Sauce)
-            self.pipe = self.vram_manager.enable_all_optimizations(self.pipe)
-            
-            self.current_model_id = model_id
-            print(f"Model {model_id} loaded and optimized.")
-            return self.pipe
+        # Additional ML Quality/Speed tweaks
+        # self.pipe.enable_freeu(s1=0.9, s2=0.2, b1=1.2, b2=1.4) 
             
-        except Exception as e:
-            print(f"Error loading model: {e}")
-            return None
+        # Scheduler
+        pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config, use_karras_sigmas=True)
+        return pipe
+
+    def activate_pipeline(self, pipe):
+        self.instrumentation.install_probes(pipe)
+        if pipe in self.onnx_pipes:
+            # ONNX Runtime places and plans its own memory; nothing to offload or compile
+            return pipe
+        if any(is_cpu_quantized(module) for module in pipe.components.values()):
+            # Dynamic INT8 kernels are CPU-only; offloading to the GPU would break them
+            print("INT8 quantized model: running on CPU without GPU offload.")
+            pipe.enable_vae_slicing()
+            self.cpu_only_pipes.add(pipe)
+            return pipe
+        if self.compiler is not None:
+            # Before any offload hooks, which then wrap the routed forward
+            self.compiler.attach(pipe)
+        # 3. Apply VRAM Optimizations (The Secret Sauce): only the savers the
+        # default 1024x1024 request needs on this card; generate() re-plans per request
+        self.vram_manager.adapt(pipe, force=True)
+        return pipe
+
+    def warmup_shapes(self):
+        """(width, height, batch) of the warm-up runs: `warmup_resolutions`, then every compile bucket."""
+        shapes = [(width, height, 1) for width, height in self.warmup_resolutions]
+        if self.compiler is not None:
+            shapes += [bucket for bucket in self.compiler.buckets if bucket not in shapes]
+        return shapes
+
+    def warmup(self):
+        """
+        Run short throwaway generations at `warmup_resolutions` so CUDA kernels,
+        attention backends and the caching allocator are primed before real traffic.
+        In compiled mode every bucket is run too, so it is compiled (or loaded
+        from the artifact cache) before the first request needs it.
+        """
+        with self.lock, self.instrumentation.uncounted():
+            self.state = "warming"
+            try:
+                for width, height, batch in self.warmup_shapes():
+                    print(f"Warming up at {width}x{height} x{batch}...")
+                    if batch == 1:
+                        self.generate("warmup", width=width, height=height, steps=self.warmup_steps, seed=0,
+                                      save_output=False)
+                    else:
+                        self.generate(["warmup"] * batch, negative_prompt=[""] * batch, seed=[0] * batch, width=width,
+                                      height=height, steps=self.warmup_steps, save_output=False)
+            except Exception as e:
+                # A failed warm-up only costs speed on the first request, the model is usable
+                print(f"Warm-up failed: {e}")
+
+    def start_preload(self, model_id):
+        """
+        Load (and warm up) a model on a background thread so the server can
+        answer /health and /ready while it happens.
+        """
+        self.state = "loading"
+        thread = threading.Thread(target=self.load_optimized_pipeline, args=(model_id,), name="model-preload", daemon=True)
+        thread.start()
+        return thread
 
-    def generate(self, prompt, negative_prompt="", width=1024, height=1024, steps=20, guidance=7.5, seed=None):
+    def request_pipe(self, scheduler):
+        """
+        Per-request view of the shared pipeline using its own scheduler.
+        A shallow copy shares all weights and offload hooks but keeps the
+        scheduler and per-call attributes (guidance scale, timestep counters)
+        private to the request.
+        """
+        pipe = copy.copy(self.pipe)
+        pipe.scheduler = scheduler
+        return pipe
+
+    def encode_prompts(self, prompts, negative_prompts):
+        """
+        Text-encoder outputs for a batch of prompts, served from the embedding
+        cache where possible. Only cache misses are run through the encoders.
+        Negatives are always encoded so an entry is valid for any guidance scale.
+        """
+        keys = [(self.current_model_id, p, n) for p, n in zip(prompts, negative_prompts)]
+        cached = [self.embedding_cache.get(key) for key in keys]
+
+        missing = [i for i, embeds in enumerate(cached) if embeds is None]
+        if missing:
+            # Returns (prompt_embeds, negative_prompt_embeds, pooled, negative_pooled)
+            encoded = self.pipe.encode_prompt(
+                prompt=[prompts[i] for i in missing],
+                negative_prompt=[negative_prompts[i] for i in missing],
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=True,
+            )
+            for row, i in enumerate(missing):
+                # Own copies: a view would keep the whole batch alive under a one-row byte charge
+                cached[i] = tuple(t[row:row + 1].clone() for t in encoded)
+                self.embedding_cache.put(keys[i], cached[i])
+
+        return [torch.cat(parts) for parts in zip(*cached)]
+
+    def step_callback(self, cancel_tokens, progress_callbacks, recorder=None):
+        """
+        Build a diffusers `callback_on_step_end` that publishes per-step progress
+        and aborts the run once every request in the batch has been cancelled.
+        """
+        start = time.time()
+
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            if recorder is not None:
+                recorder.step_end()
+            elapsed = time.time() - start
+            event = {
+                "event": "step",
+                "step": step + 1,
+                "total": pipe.num_timesteps,
+                "elapsed": round(elapsed, 3),
+                "it_per_s": round((step + 1) / elapsed, 3) if elapsed > 0 else None
+            }
+            for callback in progress_callbacks:
+                callback(event)
+            if cancel_tokens and all(token.cancelled for token in cancel_tokens):
+                raise GenerationCancelled(f"Cancelled after step {step + 1}/{pipe.num_timesteps}")
+            return callback_kwargs
+
+        return on_step_end
+
+    def generate(self, prompt, negative_prompt="", width=1024, height=1024, steps=20, guidance=7.5, seed=None,
+                 cancel_token=None, on_progress=None, save_output=True, wait_for_output=True):
         """
         Execute generation with VRAM management.
+
+        `prompt` may also be a list of prompts (with matching lists for
+        `negative_prompt` and `seed`) to run several compatible requests as one
+        batched pipeline call. A list of results is returned in that case.
+
+        `cancel_token` (a CancellationToken, or one per prompt) stops the run
+        within one denoising step by raising GenerationCancelled; a batch only
+        stops once all of its requests are cancelled. `on_progress` (a callable,
+        or one per prompt) receives a dict after every denoising step.
+        With `save_output=False` nothing is written and `image_url` is None.
+        With a result store, `image_id` names the encoded bytes kept in memory;
+        without disk persistence, `image_url` is None.
+
+        Images are encoded and written by `output_writer` once the GPU lock is
+        released. By default the call returns when the files are in place; with
+        `wait_for_output=False` it returns Futures of the results instead, so a
+        GPU worker can move on to the next job while the writes finish.
+
+        An out-of-memory error is retried with cheaper settings (OOM_LADDER:
+        attention slicing, VAE tiling, sequential offload, then smaller
+        batches). The settings that worked are remembered for this model and
+        resolution, so later requests start from them.
         """
+        batched = isinstance(prompt, (list, tuple))
+        prompts = list(prompt) if batched else [prompt]
+        negative_prompts = list(negative_prompt) if batched else [negative_prompt]
+        seeds = list(seed) if batched else [seed]
+        if self.compiler is not None and self.compiler.snap:
+            # Generate at the closest compiled resolution; metadata reports the size used
+            width, height = self.compiler.nearest_resolution(width, height)
+
         # Ensure model is loaded
         if self.pipe is None:
             self.load_optimized_pipeline()
-            
-        # VRAM Cleanup
-        self.vram_manager.pre_generation_cleanup()
-        
-        # Generator seed
-        generator = None
-        if seed is not None:
-            generator = torch.Generator(device="cpu").manual_seed(seed)
-            
-        print(f"Generating: '{prompt}' ({width}x{height})")
 
-        # CRITICAL: CPU WARNING
-        if self.device == "cpu":
-            print("\n" + "!"*50)
-            print("WARNING: COMPUTE DEVICE IS 'CPU'. GENERATION WILL BE EXTREMELY SLOW.")
-            print("Please install CUDA Torch: pip install torch torchvision --index-url https://download.pytorch.org/whl/cu121")
-            print("!"*50 + "\n")
+        # Scheduler Logic for Lightning/Turbo. Each pipeline call checks out its own
+        # scheduler from the pool; the shared pipeline is never mutated.
+        family = scheduler_family(steps)
+        if family == "EulerAncestral":
+            print("Detecting low steps: using EulerAncestral scheduler (Lightning/Turbo mode)")
 
-        start_time = time.time()
-        
-        # Scheduler Logic for Lightning/Turbo
-        if steps <= 8:
-            print("Detecting low steps: Switching scheduler to EulerAncestral (Lightning/Turbo mode)")
-            from diffusers import EulerAncestralDiscreteScheduler
-            self.pipe.scheduler = EulerAncestralDiscreteScheduler.from_config(self.pipe.scheduler.config, timestep_spacing="trailing")
-        else:
-            # Default to DPM++ 2M Karras for quality
-            from diffusers import DPMSolverMultistepScheduler
-            self.pipe.scheduler = DPMSolverMultistepScheduler.from_config(self.pipe.scheduler.config, use_karras_sigmas=True)
-
-        # Generate
-        # Optimization note: Since we used 'enable_model_cpu_offload', we don't need to manually .to("cuda")
-        image = self.pipe(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            width=width,
-            height=height,
-            num_inference_steps=steps,
-            guidance_scale=guidance,
-            generator=generator
-        ).images[0]
-        
-        duration = time.time() - start_time
-        print(f"Generation complete in {duration:.2f}s")
-        
-        # Save output
-        output_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "outputs")
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-            
-        filename = f"out_{int(time.time())}.png"
-        filepath = os.path.join(output_dir, filename)
-        image.save(filepath)
-        
-        # Cleanup
-        self.vram_manager.post_generation_cleanup()
-        
-        return {
-            "image_url": filepath, # In real app, serve via static file server
-            "metadata": {
-                "width": width,
-                "height": height,
-                "steps": steps,
-                "seed": seed,
-                "model": self.current_model_id
-            },
-            "generation_time": duration
-        }
+        # One request for the profiler however many pipeline calls it takes
+        with self.instrumentation.generation(), self.lock:
+            key = (self.current_model_id, width, height)
+            remembered = self.oom_fallbacks.get(key)
+            fallback = {"savers": list(remembered["savers"]), "max_batch_size": remembered["max_batch_size"]} \
+                if remembered else {"savers": [], "max_batch_size": None}
+            retries = 0
+            # Finished chunks are kept across retries; a retry resumes at the first unfinished prompt
+            results, images = [], []
+            while True:
+                try:
+                    self.generate_in_chunks(
+                        prompts, negative_prompts, seeds, width, height, steps, guidance, family,
+                        cancel_token, on_progress, fallback, batched, results, images
+                    )
+                    break
+                except Exception as e:
+                    if not is_out_of_memory(e):
+                        raise
+                    remaining = len(prompts) - len(results)
+                    step = self.vram_manager.degrade(self.pipe, fallback, remaining,
+                                                     offload=self.pipe not in self.cpu_only_pipes,
+                                                     savers=self.pipe not in self.onnx_pipes)
+                    if step is None:
+                        print(f"Out of memory at {width}x{height} with every fallback applied")
+                        self.vram_manager.recover_from_oom()
+                        raise
+                    retries += 1
+                    print(f"Out of memory at {width}x{height} x{remaining}; retrying with {step} "
+                          f"(savers: {', '.join(fallback['savers']) or 'none'}, "
+                          f"max batch: {fallback['max_batch_size'] or len(prompts)})")
+                # Outside the except block so the failed attempt's tensors can be released
+                self.vram_manager.cleanup("oom")
+
+            if retries:
+                self.oom_fallbacks[key] = fallback
+            if fallback["savers"] or fallback["max_batch_size"]:
+                for result in results:
+                    result["metadata"]["oom_fallback"] = dict(fallback, retries=retries)
+
+        # Hand the images to the background writer; the GPU lock is already released
+        outputs = []
+        for result, image in zip(results, images):
+            if save_output:
+                _, write = self.output_writer.submit(image, result)
+                outputs.append(chain(write, result))
+            else:
+                outputs.append(resolved(result))
+        if wait_for_output:
+            outputs = [output.result() for output in outputs]
+        return outputs if batched else outputs[0]
+
+    def generate_in_chunks(self, prompts, negative_prompts, seeds, width, height, steps, guidance, family,
+                           cancel_token, on_progress, fallback, batched, results, images):
+        """
+        Run the batch in pipeline calls of at most `fallback["max_batch_size"]`
+        prompts, with `fallback["savers"]` forced on. Per-prompt cancel tokens
+        and progress callbacks are split along with the prompts.
+
+        Each finished chunk is appended to `results` and `images` right away,
+        and prompts already in `results` are skipped, so a call after an OOM
+        continues where the failed one stopped.
+        """
+        size = fallback["max_batch_size"] or len(prompts)
+        for first in range(len(results), len(prompts), size):
+            chunk = slice(first, first + size)
+            chunk_results, chunk_images = self.generate_batch(
+                prompts[chunk], negative_prompts[chunk], seeds[chunk], width, height, steps, guidance, family,
+                cancel_token[chunk] if isinstance(cancel_token, (list, tuple)) else cancel_token,
+                on_progress[chunk] if isinstance(on_progress, (list, tuple)) else on_progress,
+                fallback["savers"], batched
+            )
+            results.extend(chunk_results)
+            images.extend(chunk_images)
+
+    def generate_batch(self, prompts, negative_prompts, seeds, width, height, steps, guidance, family,
+                       cancel_token, on_progress, required_savers, batched):
+        """One pipeline call for a list of compatible prompts; returns the results and their images."""
+        cancel_tokens = [t for t in (cancel_token if isinstance(cancel_token, (list, tuple)) else [cancel_token]) if t is not None]
+        progress_callbacks = [c for c in (on_progress if isinstance(on_progress, (list, tuple)) else [on_progress]) if c is not None]
+        if cancel_tokens and all(token.cancelled for token in cancel_tokens):
+            raise GenerationCancelled("Cancelled before start")
+
+        with self.lock, self.instrumentation.request(self.device) as recorder:
+            # VRAM cleanup, only when fragmentation/slack thresholds are crossed
+            self.vram_manager.pre_generation_cleanup()
+            if self.pipe in self.onnx_pipes:
+                pass  # No torch modules to offload, slice or tile
+            elif self.pipe not in self.cpu_only_pipes:
+                self.vram_manager.adapt(self.pipe, width, height, len(prompts), required=required_savers)
+            else:
+                # No offload on CPU-only pipelines; fallback savers simply stay on
+                if "attention_slicing" in required_savers:
+                    self.pipe.enable_attention_slicing(slice_size="max")
+                if "vae_tiling" in required_savers:
+                    self.pipe.vae.enable_tiling()
+
+            # Generator seed. A batch needs one generator per image, so requests
+            # without a seed get a random one that is reported back.
+            generator = None
+            if batched and any(s is not None for s in seeds):
+                seeds = [s if s is not None else random.randint(0, 2**32 - 1) for s in seeds]
+                generator = [torch.Generator(device="cpu").manual_seed(s) for s in seeds]
+            elif seeds[0] is not None:
+                generator = torch.Generator(device="cpu").manual_seed(seeds[0])
+
+            print(f"Generating: {prompts if batched else prompts[0]!r} ({width}x{height})")
+
+            # CRITICAL: CPU WARNING
+            if self.device == "cpu":
+                print("\n" + "!"*50)
+                print("WARNING: COMPUTE DEVICE IS 'CPU'. GENERATION WILL BE EXTREMELY SLOW.")
+                print("Please install CUDA Torch: pip install torch torchvision --index-url https://download.pytorch.org/whl/cu121")
+                print("!"*50 + "\n")
+
+            start_time = time.time()
+
+            if self.scheduler_pool is None:
+                self.scheduler_pool = SchedulerPool(self.pipe.scheduler.config, device=self.device)
+
+            with recorder.stage("text_encode"):
+                prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds = \
+                    self.encode_prompts(prompts, negative_prompts)
+
+            # Generate
+            # Optimization note: the VRAM plan either placed the pipeline on the device or offload hooks move it
+            with self.scheduler_pool.checkout(family) as scheduler:
+                pipe = self.request_pipe(scheduler)
+                self.instrumentation.probe_offload(pipe)
+                recorder.start_denoise()
+                images = pipe(
+                    prompt_embeds=prompt_embeds,
+                    negative_prompt_embeds=negative_prompt_embeds,
+                    pooled_prompt_embeds=pooled_prompt_embeds,
+                    negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+                    width=width,
+                    height=height,
+                    num_inference_steps=steps,
+                    guidance_scale=guidance,
+                    generator=generator,
+                    callback_on_step_end=self.step_callback(cancel_tokens, progress_callbacks, recorder)
+                ).images
+
+            duration = time.time() - start_time
+            print(f"Generation complete in {duration:.2f}s ({len(images)} image(s))")
+
+            results = []
+            for i in range(len(images)):
+                results.append({
+                    "image_url": None, # Set once the image is handed to the output writer
+                    "image_id": None,
+                    "metadata": {
+                        "width": width,
+                        "height": height,
+                        "steps": steps,
+                        "seed": seeds[i],
+                        "model": self.current_model_id,
+                        "batch_size": len(images)
+                    },
+                    "generation_time": duration
+                })
+
+            # Cleanup
+            self.vram_manager.post_generation_cleanup()
+
+            self.instrumentation.observe(recorder, duration, len(images))
+            timings = recorder.summary()
+            for result in results:
+                if timings is not None:
+                    result["metadata"]["timings"] = timings
+                if recorder.trace_path is not None:
+                    result["metadata"]["profile_trace"] = recorder.trace_path
+
+        return results, images
 
     def list_models(self):
         # Scan models directory
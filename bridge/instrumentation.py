@@ -0,0 +1,277 @@
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import psutil
+import torch
+
+try:
+    from metrics import BYTES_BUCKETS, MetricsRegistry
+except ImportError:
+    from bridge.metrics import BYTES_BUCKETS, MetricsRegistry
+
+MB = 1024 ** 2
+
+# Recorder of the generation running on this thread, read by the module probes
+_local = threading.local()
+
+
+class NullRecorder:
+    """Stand-in when instrumentation is off: every probe is a no-op."""
+
+    def __init__(self):
+        self.trace_path = None
+
+    def stage(self, name):
+        return nullcontext()
+
+    def begin(self, name, reset_peak=True):
+        return None
+
+    def end(self, name, start, track_memory=True):
+        pass
+
+    def start_denoise(self):
+        pass
+
+    def step_end(self):
+        pass
+
+    def summary(self):
+        return None
+
+
+class StageRecorder:
+    """
+    Wall time and peak memory per stage of one generate() call.
+
+    Peak memory is the CUDA caching allocator's peak allocated bytes within the
+    stage on GPU, and the process RSS at the end of the stage on CPU. CUDA work
+    is synchronized at every boundary so GPU time lands in the right stage;
+    that costs some overlap, which is why recording is opt-in.
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.cuda = self.device.type == "cuda"
+        self.process = psutil.Process()
+        self.stages = {}
+        self.steps = []
+        self.trace_path = None
+        self._step_start = None
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+
+    def _reset_peak(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def _peak_mb(self):
+        if self.cuda:
+            return torch.cuda.max_memory_allocated(self.device) / MB
+        return self.process.memory_info().rss / MB
+
+    def begin(self, name, reset_peak=True):
+        self._sync()
+        if reset_peak:
+            self._reset_peak()
+        return time.perf_counter()
+
+    def end(self, name, start, track_memory=True):
+        self._sync()
+        entry = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "peak_mb": None})
+        entry["seconds"] += time.perf_counter() - start
+        entry["calls"] += 1
+        if track_memory:
+            entry["peak_mb"] = max(entry["peak_mb"] or 0.0, self._peak_mb())
+
+    @contextmanager
+    def stage(self, name):
+        start = self.begin(name)
+        with torch.profiler.record_function(name):
+            yield
+        self.end(name, start)
+
+    def start_denoise(self):
+        """Mark the pipeline call start; the first step therefore includes latent/timestep preparation."""
+        self._sync()
+        self._reset_peak()
+        self._step_start = time.perf_counter()
+
+    def step_end(self):
+        self._sync()
+        now = time.perf_counter()
+        self.steps.append({"seconds": now - self._step_start, "peak_mb": self._peak_mb()})
+        self._reset_peak()
+        self._step_start = now
+
+    def summary(self):
+        timings = {
+            name: {"seconds": round(entry["seconds"], 4), "calls": entry["calls"],
+                   "peak_mb": round(entry["peak_mb"], 1) if entry["peak_mb"] is not None else None}
+            for name, entry in self.stages.items()
+        }
+        if self.steps:
+            timings["denoise"] = {
+                "seconds": round(sum(s["seconds"] for s in self.steps), 4),
+                "peak_mb": round(max(s["peak_mb"] for s in self.steps), 1),
+                "steps": [{"seconds": round(s["seconds"], 4), "peak_mb": round(s["peak_mb"], 1)} for s in self.steps],
+            }
+        timings["memory"] = "cuda_peak_allocated" if self.cuda else "process_rss"
+        return timings
+
+
+def active_recorder():
+    return getattr(_local, "recorder", None) or NullRecorder()
+
+
+def _timed_transfer(method):
+    """Wrap a bound offload method so it reports to the active recorder as "offload_transfer"."""
+    def wrapper(*args, **kwargs):
+        recorder = active_recorder()
+        if getattr(_local, "in_transfer", False) or isinstance(recorder, NullRecorder):
+            return method(*args, **kwargs)
+        _local.in_transfer = True
+        try:
+            start = recorder.begin("offload_transfer", reset_peak=False)
+            result = method(*args, **kwargs)
+            recorder.end("offload_transfer", start, track_memory=False)
+            return result
+        finally:
+            _local.in_transfer = False
+    return wrapper
+
+
+class Instrumentation:
+    """
+    Opt-in per-stage instrumentation of FooocusConnector.generate:
+    text encoding, every denoising step, VAE decode, PNG encode, disk write
+    and CPU-offload transfers. Summaries go into the response metadata and
+    into Prometheus-style histograms served on /metrics. End-to-end
+    generation time is always recorded.
+
+    `profile_request=N` wraps the Nth generate() call (counted from startup,
+    warm-up excluded; chunks and OOM retries of one call are one request) in
+    torch.profiler and writes a Chrome trace to `trace_dir`.
+    """
+
+    def __init__(self, enabled=False, profile_request=0, trace_dir=None):
+        self.enabled = enabled
+        self.profile_request = profile_request
+        self.trace_dir = trace_dir or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                   "outputs", "traces")
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        self.metrics = MetricsRegistry()
+        self.generation_seconds = self.metrics.histogram(
+            "prunejuice_generation_seconds", "End-to-end generate() wall time.")
+        self.images_total = self.metrics.counter("prunejuice_images_total", "Images generated.")
+        self.stage_seconds = self.metrics.histogram(
+            "prunejuice_stage_seconds", "Wall time per generation stage (denoise_step is per step).")
+        self.stage_memory = self.metrics.histogram(
+            "prunejuice_stage_peak_memory_bytes", "Peak memory per generation stage.", BYTES_BUCKETS)
+
+    def install_probes(self, pipe):
+        """Forward hooks timing every VAE decoder call (tiles and slices are summed)."""
+        decoder = getattr(getattr(pipe, "vae", None), "decoder", None)
+        if not self.enabled or decoder is None or getattr(decoder, "_prunejuice_probe", False):
+            return
+        starts = []
+        decoder.register_forward_pre_hook(lambda module, args: starts.append(active_recorder().begin("vae_decode")))
+        decoder.register_forward_hook(lambda module, args, output: active_recorder().end("vae_decode", starts.pop()))
+        decoder._prunejuice_probe = True
+
+    def probe_offload(self, pipe):
+        """
+        Time the model CPU offload transfers of the next call of `pipe`: the
+        current offload hooks' pre_forward (next model in, previous one out) and
+        maybe_free_model_hooks (final offload). The hooks are rebuilt after every
+        call, so this runs before each one; only this pipeline's hook instances
+        are wrapped, accelerate's classes are left alone.
+        """
+        if not self.enabled:
+            return
+        for user_hook in getattr(pipe, "_all_hooks", None) or []:
+            hook = getattr(user_hook, "hook", None)
+            if hook is not None and not getattr(hook, "_prunejuice_probe", False):
+                hook.pre_forward = _timed_transfer(hook.pre_forward)
+                hook._prunejuice_probe = True
+        pipe.maybe_free_model_hooks = _timed_transfer(pipe.maybe_free_model_hooks)
+
+    @contextmanager
+    def uncounted(self):
+        """Generations on this thread inside the block (e.g. warm-up) are not numbered requests."""
+        _local.uncounted = True
+        try:
+            yield
+        finally:
+            _local.uncounted = False
+
+    @contextmanager
+    def generation(self):
+        """
+        Scope of one FooocusConnector.generate() call, however many pipeline
+        calls it takes. Counts it (outside `uncounted`) and runs it under
+        torch.profiler if it is request number `profile_request`.
+        """
+        number = None
+        if not getattr(_local, "uncounted", False):
+            with self.lock:
+                self.requests += 1
+                number = self.requests
+        if number is None or number != self.profile_request:
+            yield
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        # Set up front so the response metadata can point at the trace
+        _local.trace_path = os.path.join(self.trace_dir, f"request_{number}.json")
+        try:
+            with torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True) as profiler:
+                yield
+            os.makedirs(self.trace_dir, exist_ok=True)
+            profiler.export_chrome_trace(_local.trace_path)
+            print(f"Profiler trace of request {number} written to {_local.trace_path}")
+        finally:
+            _local.trace_path = None
+
+    @contextmanager
+    def request(self, device):
+        """Scope of one pipeline call; yields the recorder its stages report to."""
+        recorder = StageRecorder(device) if self.enabled else NullRecorder()
+        recorder.trace_path = getattr(_local, "trace_path", None)
+        _local.recorder = recorder
+        try:
+            yield recorder
+        finally:
+            _local.recorder = None
+
+    def observe(self, recorder, duration, images):
+        """Add one generation to the /metrics histograms."""
+        self.generation_seconds.observe(duration)
+        self.images_total.inc(images)
+        timings = recorder.summary()
+        if not timings:
+            return
+        for name, entry in timings.items():
+            if name == "denoise":
+                for step in entry["steps"]:
+                    self.stage_seconds.observe(step["seconds"], stage="denoise_step")
+                    self.stage_memory.observe(step["peak_mb"] * MB, stage="denoise_step")
+            elif isinstance(entry, dict):
+                self.stage_seconds.observe(entry["seconds"], stage=name)
+                if entry["peak_mb"] is not None:
+                    self.stage_memory.observe(entry["peak_mb"] * MB, stage=name)
+
+    def observe_stage(self, name, seconds):
+        """Time spent outside generate() on behalf of a request (e.g. background image writes)."""
+        if self.enabled:
+            self.stage_seconds.observe(seconds, stage=name)
+
+    def render_metrics(self):
+        return self.metrics.render()
@@ -0,0 +1,216 @@
+import asyncio
+import itertools
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    from progress import CancellationToken, GenerationCancelled, ProgressBroker
+except ImportError:
+    from bridge.progress import CancellationToken, GenerationCancelled, ProgressBroker
+
+# Lower value is served first
+PRIORITY_LANES = {"interactive": 0, "bulk": 1}
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when no more jobs can be accepted."""
+
+
+class Job:
+    def __init__(self, params, priority="interactive"):
+        self.id = f"job_{uuid.uuid4().hex[:12]}"
+        self.params = params
+        self.priority = priority
+        self.seq = None
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_token = CancellationToken()
+        self.progress = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "progress": self.progress,
+        }
+
+
+class JobQueue:
+    """
+    Asyncio job queue with a single dedicated GPU worker.
+
+    Jobs are served by priority lane (interactive before bulk), FIFO within a
+    lane. Compatible queued jobs are handed to the worker together so they can
+    run as one batched generation.
+    """
+
+    def __init__(self, run_batch, batch_key, max_queued: int = 32, max_batch_size=lambda params: 1,
+                 keep_finished: int = 256):
+        """
+        Args:
+            run_batch: Blocking callable taking a list of jobs and returning one result per job.
+                A result may be a concurrent Future (e.g. image still being written); the job
+                completes when it resolves while the worker moves on to the next batch.
+            batch_key: Callable mapping job params to a key; equal keys may share a batch
+            max_queued: Queue capacity across all lanes; submit raises QueueFull beyond it
+            max_batch_size: Callable giving the batch limit for the head job's params
+            keep_finished: Finished jobs kept around for status/result lookups
+        """
+        self.run_batch = run_batch
+        self.batch_key = batch_key
+        self.max_queued = max_queued
+        self.max_batch_size = max_batch_size
+        self.keep_finished = keep_finished
+        self.queue = None
+        self.jobs = OrderedDict()
+        self.counter = itertools.count()
+        self.current = []
+        self.worker = None
+        # Per-job progress stream (status changes here, denoising steps from run_batch)
+        self.events = ProgressBroker()
+        # Diffusion runs off the event loop on one thread, so HTTP workers never block on the GPU
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu-worker")
+
+    def start(self):
+        """Start the worker on the running event loop."""
+        self.queue = asyncio.PriorityQueue()
+        self.worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        self.executor.shutdown(wait=False)
+
+    def queued_count(self):
+        return sum(1 for job in self.jobs.values() if job.status == "queued")
+
+    def submit(self, params, priority="interactive"):
+        if priority not in PRIORITY_LANES:
+            raise ValueError(f"Unknown priority lane '{priority}'")
+        if self.queued_count() >= self.max_queued:
+            raise QueueFull(f"Queue is full ({self.max_queued} jobs waiting)")
+
+        job = Job(params, priority)
+        job.seq = next(self.counter)
+        self.jobs[job.id] = job
+        self.queue.put_nowait((PRIORITY_LANES[priority], job.seq, job))
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def position(self, job):
+        """Number of queued jobs that will be served before this one."""
+        if job.status != "queued":
+            return None
+        rank = (PRIORITY_LANES[job.priority], job.seq)
+        return sum(
+            1 for other in self.jobs.values()
+            if other.status == "queued" and (PRIORITY_LANES[other.priority], other.seq) < rank
+        )
+
+    def cancel(self, job_id):
+        """
+        Cancel a job. Queued jobs are dropped immediately; a running job stops
+        within one denoising step (or, in a batch with live jobs, has its
+        result discarded).
+        """
+        job = self.jobs.get(job_id)
+        if job is None or job.status in ("completed", "failed", "cancelled"):
+            return job
+        job.cancel_token.cancel()
+        job.status = "cancelled"
+        job.finished_at = time.time()
+        self.events.publish(job.id, {"event": "cancelled"})
+        return job
+
+    def report_progress(self, job, event):
+        """Record a job's latest step event and publish it. Safe to call from the GPU thread."""
+        job.progress = event
+        self.events.publish(job.id, event)
+
+    def _take_batch(self, head):
+        """Pull queued jobs compatible with `head`, leaving the rest in order."""
+        batch = [head]
+        limit = self.max_batch_size(head.params)
+        key = self.batch_key(head.params)
+        held = []
+        while not self.queue.empty():
+            entry = self.queue.get_nowait()
+            job = entry[2]
+            if job.status != "queued":
+                continue
+            if len(batch) < limit and self.batch_key(job.params) == key:
+                batch.append(job)
+            else:
+                held.append(entry)
+        for entry in held:
+            self.queue.put_nowait(entry)
+        return batch
+
+    def _prune_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self.jobs[job_id]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, head = await self.queue.get()
+            if head.status != "queued":
+                continue
+
+            batch = self._take_batch(head)
+            now = time.time()
+            for job in batch:
+                job.status = "running"
+                job.started_at = now
+                self.events.publish(job.id, {"event": "started", "batch_size": len(batch)})
+            self.current = batch
+
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, batch)
+                errors = [None] * len(batch)
+            except GenerationCancelled:
+                # Every job in the batch was cancelled; cancel() already updated them
+                results = errors = [None] * len(batch)
+            except Exception as e:
+                results = [None] * len(batch)
+                errors = [e] * len(batch)
+
+            for job, result, error in zip(batch, results, errors):
+                if isinstance(result, Future):
+                    asyncio.wrap_future(result).add_done_callback(
+                        lambda f, job=job: self._finish(job, None if f.exception() else f.result(), f.exception())
+                    )
+                else:
+                    self._finish(job, result, error)
+            self.current = []
+            self._prune_finished()
+
+    def _finish(self, job, result, error):
+        if job.status == "cancelled":
+            return
+        job.finished_at = time.time()
+        if error is not None:
+            job.status = "failed"
+            job.error = error
+        else:
+            job.status = "completed"
+            job.result = result
+        self.events.publish(job.id, {"event": job.status})
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+WEIGHT_SUFFIXES = (".safetensors", ".bin")
+
+# (path, size, mtime) -> sha256, so local checkpoints are only hashed once per process
+_file_hash_cache = {}
+
+
+def _file_digest(path):
+    """
+    Content identity of a weight file. Files in the HuggingFace cache are
+    symlinks to blobs named by their sha256, so the blob name is used as is;
+    anything else is hashed once and memoized.
+    """
+    real = os.path.realpath(path)
+    stat = os.stat(real)
+    if os.path.basename(os.path.dirname(real)) == "blobs":
+        return f"{os.path.basename(real)}:{stat.st_size}"
+
+    key = (real, stat.st_size, stat.st_mtime)
+    if key not in _file_hash_cache:
+        sha256 = hashlib.sha256()
+        with open(real, "rb") as f:
+            for block in iter(lambda: f.read(16 * 1024**2), b""):
+                sha256.update(block)
+        _file_hash_cache[key] = f"{sha256.hexdigest()}:{stat.st_size}"
+    return _file_hash_cache[key]
+
+
+def resolve_model_dir(load_path):
+    """Local directory for a model path or a HuggingFace id that is already cached, else None."""
+    if os.path.isdir(load_path):
+        return load_path
+    try:
+        from huggingface_hub import snapshot_download
+        return snapshot_download(load_path, local_files_only=True)
+    except Exception:
+        return None
+
+
+def component_fingerprints(load_path):
+    """
+    Map each pipeline component with weights to a fingerprint of its config and
+    weight files. Components with equal fingerprints hold identical weights and
+    can be shared between pipelines.
+    """
+    model_dir = resolve_model_dir(load_path)
+    index_path = os.path.join(model_dir, "model_index.json") if model_dir else None
+    if index_path is None or not os.path.exists(index_path):
+        return {}
+
+    with open(index_path) as f:
+        components = [name for name in json.load(f) if not name.startswith("_")]
+
+    fingerprints = {}
+    for name in components:
+        component_dir = os.path.join(model_dir, name)
+        if not os.path.isdir(component_dir):
+            continue
+        files = sorted(f for f in os.listdir(component_dir) if f.endswith(WEIGHT_SUFFIXES) or f == "config.json")
+        if not any(f.endswith(WEIGHT_SUFFIXES) for f in files):
+            continue
+        parts = [f"{f}={_file_digest(os.path.join(component_dir, f))}" for f in files]
+        fingerprints[name] = hashlib.sha256("|".join(parts).encode()).hexdigest()
+    return fingerprints
+
+
+def _modules(pipe):
+    return {name: module for name, module in pipe.components.items() if isinstance(module, torch.nn.Module)}
+
+
+def _module_bytes(module):
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ResidentModel:
+    def __init__(self, model_id, pipe, fingerprints):
+        self.model_id = model_id
+        self.pipe = pipe
+        self.fingerprints = fingerprints
+        self.tier = "cpu"
+        # Set when another pipeline re-hooked or moved a module this one shares
+        self.stale = False
+
+
+class ModelResidencyManager:
+    """
+    Keeps several pipelines resident across memory tiers and evicts by LRU.
+
+    - gpu: activated (VRAM optimizations applied), ready to run immediately
+    - cpu: weights parked in (pinned) system RAM, activation takes seconds
+    - disk: not resident, reloaded through `load_fn`
+
+    Components whose config and weight files are identical (e.g. the same VAE
+    or text encoders) are loaded once and shared between pipelines.
+    """
+
+    def __init__(self, load_fn, activate_fn, vram_budget_bytes, ram_budget_bytes):
+        """
+        Args:
+            load_fn: load_fn(model_id, shared_components) -> pipeline, loaded to CPU
+            activate_fn: activate_fn(pipeline) -> pipeline ready to run on the GPU
+            vram_budget_bytes: Weight bytes allowed in the gpu tier
+            ram_budget_bytes: Weight bytes allowed in the cpu tier
+        """
+        self.load_fn = load_fn
+        self.activate_fn = activate_fn
+        self.vram_budget_bytes = vram_budget_bytes
+        self.ram_budget_bytes = ram_budget_bytes
+        self.pin_memory = torch.cuda.is_available()
+        # model_id -> ResidentModel, least recently used first
+        self.models = OrderedDict()
+        self.lock = threading.RLock()
+
+    def tier_bytes(self, tier):
+        """Weight bytes held by a tier, counting shared components once."""
+        seen = {}
+        for entry in self.models.values():
+            if entry.tier == tier:
+                for module in _modules(entry.pipe).values():
+                    seen[id(module)] = module
+        return sum(_module_bytes(m) for m in seen.values())
+
+    @staticmethod
+    def _share(a, b):
+        return bool({id(m) for m in _modules(a.pipe).values()} & {id(m) for m in _modules(b.pipe).values()})
+
+    def _mark_sharing_stale(self, entry):
+        for other in self.models.values():
+            if other is not entry and other.tier == "gpu" and self._share(entry, other):
+                other.stale = True
+
+    def _shared_components(self, fingerprints):
+        """Already-resident modules matching the fingerprints of a model about to load."""
+        shared = {}
+        for entry in self.models.values():
+            modules = _modules(entry.pipe)
+            for name, fingerprint in fingerprints.items():
+                if name not in shared and entry.fingerprints.get(name) == fingerprint and name in modules:
+                    shared[name] = modules[name]
+        return shared
+
+    def _demote(self, entry):
+        """gpu -> cpu: drop offload hooks and park the weights in pinned RAM."""
+        print(f"Parking {entry.model_id} in system RAM...")
+        entry.pipe.remove_all_hooks()
+        entry.pipe.to("cpu")
+        if self.pin_memory:
+            for module in _modules(entry.pipe).values():
+                for tensor in list(module.parameters()) + list(module.buffers()):
+                    if not tensor.is_pinned():
+                        tensor.data = tensor.data.pin_memory()
+        entry.tier = "cpu"
+        # Shared modules just lost their hooks and moved to CPU
+        self._mark_sharing_stale(entry)
+
+    def _evict(self, entry):
+        """cpu -> disk: forget the pipeline; shared modules live on in other pipelines."""
+        print(f"Evicting {entry.model_id} from memory...")
+        del self.models[entry.model_id]
+
+    def _enforce_budgets(self, keep):
+        for entry in list(self.models.values()):
+            if self.tier_bytes("gpu") <= self.vram_budget_bytes:
+                break
+            if entry.tier == "gpu" and entry is not keep:
+                self._demote(entry)
+
+        for entry in list(self.models.values()):
+            if self.tier_bytes("cpu") <= self.ram_budget_bytes:
+                break
+            if entry.tier == "cpu" and entry is not keep:
+                self._evict(entry)
+
+    def acquire(self, model_id, load_path=None):
+        """
+        Return a ready-to-run pipeline for `model_id`, promoting or loading it
+        as needed and evicting least recently used models to stay in budget.
+        """
+        with self.lock:
+            entry = self.models.get(model_id)
+            if entry is None:
+                fingerprints = component_fingerprints(load_path or model_id)
+                shared = self._shared_components(fingerprints)
+                if shared:
+                    print(f"Sharing components with resident models: {', '.join(sorted(shared))}")
+                pipe = self.load_fn(model_id, shared)
+                if pipe is None:
+                    return None
+                entry = ResidentModel(model_id, pipe, fingerprints)
+                self.models[model_id] = entry
+
+            self.models.move_to_end(model_id)
+            needs_activation = entry.tier != "gpu"
+            entry.tier = "gpu"
+            # Make room first: demoting a model that shares modules with this one marks it stale
+            self._enforce_budgets(keep=entry)
+            if needs_activation or entry.stale:
+                entry.pipe = self.activate_fn(entry.pipe)
+                entry.stale = False
+                # Activation re-hooks shared modules, so pipelines sharing them must redo theirs
+                self._mark_sharing_stale(entry)
+            return entry.pipe
+
+    def stats(self):
+        with self.lock:
+            return {
+                "gpu": [m.model_id for m in self.models.values() if m.tier == "gpu"],
+                "cpu": [m.model_id for m in self.models.values() if m.tier == "cpu"],
+                "gpu_bytes": self.tier_bytes("gpu"),
+                "cpu_bytes": self.tier_bytes("cpu"),
+                "vram_budget_bytes": self.vram_budget_bytes,
+                "ram_budget_bytes": self.ram_budget_bytes,
+            }
@@ -0,0 +1,176 @@
+import io
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Pillow format name, file extension and media type per output format
+FORMATS = {
+    "png": ("PNG", "png", "image/png"),
+    "webp": ("WEBP", "webp", "image/webp"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+}
+
+
+def resolved(value):
+    """An already completed Future holding `value`."""
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def chain(future, value):
+    """Future resolving to `value` once `future` completes (or failing with its error)."""
+    chained = Future()
+
+    def done(f):
+        error = f.exception()
+        if error is not None:
+            chained.set_exception(error)
+        else:
+            chained.set_result(value)
+
+    future.add_done_callback(done)
+    return chained
+
+
+class OutputWriter:
+    """
+    Encodes and writes generated images on a small thread pool, so the GPU
+    worker only hands the image off and moves on to the next job.
+
+    Names are allocated up front (`out_<ms>_<random>.<ext>`), so the caller
+    can report the path immediately and concurrent requests never collide.
+    Files are written to a hidden temporary name in the same directory and
+    renamed into place, so a reader never sees a partial image.
+
+    With a `store`, the encoded bytes are also kept in memory under the same
+    name (without extension) as the image id; `persist=False` skips the disk.
+    An image too large for the store gets `image_id` None (and fails the write
+    without a disk copy), so callers never hand out an id that cannot be fetched.
+    """
+
+    def __init__(self, output_dir, image_format="png", compress_level=6, quality=90, workers=2, observe=None,
+                 store=None, persist=True):
+        """
+        Args:
+            output_dir: Directory the images are written to (created on first write)
+            image_format: "png", "webp" or "jpeg"
+            compress_level: zlib level for PNG, 0 (fastest) to 9 (smallest)
+            quality: Quality for WebP and JPEG, 1 to 100
+            workers: Encoder threads
+            observe: Optional callable(stage, seconds) receiving "image_encode" and "disk_write" timings
+            store: Optional ResultStore receiving the encoded bytes
+            persist: Write files to `output_dir` (requires a store when False)
+        """
+        if image_format not in FORMATS:
+            raise ValueError(f"Unknown output format {image_format!r} (expected one of {', '.join(FORMATS)})")
+        if not persist and store is None:
+            raise ValueError("persist=False needs a result store, the images would go nowhere")
+        self.output_dir = output_dir
+        self.image_format = image_format
+        self.compress_level = compress_level
+        self.quality = quality
+        self.observe = observe
+        self.store = store
+        self.persist = persist
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="output-writer")
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @property
+    def media_type(self):
+        return FORMATS[self.image_format][2]
+
+    def allocate_name(self):
+        return f"out_{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
+
+    def save_options(self):
+        if self.image_format == "png":
+            return {"compress_level": self.compress_level}
+        if self.image_format == "webp":
+            return {"quality": self.quality, "method": 4}
+        return {"quality": self.quality, "optimize": True}
+
+    def encode(self, image):
+        """Encoded image bytes in the configured format."""
+        if self.image_format == "jpeg" and image.mode != "RGB":
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format=FORMATS[self.image_format][0], **self.save_options())
+        return buffer.getbuffer()
+
+    def submit(self, image, output=None):
+        """
+        Queue `image` for encoding and writing.
+
+        Args:
+            image: PIL image
+            output: Optional dict (e.g. the generation result) to fill in; a new one by default
+
+        Returns:
+            (output, future): `output` with "image_url" (path or None) and "image_id" (id or None),
+            known immediately, and a Future resolving to it once the image is stored / in place.
+            "image_id" is reset to None if the store rejects the image.
+        """
+        name = self.allocate_name()
+        output = {} if output is None else output
+        output.update({
+            "image_url": os.path.join(self.output_dir, f"{name}.{FORMATS[self.image_format][1]}") if self.persist else None,
+            "image_id": name if self.store is not None else None,
+        })
+        with self.lock:
+            self.pending += 1
+        return output, self.executor.submit(self._write, image, output)
+
+    def _write(self, image, output):
+        written = False
+        try:
+            start = time.perf_counter()
+            data = self.encode(image)
+            encoded = time.perf_counter()
+            if self.store is not None and not self.store.put(output["image_id"], data, self.media_type):
+                output["image_id"] = None
+                with self.lock:
+                    self.rejected += 1
+                if not self.persist:
+                    raise RuntimeError(f"Encoded image ({len(data)} bytes) exceeds the result store budget "
+                                       f"and outputs are not persisted")
+                print(f"Result store rejected a {len(data)} byte image; it is only available on disk")
+            if self.persist:
+                os.makedirs(self.output_dir, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=self.output_dir, prefix=".out_", suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        f.write(data)
+                    os.replace(tmp_path, output["image_url"])
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+            if self.observe is not None:
+                self.observe("image_encode", encoded - start)
+                if self.persist:
+                    self.observe("disk_write", time.perf_counter() - encoded)
+            written = True
+            return output
+        finally:
+            with self.lock:
+                self.pending -= 1
+                if written:
+                    self.written += 1
+                else:
+                    self.failed += 1
+
+    def stats(self):
+        with self.lock:
+            return {"format": self.image_format, "persist": self.persist, "pending": self.pending,
+                    "written": self.written, "failed": self.failed, "rejected": self.rejected}
+
+    def close(self):
+        """Finish the queued writes and stop the threads."""
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,54 @@
+import asyncio
+import threading
+
+
+class GenerationCancelled(Exception):
+    """Raised from inside the denoising loop when a generation is cancelled."""
+
+
+class CancellationToken:
+    """
+    Thread-safe cancel flag shared between the HTTP side and the GPU worker.
+    The connector checks it after every denoising step.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+
+class ProgressBroker:
+    """
+    Fan-out of progress events to async subscribers (SSE streams), keyed by
+    channel (the job id). `publish` may be called from any thread.
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, channel):
+        queue = asyncio.Queue()
+        with self.lock:
+            self.subscribers.setdefault(channel, []).append((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, channel, queue):
+        with self.lock:
+            subs = [s for s in self.subscribers.get(channel, []) if s[1] is not queue]
+            if subs:
+                self.subscribers[channel] = subs
+            else:
+                self.subscribers.pop(channel, None)
+
+    def publish(self, channel, event):
+        with self.lock:
+            subs = list(self.subscribers.get(channel, []))
+        for loop, queue in subs:
+            loop.call_soon_threadsafe(queue.put_nowait, event)
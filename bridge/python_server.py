@@ -1,9 +1,12 @@
 from fastapi import FastAPI, HTTPException, Depends
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from fastapi.security.api_key import APIKeyHeader
 from pydantic import BaseModel
 import uvicorn
+import json
 import sys
 import os
+import uuid
 import torch
 import psutil
 from typing import Optional
@@ -14,12 +17,67 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 try:
     from fooocus_connector import FooocusConnector
+    from batching import MicroBatcher, batch_key
+    from job_queue import JobQueue, QueueFull
     from presets import list_presets, get_preset
     from security import generate_token
+    from result_store import ResultStore
 except ImportError:
     from bridge.fooocus_connector import FooocusConnector
+    from bridge.batching import MicroBatcher, batch_key
+    from bridge.job_queue import JobQueue, QueueFull
     from bridge.presets import list_presets, get_preset
     from bridge.security import generate_token
+    from bridge.result_store import ResultStore
+from optimization.vram_manager import is_out_of_memory
+from optimization.compiled import parse_buckets
+
+# Micro-batching: compatible /generate requests arriving within this window are
+# run as one batched pipeline call. 0 disables batching.
+BATCH_WINDOW_MS = int(os.environ.get("PRUNEJUICE_BATCH_WINDOW_MS", "0"))
+MAX_BATCH_SIZE = int(os.environ.get("PRUNEJUICE_MAX_BATCH_SIZE", "4"))
+# Jobs waiting across both priority lanes before /jobs answers 429.
+MAX_QUEUED_JOBS = int(os.environ.get("PRUNEJUICE_MAX_QUEUED_JOBS", "32"))
+# Model loaded in the background at startup ("" disables preloading).
+PRELOAD_MODEL = os.environ.get("PRUNEJUICE_PRELOAD_MODEL", "")
+# Resolutions warmed up after every model load, e.g. "1024x1024,832x1216" ("" disables warm-up).
+WARMUP_RESOLUTIONS = [
+    tuple(int(v) for v in res.lower().split("x"))
+    for res in os.environ.get("PRUNEJUICE_WARMUP_RESOLUTIONS", "").split(",") if res.strip()
+]
+WARMUP_STEPS = int(os.environ.get("PRUNEJUICE_WARMUP_STEPS", "2"))
+# Byte budget of the prompt embedding cache, in MiB.
+EMBED_CACHE_MB = int(os.environ.get("PRUNEJUICE_EMBED_CACHE_MB", "256"))
+# Weight budgets for models kept hot on the GPU / parked in RAM (defaults: VRAM limit / half of RAM).
+VRAM_BUDGET_GB = float(os.environ["PRUNEJUICE_VRAM_BUDGET_GB"]) if os.environ.get("PRUNEJUICE_VRAM_BUDGET_GB") else None
+RAM_BUDGET_GB = float(os.environ["PRUNEJUICE_RAM_BUDGET_GB"]) if os.environ.get("PRUNEJUICE_RAM_BUDGET_GB") else None
+# Per-stage timing/memory in responses and /metrics (adds a CUDA sync per stage).
+INSTRUMENT = os.environ.get("PRUNEJUICE_INSTRUMENT", "0") == "1"
+# Capture a torch profiler trace of the Nth generation (0 disables) into PRUNEJUICE_TRACE_DIR.
+PROFILE_REQUEST = int(os.environ.get("PRUNEJUICE_PROFILE_REQUEST", "0"))
+TRACE_DIR = os.environ.get("PRUNEJUICE_TRACE_DIR") or None
+# Output images: format (png, webp, jpeg), PNG zlib level 0-9, WebP/JPEG quality, encoder threads.
+OUTPUT_FORMAT = os.environ.get("PRUNEJUICE_OUTPUT_FORMAT", "png").lower()
+PNG_COMPRESS_LEVEL = int(os.environ.get("PRUNEJUICE_PNG_COMPRESS_LEVEL", "6"))
+OUTPUT_QUALITY = int(os.environ.get("PRUNEJUICE_OUTPUT_QUALITY", "90"))
+OUTPUT_WORKERS = int(os.environ.get("PRUNEJUICE_OUTPUT_WORKERS", "2"))
+# Encoded images kept in memory for /images/{id} and binary responses (0 disables the store).
+RESULT_STORE_MB = int(os.environ.get("PRUNEJUICE_RESULT_STORE_MB", "256"))
+RESULT_TTL_SECONDS = float(os.environ.get("PRUNEJUICE_RESULT_TTL_SECONDS", "300"))
+# "0" keeps images in memory only (zero-disk mode; needs the result store).
+PERSIST_OUTPUTS = os.environ.get("PRUNEJUICE_PERSIST_OUTPUTS", "1") != "0"
+# Memory-map model weights instead of deserializing them ("0" uses from_pretrained), and tensor reader threads.
+MMAP_LOAD = os.environ.get("PRUNEJUICE_MMAP_LOAD", "1") != "0"
+LOAD_WORKERS = int(os.environ.get("PRUNEJUICE_LOAD_WORKERS", "8"))
+# Compiled UNet/VAE decoder for "WIDTHxHEIGHT[xBATCH],..." shape buckets ("" disables), artifacts cached on disk.
+COMPILE_BUCKETS = parse_buckets(os.environ.get("PRUNEJUICE_COMPILE_BUCKETS", ""))
+COMPILE_CACHE_DIR = os.environ.get("PRUNEJUICE_COMPILE_CACHE_DIR") or None
+COMPILE_BACKEND = os.environ.get("PRUNEJUICE_COMPILE_BACKEND", "inductor")
+# "1" generates at the nearest bucket resolution instead of the requested one.
+COMPILE_SNAP = os.environ.get("PRUNEJUICE_COMPILE_SNAP", "0") == "1"
+# Model ids run on ONNX Runtime from their <model dir>/onnx export ("*" for every exported model), and its providers.
+ONNX_MODELS = [m.strip() for m in os.environ.get("PRUNEJUICE_ONNX_MODELS", "").split(",") if m.strip()]
+ONNX_PROVIDERS = [p.strip() for p in os.environ.get("PRUNEJUICE_ONNX_PROVIDERS", "").split(",") if p.strip()] or None
 
 # Initialize App and Security
 app = FastAPI(title="Prunejuice AI Backend")
@@ -33,7 +91,19 @@ async def get_token_header(api_key: str = Depends(api_key_header)):
         status_code=HTTP_403_FORBIDDEN, detail="Invalid or missing Bridge Token"
     )
 
-connector = FooocusConnector()
+result_store = ResultStore(RESULT_STORE_MB * 1024**2, RESULT_TTL_SECONDS) if RESULT_STORE_MB > 0 else None
+connector = FooocusConnector(embedding_cache_mb=EMBED_CACHE_MB, vram_budget_gb=VRAM_BUDGET_GB, ram_budget_gb=RAM_BUDGET_GB,
+                             instrument=INSTRUMENT, profile_request=PROFILE_REQUEST, trace_dir=TRACE_DIR,
+                             output_format=OUTPUT_FORMAT, compress_level=PNG_COMPRESS_LEVEL,
+                             output_quality=OUTPUT_QUALITY, output_workers=OUTPUT_WORKERS,
+                             result_store=result_store, persist_outputs=PERSIST_OUTPUTS,
+                             mapped_loading=MMAP_LOAD, load_workers=LOAD_WORKERS,
+                             compile_buckets=COMPILE_BUCKETS, compile_cache_dir=COMPILE_CACHE_DIR,
+                             compile_backend=COMPILE_BACKEND, compile_snap=COMPILE_SNAP,
+                             onnx_models=ONNX_MODELS, onnx_providers=ONNX_PROVIDERS)
+connector.warmup_resolutions = WARMUP_RESOLUTIONS
+connector.warmup_steps = WARMUP_STEPS
+batcher = MicroBatcher(connector, BATCH_WINDOW_MS, MAX_BATCH_SIZE) if BATCH_WINDOW_MS > 0 else None
 
 class GenerateRequest(BaseModel):
     prompt: str
@@ -44,6 +114,11 @@ class GenerateRequest(BaseModel):
     guidance_scale: float = 7.5
     seed: Optional[int] = None
     style: Optional[str] = None
+    # "json" (default), "binary" (the image bytes) or "multipart" (JSON part + image part)
+    response_format: str = "json"
+
+class JobRequest(GenerateRequest):
+    priority: str = "interactive"
 
 class ModelSwitchRequest(BaseModel):
     model_id: str
@@ -68,65 +143,259 @@ def health_check():
         },
         "model": {
             "current": connector.current_model_id,
-            "loaded": connector.pipe is not None
+            "loaded": connector.pipe is not None,
+            "backend": connector.backend(),
+            "readiness": connector.state,
+            "resident": connector.residency.stats()
+        },
+        "vram_plan": connector.vram_manager.last_plan,
+        "memory_hygiene": connector.vram_manager.hygiene_stats(),
+        "oom_fallbacks": [
+            {"model": model, "width": w, "height": h, **fallback}
+            for (model, w, h), fallback in list(connector.oom_fallbacks.items())
+        ],
+        "embedding_cache": connector.embedding_cache.stats(),
+        "output_writer": connector.output_writer.stats(),
+        "compiled": connector.compiler.stats() if connector.compiler is not None else None,
+        "result_store": result_store.stats() if result_store is not None else None,
+        "jobs": {
+            "queued": job_queue.queued_count(),
+            "running": len(job_queue.current)
         }
     }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus text exposition: generation and per-stage latency / peak memory histograms."""
+    return PlainTextResponse(connector.instrumentation.render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/ready")
+def readiness_check():
+    """Load balancer probe: 503 while a model is loading or warming up, or after a failed load."""
+    if connector.state in ("loading", "warming", "error"):
+        raise HTTPException(status_code=503, detail={"error_code": "NOT_READY", "readiness": connector.state})
+    return {"readiness": connector.state}
+
 @app.post("/recover")
 def recover_gpu(token: str = Depends(get_token_header)):
     """Force clears CUDA cache to recover from OOM or fragmentation."""
     if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-        import gc
-        gc.collect()
-        return {"status": "recovered", "freed": True}
+        reclaimed = connector.vram_manager.cleanup("manual")
+        return {"status": "recovered", "freed": True, "reclaimed_bytes": reclaimed}
     return {"status": "skipped", "freed": False}
 
 @app.get("/styles")
 def get_styles():
     return list_presets()
 
+def resolve_params(req: GenerateRequest):
+    """Apply the request's style preset and map it onto FooocusConnector.generate arguments."""
+    p_prompt = req.prompt
+    p_neg = req.negative_prompt
+    p_steps = req.num_inference_steps
+    p_guidance = req.guidance_scale
+
+    if req.style:
+        preset = get_preset(req.style)
+        if preset:
+            p_prompt += preset.get("prompt_suffix", "")
+            p_neg = preset.get("negative_prompt", "") + " " + p_neg
+            p_steps = preset.get("steps", p_steps)
+            p_guidance = preset.get("guidance", p_guidance)
+
+    return {
+        "prompt": p_prompt,
+        "negative_prompt": p_neg,
+        "width": req.width,
+        "height": req.height,
+        "steps": p_steps,
+        "guidance": p_guidance,
+        "seed": req.seed
+    }
+
+def inference_error(e: Exception):
+    """Map a generation failure onto the HTTP error returned to clients."""
+    if is_out_of_memory(e):
+        # The connector already retried with every cheaper setting and flushed the allocator
+        return HTTPException(
+            status_code=507,
+            detail={
+                "error_code": "CUDA_OOM",
+                "message": "Ran out of memory even with the cheapest settings. Try reducing resolution or closing other apps.",
+                "details": str(e)
+            }
+        )
+    if isinstance(e, RuntimeError):
+        return HTTPException(status_code=500, detail={"error_code": "INFERENCE_ERROR", "message": str(e)})
+    return HTTPException(status_code=500, detail={"error_code": "INTERNAL_ERROR", "message": str(e)})
+
+def stored_image(image_id):
+    entry = result_store.get(image_id) if result_store is not None and image_id else None
+    if entry is None:
+        raise HTTPException(status_code=404, detail={
+            "error_code": "IMAGE_NOT_FOUND",
+            "message": "Unknown or expired image id (results are kept for PRUNEJUICE_RESULT_TTL_SECONDS)"
+        })
+    return entry
+
+def check_response_format(response_format):
+    """Reject a response format that cannot be served, before any generation runs."""
+    if response_format not in ("json", "binary", "multipart"):
+        raise HTTPException(status_code=422, detail={
+            "error_code": "INVALID_RESPONSE_FORMAT",
+            "message": f"response_format must be json, binary or multipart, not {response_format!r}"
+        })
+    if response_format != "json" and result_store is None:
+        raise HTTPException(status_code=422, detail={
+            "error_code": "INVALID_RESPONSE_FORMAT",
+            "message": f"response_format {response_format!r} needs the result store (PRUNEJUICE_RESULT_STORE_MB > 0)"
+        })
+
+def image_response(result, response_format):
+    """
+    A generation result as JSON, as the raw image bytes (metadata in the
+    X-Prunejuice-Metadata header), or as multipart/mixed with a JSON part
+    followed by the image part. The bytes come from the result store.
+    """
+    if response_format == "json":
+        return result
+    data, media_type = stored_image(result.get("image_id"))
+    info = json.dumps(result)
+    if response_format == "binary":
+        return Response(content=data, media_type=media_type,
+                        headers={"X-Image-Id": result["image_id"], "X-Prunejuice-Metadata": info})
+    boundary = uuid.uuid4().hex
+    body = b"".join([
+        f"--{boundary}\r\nContent-Type: application/json\r\n\r\n{info}\r\n".encode(),
+        f"--{boundary}\r\nContent-Type: {media_type}\r\nContent-ID: <{result['image_id']}>\r\n\r\n".encode(),
+        data,
+        f"\r\n--{boundary}--\r\n".encode(),
+    ])
+    return Response(content=body, media_type=f"multipart/mixed; boundary={boundary}")
+
 @app.post("/generate")
 def generate(req: GenerateRequest, token: str = Depends(get_token_header)):
+    check_response_format(req.response_format)
     try:
-        # Apply style if present
-        p_prompt = req.prompt
-        p_neg = req.negative_prompt
-        p_steps = req.num_inference_steps
-        p_guidance = req.guidance_scale
-        
-        if req.style:
-            preset = get_preset(req.style)
-            if preset:
-                p_prompt += preset.get("prompt_suffix", "")
-                p_neg = preset.get("negative_prompt", "") + " " + p_neg
-                p_steps = preset.get("steps", p_steps)
-                p_guidance = preset.get("guidance", p_guidance)
-
-        result = connector.generate(
-            prompt=p_prompt,
-            negative_prompt=p_neg,
-            width=req.width,
-            height=req.height,
-            steps=p_steps,
-            guidance=p_guidance,
-            seed=req.seed
-        )
-        return result
-    except RuntimeError as e:
-        if "out of memory" in str(e).lower():
-            torch.cuda.empty_cache()
-            raise HTTPException(
-                status_code=507, 
-                detail={
-                    "error_code": "CUDA_OOM",
-                    "message": "GPU ran out of memory. Try reducing resolution or closing other apps.",
-                    "details": str(e)
-                }
-            )
-        raise HTTPException(status_code=500, detail={"error_code": "INFERENCE_ERROR", "message": str(e)})
+        run = batcher.submit if batcher is not None else connector.generate
+        result = run(**resolve_params(req))
     except Exception as e:
-        raise HTTPException(status_code=500, detail={"error_code": "INTERNAL_ERROR", "message": str(e)})
+        raise inference_error(e)
+    return image_response(result, req.response_format)
+
+@app.get("/images/{image_id}")
+def get_image(image_id: str, token: str = Depends(get_token_header)):
+    """Encoded image bytes from the in-memory result store."""
+    data, media_type = stored_image(image_id)
+    return Response(content=data, media_type=media_type)
+
+# --- Job queue: submit returns immediately, a dedicated GPU worker runs the jobs ---
+
+def run_job_batch(jobs):
+    # Per-step progress goes to each job's event stream
+    on_progress = [lambda event, job=job: job_queue.report_progress(job, event) for job in jobs]
+    cancel_tokens = [job.cancel_token for job in jobs]
+    if len(jobs) == 1:
+        return [connector.generate(**jobs[0].params, cancel_token=cancel_tokens[0], on_progress=on_progress[0],
+                                   wait_for_output=False)]
+    head = jobs[0].params
+    return connector.generate(
+        prompt=[job.params["prompt"] for job in jobs],
+        negative_prompt=[job.params["negative_prompt"] for job in jobs],
+        width=head["width"],
+        height=head["height"],
+        steps=head["steps"],
+        guidance=head["guidance"],
+        seed=[job.params["seed"] for job in jobs],
+        cancel_token=cancel_tokens,
+        on_progress=on_progress,
+        wait_for_output=False
+    )
+
+job_queue = JobQueue(
+    run_job_batch,
+    batch_key=lambda p: batch_key(connector.current_model_id, p["width"], p["height"], p["steps"], p["guidance"]),
+    max_queued=MAX_QUEUED_JOBS,
+    max_batch_size=lambda p: connector.vram_manager.max_batch_size(p["width"], p["height"], MAX_BATCH_SIZE,
+                                                                  pipe=connector.pipe)
+)
+
+@app.on_event("startup")
+async def start_background_services():
+    job_queue.start()
+    if PRELOAD_MODEL:
+        connector.start_preload(PRELOAD_MODEL)
+
+@app.on_event("shutdown")
+async def stop_background_services():
+    await job_queue.stop()
+    connector.output_writer.close()
+
+def job_status(job):
+    status = job.to_dict()
+    status["position"] = job_queue.position(job)
+    if job.error is not None:
+        status["error"] = inference_error(job.error).detail
+    return status
+
+def get_job_or_404(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail={"error_code": "JOB_NOT_FOUND", "message": "Job ID does not exist"})
+    return job
+
+@app.post("/jobs", status_code=202)
+async def submit_job(req: JobRequest, token: str = Depends(get_token_header)):
+    try:
+        job = job_queue.submit(resolve_params(req), req.priority)
+    except QueueFull as e:
+        raise HTTPException(status_code=429, detail={"error_code": "QUEUE_FULL", "message": str(e)})
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail={"error_code": "INVALID_PRIORITY", "message": str(e)})
+    return job_status(job)
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, token: str = Depends(get_token_header)):
+    return job_status(get_job_or_404(job_id))
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, format: str = "json", token: str = Depends(get_token_header)):
+    check_response_format(format)
+    job = get_job_or_404(job_id)
+    if job.status == "completed":
+        return image_response(job.result, format)
+    if job.status == "failed":
+        raise inference_error(job.error)
+    if job.status == "cancelled":
+        raise HTTPException(status_code=410, detail={"error_code": "JOB_CANCELLED", "message": "Job was cancelled"})
+    raise HTTPException(status_code=409, detail={"error_code": "JOB_NOT_FINISHED", "message": f"Job is {job.status}"})
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, token: str = Depends(get_token_header)):
+    """Server-Sent Events stream of a job's status changes and per-step progress."""
+    job = get_job_or_404(job_id)
+    events = job_queue.events.subscribe(job.id)
+
+    async def event_stream():
+        try:
+            # Subscribed before taking the snapshot, so no transition is missed
+            yield f"data: {json.dumps(job_status(job))}\n\n"
+            if job.finished_at is not None:
+                return
+            while True:
+                event = await events.get()
+                yield f"data: {json.dumps(event)}\n\n"
+                if event["event"] in ("completed", "failed", "cancelled"):
+                    return
+        finally:
+            job_queue.events.unsubscribe(job.id, events)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, token: str = Depends(get_token_header)):
+    job = job_queue.cancel(get_job_or_404(job_id).id)
+    return job_status(job)
 
 @app.get("/models")
 def get_models():
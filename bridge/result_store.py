@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultStore:
+    """
+    Encoded output images kept in memory for a while, so clients can fetch
+    the bytes from the server instead of reading `outputs/` from disk.
+
+    Entries expire `ttl_seconds` after they were stored; when the byte budget
+    is exceeded the oldest entries are evicted first.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024**2, ttl_seconds: float = 300):
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.entries = OrderedDict()  # image id -> (data, media type, expires at)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        # All entries share one TTL, so insertion order is expiry order
+        while self.entries:
+            key, (data, _, expires) = next(iter(self.entries.items()))
+            if expires > now:
+                break
+            del self.entries[key]
+            self.current_bytes -= len(data)
+            self.expirations += 1
+
+    def put(self, image_id, data, media_type):
+        """Store `data`; returns False if it alone exceeds the byte budget."""
+        data = bytes(data)
+        if len(data) > self.max_bytes:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+            if image_id in self.entries:
+                self.current_bytes -= len(self.entries.pop(image_id)[0])
+            self.entries[image_id] = (data, media_type, now + self.ttl)
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes:
+                _, (evicted, _, _) = self.entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+                self.evictions += 1
+        return True
+
+    def get(self, image_id):
+        """(data, media type), or None if unknown, expired or evicted."""
+        with self.lock:
+            self._expire(time.monotonic())
+            entry = self.entries.get(image_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def stats(self):
+        with self.lock:
+            self._expire(time.monotonic())
+            return {
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -0,0 +1,125 @@
+import copy
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from optimization.schedulers import SCHEDULER_FAMILIES
+
+# Step counts used by the presets and Lightning checkpoints
+COMMON_STEPS = (4, 6, 8, 20, 25, 30)
+
+
+def scheduler_family(steps):
+    """Scheduler used for a given step count (few-step Lightning/Turbo vs quality)."""
+    return "EulerAncestral" if steps <= 8 else "DPMSolverMultistep"
+
+
+def _normalize_device(device):
+    device = torch.device(device if device is not None else "cpu")
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    return device
+
+
+def _copy_state(state):
+    # Lists/dicts (e.g. DPM-Solver's model_outputs) are mutated in place while
+    # stepping, tensors are only ever reassigned, so a shallow copy is enough.
+    return {k: copy.copy(v) if isinstance(v, (list, dict)) else v for k, v in state.items()}
+
+
+class SchedulerPool:
+    """
+    Per-model pool of prebuilt schedulers.
+
+    Each request checks out its own scheduler instance, so concurrent or
+    batched generations never share mutable scheduler state. `set_timesteps`
+    results are cached per (family, options, steps, device), so a checked-out
+    scheduler is reset from a precomputed table instead of recomputing its
+    sigma/timestep schedule.
+    """
+
+    def __init__(self, base_config, device=None, max_idle: int = 4, warm_steps=COMMON_STEPS):
+        """
+        Args:
+            base_config: Scheduler config of the loaded model
+            device: Device the pipeline runs the denoising loop on
+            max_idle: Idle instances kept per (family, options)
+            warm_steps: Step counts whose tables are precomputed up front
+        """
+        self.base_config = base_config
+        self.max_idle = max_idle
+        self.idle = {}
+        self.tables = {}
+        self.lock = threading.Lock()
+
+        for steps in warm_steps:
+            family = scheduler_family(steps)
+            with self.checkout(family) as scheduler:
+                scheduler.set_timesteps(steps, device=device)
+
+    @staticmethod
+    def _key(family, options):
+        return (family, tuple(sorted(options.items())))
+
+    def _build(self, key):
+        family, options = key
+        scheduler_cls, defaults = SCHEDULER_FAMILIES[family]
+        scheduler = scheduler_cls.from_config(self.base_config, **{**defaults, **dict(options)})
+        # Instance attribute shadows the class method so the pipeline's own
+        # set_timesteps call goes through the table.
+        scheduler.set_timesteps = lambda *args, **kwargs: self._set_timesteps(scheduler, key, *args, **kwargs)
+        return scheduler
+
+    def _set_timesteps(self, scheduler, key, num_inference_steps=None, device=None, **kwargs):
+        if kwargs or num_inference_steps is None:
+            # Custom timesteps/sigmas are not worth caching
+            return type(scheduler).set_timesteps(scheduler, num_inference_steps, device=device, **kwargs)
+
+        table_key = (key, num_inference_steps, _normalize_device(device))
+        with self.lock:
+            state = self.tables.get(table_key)
+
+        if state is None:
+            type(scheduler).set_timesteps(scheduler, num_inference_steps, device=device)
+            state = {k: v for k, v in vars(scheduler).items() if k != "set_timesteps"}
+            with self.lock:
+                self.tables[table_key] = _copy_state(state)
+            return
+
+        # Drop anything the previous run added while stepping, then restore
+        hook = scheduler.set_timesteps
+        scheduler.__dict__.clear()
+        scheduler.__dict__.update(_copy_state(state))
+        scheduler.set_timesteps = hook
+
+    @contextmanager
+    def checkout(self, family, **options):
+        """
+        Borrow a scheduler for the duration of one generation.
+        """
+        key = self._key(family, options)
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            scheduler = idle.pop() if idle else None
+        if scheduler is None:
+            scheduler = self._build(key)
+
+        try:
+            yield scheduler
+        finally:
+            with self.lock:
+                idle = self.idle.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(scheduler)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "idle": sum(len(v) for v in self.idle.values()),
+                "tables": len(self.tables),
+            }
@@ -0,0 +1,375 @@
+import gc
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional, Sequence
+
+import psutil
+import torch
+from diffusers import (AutoencoderKL, EulerDiscreteScheduler, StableDiffusionXLPipeline,
+                       UNet2DConditionModel)
+from diffusers.models.attention_processor import AttnProcessor, AttnProcessor2_0
+
+# Allow running as a script from anywhere
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from optimization.schedulers import SCHEDULER_FAMILIES
+
+SCHEDULERS = {"Euler": (EulerDiscreteScheduler, {}), **SCHEDULER_FAMILIES}
+
+# Optimization toggles; a configuration combines any of them, e.g. "vae_slicing+vae_tiling"
+OPTIMIZATIONS = ("attention_slicing", "vae_slicing", "vae_tiling", "cpu_offload",
+                 "attn_sdpa", "attn_eager", "attn_xformers")
+
+# Metric -> whether larger is better, for baseline comparison
+METRICS = {"latency_p50": False, "latency_p95": False, "its": True, "peak_ram_mb": False, "peak_vram_mb": False}
+
+
+def build_tiny_pipeline(seed: int = 0) -> StableDiffusionXLPipeline:
+    """
+    Randomly initialized SDXL-shaped pipeline (two UNet levels, text-time
+    conditioning, two CLIP encoders, 4-channel VAE) small enough to benchmark
+    on CPU in seconds. Needs no downloads: the tokenizer is a byte-level
+    vocabulary built in a temporary directory that is removed again.
+    """
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64), layers_per_block=2, sample_size=32, in_channels=4, out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4), use_linear_projection=True, addition_embed_type="text_time",
+        addition_time_embed_dim=8, transformer_layers_per_block=(1, 2), projection_class_embeddings_input_dim=80,
+        cross_attention_dim=64, norm_num_groups=32,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64], in_channels=3, out_channels=3, latent_channels=4, sample_size=128,
+        down_block_types=["DownEncoderBlock2D"] * 2, up_block_types=["UpDecoderBlock2D"] * 2,
+    )
+    config = CLIPTextConfig(bos_token_id=0, eos_token_id=2, hidden_size=32, intermediate_size=37, layer_norm_eps=1e-05,
+                            num_attention_heads=4, num_hidden_layers=5, pad_token_id=1, vocab_size=1000,
+                            hidden_act="gelu", projection_dim=32)
+
+    chars = list(bytes_to_unicode().values())
+    vocab = {c: i for i, c in enumerate(chars)}
+    for c in chars:
+        vocab.setdefault(c + "</w>", len(vocab))
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+    # CLIPTokenizer reads both files in its constructor, so the directory can go right after
+    with tempfile.TemporaryDirectory(prefix="prunejuice-tokenizer-") as vocab_dir:
+        with open(os.path.join(vocab_dir, "vocab.json"), "w") as f:
+            json.dump(vocab, f)
+        with open(os.path.join(vocab_dir, "merges.txt"), "w") as f:
+            f.write("#version: 0.2\n")
+        tokenizer = CLIPTokenizer(os.path.join(vocab_dir, "vocab.json"), os.path.join(vocab_dir, "merges.txt"),
+                                  model_max_length=77)
+
+    scheduler = EulerDiscreteScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+                                       steps_offset=1, timestep_spacing="leading")
+    return StableDiffusionXLPipeline(
+        vae=vae, text_encoder=CLIPTextModel(config), text_encoder_2=CLIPTextModelWithProjection(config),
+        tokenizer=tokenizer, tokenizer_2=tokenizer, unet=unet, scheduler=scheduler,
+    )
+
+
+class PeakMemorySampler:
+    """
+    Samples process RSS on a background thread. `peak` is the maximum seen
+    inside the `with` block and `growth` its excess over the RSS on entry:
+    RSS rarely shrinks once freed memory is cached by the allocator, so only
+    the growth is comparable between configurations run in one process.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.start = 0
+        self.peak = 0
+        self._stop = threading.Event()
+
+    @property
+    def growth(self) -> int:
+        return self.peak - self.start
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start = self.peak = self.process.memory_info().rss
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Linearly interpolated percentile, q in [0, 100]."""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def environment(device: torch.device) -> dict:
+    import diffusers
+    info = {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "diffusers": diffusers.__version__,
+        "platform": platform.platform(),
+        "cpu": platform.processor() or platform.machine(),
+        "threads": torch.get_num_threads(),
+        "device": str(device),
+    }
+    if device.type == "cuda":
+        info["gpu"] = torch.cuda.get_device_name(device)
+    return info
+
+
+def _unsupported(optimizations: Iterable[str], device: torch.device) -> Optional[str]:
+    for name in optimizations:
+        if name not in OPTIMIZATIONS:
+            raise ValueError(f"Unknown optimization '{name}'; expected one of {OPTIMIZATIONS}")
+    if "cpu_offload" in optimizations and device.type != "cuda":
+        return "cpu_offload needs a CUDA device"
+    if "attn_xformers" in optimizations:
+        try:
+            import xformers  # noqa: F401
+        except ImportError:
+            return "xformers not installed"
+    if sum(name.startswith("attn_") for name in optimizations) > 1:
+        return "more than one attention backend"
+    return None
+
+
+def configure(pipe: StableDiffusionXLPipeline, device: torch.device, scheduler: str, optimizations: Iterable[str]):
+    """Reset the pipeline to a known state, then apply one scheduler and set of optimization toggles."""
+    if not hasattr(pipe, "_benchmark_scheduler_config"):
+        pipe._benchmark_scheduler_config = pipe.scheduler.config
+    scheduler_cls, options = SCHEDULERS[scheduler]
+    pipe.scheduler = scheduler_cls.from_config(pipe._benchmark_scheduler_config, **options)
+
+    pipe.set_progress_bar_config(disable=True)
+    pipe.remove_all_hooks()
+    pipe.to(device)
+    pipe.disable_attention_slicing()
+    pipe.vae.disable_slicing()
+    pipe.vae.disable_tiling()
+    pipe.unet.set_attn_processor(AttnProcessor2_0())
+    pipe.vae.set_attn_processor(AttnProcessor2_0())
+
+    if "attn_eager" in optimizations:
+        pipe.unet.set_attn_processor(AttnProcessor())
+        pipe.vae.set_attn_processor(AttnProcessor())
+    if "attn_xformers" in optimizations:
+        pipe.enable_xformers_memory_efficient_attention()
+    if "attention_slicing" in optimizations:
+        pipe.enable_attention_slicing()
+    if "vae_slicing" in optimizations:
+        pipe.vae.enable_slicing()
+    if "vae_tiling" in optimizations:
+        pipe.vae.enable_tiling()
+    if "cpu_offload" in optimizations:
+        pipe.enable_model_cpu_offload(device=device)
+
+
+@contextmanager
+def preserved_state(pipe: StableDiffusionXLPipeline):
+    """
+    Undo what `configure` changes (scheduler, attention processors, VAE
+    slicing/tiling, progress bar, model CPU offload hooks) on exit, for
+    benchmarking a pipeline that is used or saved afterwards.
+    """
+    scheduler = pipe.scheduler
+    processors = {name: dict(getattr(pipe, name).attn_processors) for name in ("unet", "vae")}
+    vae_flags = (pipe.vae.use_slicing, pipe.vae.use_tiling)
+    progress = dict(getattr(pipe, "_progress_bar_config", {}))
+    offload_device = getattr(pipe, "_offload_device", None) if getattr(pipe, "_all_hooks", None) else None
+    try:
+        yield pipe
+    finally:
+        pipe.remove_all_hooks()
+        pipe.scheduler = scheduler
+        for name, original in processors.items():
+            getattr(pipe, name).set_attn_processor(original)
+        pipe.vae.use_slicing, pipe.vae.use_tiling = vae_flags
+        pipe._progress_bar_config = progress
+        if offload_device is not None:
+            pipe.enable_model_cpu_offload(device=offload_device)
+
+
+def config_key(config: dict) -> str:
+    return (f"{config['resolution']}px/{config['steps']}steps/{config['scheduler']}/bs{config['batch_size']}/"
+            f"{'+'.join(config['optimizations']) or 'baseline'}")
+
+
+def _synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+@torch.no_grad()
+def benchmark_config(pipe: StableDiffusionXLPipeline, device="cpu", resolution: int = 1024, steps: int = 20,
+                     scheduler: str = "Euler", batch_size: int = 1, optimizations: Iterable[str] = (),
+                     warmup: int = 1, trials: int = 5, prompt: str = "benchmark prompt") -> dict:
+    """
+    Time one configuration: `warmup` untimed runs, then `trials` timed runs.
+
+    Returns:
+        {"key", "config", "latency_p50", "latency_p95", "latency_mean" (seconds),
+         "its" (denoising steps per second), "peak_ram_mb" (RSS growth over the start of this
+         configuration), "peak_vram_mb" (peak allocated)} or {"key", "config", "skipped": reason}
+    """
+    device = torch.device(device)
+    optimizations = sorted(optimizations)
+    config = {"resolution": resolution, "steps": steps, "scheduler": scheduler, "batch_size": batch_size,
+              "optimizations": optimizations}
+    result = {"key": config_key(config), "config": config}
+    reason = _unsupported(optimizations, device)
+    if reason:
+        return dict(result, skipped=reason)
+
+    configure(pipe, device, scheduler, optimizations)
+    step_times = []
+
+    def record_step(_pipe, _step, _timestep, callback_kwargs):
+        _synchronize(device)
+        step_times.append(time.perf_counter())
+        return callback_kwargs
+
+    def run(seed):
+        pipe(prompt=[prompt] * batch_size, num_inference_steps=steps, height=resolution, width=resolution,
+             generator=torch.Generator(device="cpu").manual_seed(seed), callback_on_step_end=record_step,
+             output_type="pil")
+
+    latencies, its = [], []
+    gc.collect()
+    # RSS is measured from here, so warm-up allocations count but earlier configurations' do not
+    with PeakMemorySampler() as memory:
+        for i in range(warmup):
+            run(i)
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(device)
+        for i in range(trials):
+            step_times.clear()
+            _synchronize(device)
+            start = time.perf_counter()
+            run(warmup + i)
+            _synchronize(device)
+            latencies.append(time.perf_counter() - start)
+            # Steady-state denoising rate: the first step also pays for text encoding
+            if len(step_times) > 1:
+                its.append((len(step_times) - 1) / (step_times[-1] - step_times[0]))
+            else:
+                its.append(len(step_times) / (step_times[-1] - start))
+
+    return dict(
+        result,
+        latency_p50=percentile(latencies, 50),
+        latency_p95=percentile(latencies, 95),
+        latency_mean=sum(latencies) / len(latencies),
+        its=percentile(its, 50),
+        peak_ram_mb=memory.growth / 1024 ** 2,
+        peak_vram_mb=torch.cuda.max_memory_allocated(device) / 1024 ** 2 if device.type == "cuda" else None,
+    )
+
+
+def benchmark_matrix(pipe: StableDiffusionXLPipeline, device="cpu", resolutions: Sequence[int] = (1024,),
+                     steps: Sequence[int] = (20,), schedulers: Sequence[str] = ("Euler",),
+                     batch_sizes: Sequence[int] = (1,), optimizations: Sequence[Sequence[str]] = ((),),
+                     warmup: int = 1, trials: int = 5) -> dict:
+    """
+    Benchmark every combination of the given axes. `optimizations` lists toggle
+    sets, e.g. [(), ("vae_tiling",), ("attention_slicing", "vae_slicing")].
+    """
+    device = torch.device(device)
+    results = []
+    matrix = list(itertools.product(resolutions, steps, schedulers, batch_sizes, optimizations))
+    for n, (resolution, n_steps, scheduler, batch_size, toggles) in enumerate(matrix, 1):
+        result = benchmark_config(pipe, device, resolution, n_steps, scheduler, batch_size, toggles, warmup, trials)
+        results.append(result)
+        if "skipped" in result:
+            print(f"[{n}/{len(matrix)}] {result['key']}: skipped ({result['skipped']})")
+        else:
+            print(f"[{n}/{len(matrix)}] {result['key']}: p50 {result['latency_p50']:.3f}s "
+                  f"p95 {result['latency_p95']:.3f}s {result['its']:.2f} it/s RAM {result['peak_ram_mb']:.0f}MB"
+                  + (f" VRAM {result['peak_vram_mb']:.0f}MB" if result["peak_vram_mb"] is not None else ""))
+    return {"environment": environment(device), "warmup": warmup, "trials": trials, "results": results}
+
+
+def compare_to_baseline(current: dict, baseline: dict, tolerance: float = 0.10,
+                        memory_tolerance: Optional[float] = None) -> dict:
+    """
+    Diff two benchmark_matrix() results by configuration key.
+
+    Args:
+        tolerance: Relative change in latency / it/s treated as noise
+        memory_tolerance: Same for peak RAM / VRAM (defaults to `tolerance`)
+
+    Returns:
+        {"regressions", "improvements": [{"key", "metric", "baseline", "current", "change"}],
+         "missing": keys only in the baseline, "new": keys only in the current run,
+         "environment_changed": whether the runs came from different setups}
+    """
+    memory_tolerance = tolerance if memory_tolerance is None else memory_tolerance
+    base = {r["key"]: r for r in baseline["results"] if "skipped" not in r}
+    now = {r["key"]: r for r in current["results"] if "skipped" not in r}
+    diff = {"regressions": [], "improvements": [], "missing": sorted(set(base) - set(now)),
+            "new": sorted(set(now) - set(base)),
+            "environment_changed": current.get("environment") != baseline.get("environment")}
+    for key in sorted(set(base) & set(now)):
+        for metric, higher_is_better in METRICS.items():
+            old, new = base[key].get(metric), now[key].get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            limit = memory_tolerance if metric.startswith("peak_") else tolerance
+            worse = -change if higher_is_better else change
+            entry = {"key": key, "metric": metric, "baseline": old, "current": new, "change": change}
+            if worse > limit:
+                diff["regressions"].append(entry)
+            elif worse < -limit:
+                diff["improvements"].append(entry)
+    return diff
+
+
+def summarize_diff(diff: dict) -> str:
+    lines = []
+    if diff["environment_changed"]:
+        lines.append("Note: baseline was recorded on a different environment; timings may not be comparable.")
+    for title, entries in (("Regressions", diff["regressions"]), ("Improvements", diff["improvements"])):
+        lines.append(f"{title}: {len(entries)}")
+        for e in entries:
+            lines.append(f"  {e['key']} {e['metric']}: {e['baseline']:.4g} -> {e['current']:.4g} ({e['change']:+.1%})")
+    if diff["missing"]:
+        lines.append(f"{len(diff['missing'])} baseline configurations not run (e.g. {diff['missing'][0]})")
+    if diff["new"]:
+        lines.append(f"{len(diff['new'])} configurations not in the baseline (e.g. {diff['new'][0]})")
+    return "\n".join(lines)
+
+
+def save_results(results: dict, path: str):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,268 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+import torch
+
+from optimization.vram_manager import is_out_of_memory
+
+# Image pixels per latent pixel (SDXL VAE), unless the pipeline reports its own vae_scale_factor
+VAE_SCALE = 8
+# Modules compiled per pipeline, and the attribute path to each
+COMPILED_MODULES = {"unet": ("unet",), "vae_decoder": ("vae", "decoder")}
+# Portable compiler cache artifacts (torch >= 2.6); older versions compile on every start
+PERSISTENT_CACHE = hasattr(torch.compiler, "save_cache_artifacts") and hasattr(torch.compiler, "load_cache_artifacts")
+
+
+def parse_buckets(spec):
+    """
+    Shape buckets from "WIDTHxHEIGHT[xBATCH],..." (batch defaults to 1),
+    e.g. "1024x1024x1,1024x1024x4,832x1216".
+    """
+    buckets = []
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        values = [int(v) for v in item.lower().strip().split("x")]
+        if len(values) not in (2, 3):
+            raise ValueError(f"Invalid compile bucket {item!r} (expected WIDTHxHEIGHT[xBATCH])")
+        buckets.append((values[0], values[1], values[2] if len(values) == 3 else 1))
+    return buckets
+
+
+def module_fingerprint(module):
+    """
+    Hash of a module's architecture: class, config and every parameter and
+    buffer name, shape and dtype. Weights are inputs of the compiled graphs,
+    not constants baked into them, so this is what compiled artifacts depend
+    on; fine-tunes of one base model share them.
+    """
+    digest = hashlib.sha256(type(module).__qualname__.encode())
+    config = getattr(module, "config", None)
+    if config is not None:
+        # Private keys (_name_or_path, _use_default_values) vary between loads of the same model
+        public = {k: v for k, v in dict(config).items() if not k.startswith("_")}
+        digest.update(json.dumps(public, sort_keys=True, default=str).encode())
+    for name, tensor in list(module.named_parameters()) + list(module.named_buffers()):
+        digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+    return digest.hexdigest()
+
+
+def _fresh_artifacts():
+    """Record the cache artifacts of the next compilation on their own (torch >= 2.7)."""
+    try:
+        from torch.compiler._cache import CacheArtifactManager
+        return CacheArtifactManager.with_fresh_cache()
+    except (ImportError, AttributeError):
+        return nullcontext()
+
+
+def _pad(value, batch, target):
+    """Repeat the last row of every batch-sized tensor (including inside dicts) up to `target` rows."""
+    if isinstance(value, torch.Tensor) and value.dim() and value.shape[0] == batch:
+        return torch.cat([value, value[-1:].expand(target - batch, *value.shape[1:])])
+    if isinstance(value, dict):
+        return {k: _pad(v, batch, target) for k, v in value.items()}
+    return value
+
+
+def _unpad(output, batch):
+    if isinstance(output, torch.Tensor):
+        return output[:batch]
+    if isinstance(output, tuple):
+        return tuple(_unpad(o, batch) for o in output)
+    if hasattr(output, "sample"):  # UNet2DConditionOutput / DecoderOutput
+        output.sample = output.sample[:batch]
+    return output
+
+
+def _sequential_offload(module):
+    """True when accelerate hooks sit on the submodules, moving weights layer by layer."""
+    return any(hasattr(child, "_hf_hook") for child in module.children())
+
+
+class ShapeBucketCompiler:
+    """
+    Compiled UNet and VAE decoder for a fixed set of (width, height, batch)
+    shape buckets.
+
+    Each module's forward is replaced by a router. Calls at a bucket's latent
+    size run the `torch.compile`d forward (static shapes, one graph per
+    bucket); smaller batches are padded up to the nearest bucket batch and the
+    padding is sliced off the output. Anything else runs eagerly, so a request
+    outside the buckets never triggers a compile.
+
+    Compiled artifacts are saved under
+    `cache_dir/<model hash>/torch-<version>/<module>_b<batch>_<h>x<w>_<dtype>.bin`
+    right after a bucket's first compile, and loaded back when a pipeline
+    with the same architecture is attached, so a restart hits the compiler
+    cache instead of recompiling. Torch versions without cache artifacts
+    (before 2.6) still compile the buckets but persist nothing.
+    """
+
+    def __init__(self, buckets, cache_dir, backend="inductor", mode=None, snap=False):
+        """
+        Args:
+            buckets: (width, height, batch) tuples to compile for
+            cache_dir: Root directory of the compiled artifacts
+            backend: torch.compile backend ("inductor" works on CPU and CUDA)
+            mode: torch.compile mode, e.g. "max-autotune" (None for the default)
+            snap: Generate at the nearest bucket resolution instead of the requested one
+        """
+        self.buckets = sorted(set(buckets))
+        self.cache_dir = cache_dir
+        self.backend = backend
+        self.mode = mode
+        self.snap = snap
+        self.vae_scale = VAE_SCALE
+        if self.buckets and not PERSISTENT_CACHE:
+            print(f"torch {torch.__version__} has no portable compiler cache; buckets are recompiled on every start")
+        self.lock = threading.Lock()
+        self.failed = set()  # (module, shape) whose compile failed; they stay eager
+        self.counters = {"compiled_calls": 0, "padded_calls": 0, "eager_calls": 0, "compiles": 0,
+                         "compile_seconds": 0.0, "artifacts_loaded": 0, "artifacts_saved": 0}
+        # One graph per bucket shape, plus CFG doubling the UNet batch
+        limit = max(8, 4 * len(self.buckets))
+        if hasattr(torch._dynamo.config, "recompile_limit"):
+            torch._dynamo.config.recompile_limit = max(torch._dynamo.config.recompile_limit, limit)
+        else:
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, limit)
+
+    def shapes(self, kind):
+        """Compiled (batch, latent height, latent width) shapes of a module."""
+        shapes = set()
+        for width, height, batch in self.buckets:
+            # The UNet sees the batch twice under classifier-free guidance
+            for factor in ((1, 2) if kind == "unet" else (1,)):
+                shapes.add((batch * factor, height // self.vae_scale, width // self.vae_scale))
+        return shapes
+
+    def route(self, kind, sample):
+        """Compiled shape for a call with `sample` (padding the batch up), or None to run eagerly."""
+        batch, height, width = sample.shape[0], sample.shape[-2], sample.shape[-1]
+        sizes = sorted(b for b, h, w in self.shapes(kind) if (h, w) == (height, width) and b >= batch)
+        for size in sizes:
+            if (kind, (size, height, width)) not in self.failed:
+                return size, height, width
+        return None
+
+    def nearest_resolution(self, width, height):
+        """Bucket resolution closest in aspect ratio, then in area, to `width` x `height`."""
+        if not self.buckets:
+            return width, height
+        return min(
+            ((w, h) for w, h, _ in self.buckets),
+            key=lambda r: (abs(math.log(r[0] / r[1]) - math.log(width / height)), abs(r[0] * r[1] - width * height))
+        )
+
+    def artifact_dir(self, model_hash):
+        return os.path.join(self.cache_dir, model_hash[:16], f"torch-{torch.__version__}")
+
+    def load_artifacts(self, model_hash):
+        """Hot-load every saved artifact of this architecture and torch version into the compiler caches."""
+        directory = self.artifact_dir(model_hash)
+        if not PERSISTENT_CACHE or not os.path.isdir(directory):
+            return 0
+        loaded = 0
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".bin"):
+                continue
+            with open(os.path.join(directory, filename), "rb") as f:
+                if torch.compiler.load_cache_artifacts(f.read()) is not None:
+                    loaded += 1
+        with self.lock:
+            self.counters["artifacts_loaded"] += loaded
+        return loaded
+
+    def _save_artifacts(self, model_hash, kind, shape, dtype):
+        if not PERSISTENT_CACHE:
+            return
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is None:  # backend without a persistent cache (e.g. "eager")
+            return
+        directory = self.artifact_dir(model_hash)
+        os.makedirs(directory, exist_ok=True)
+        batch, height, width = shape
+        path = os.path.join(directory, f"{kind}_b{batch}_{height}x{width}_{str(dtype).replace('torch.', '')}.bin")
+        with open(path + ".tmp", "wb") as f:
+            f.write(artifacts[0])
+        os.replace(path + ".tmp", path)
+        with self.lock:
+            self.counters["artifacts_saved"] += 1
+
+    def wrap(self, module, kind, model_hash):
+        """Route `module`'s forward through the compiled buckets (idempotent)."""
+        if getattr(module, "_prunejuice_compiled", False):
+            return
+        # Under accelerate hooks the real forward is `_old_forward`; the hook keeps calling it
+        hooked = hasattr(module, "_hf_hook")
+        eager = module._old_forward if hooked else module.forward
+        compiled = torch.compile(eager, backend=self.backend, mode=self.mode, dynamic=False)
+        seen = set()
+
+        def forward(*args, **kwargs):
+            sample = args[0] if args else kwargs["sample"]
+            target = None if _sequential_offload(module) else self.route(kind, sample)
+            if target is None:
+                with self.lock:
+                    self.counters["eager_calls"] += 1
+                return eager(*args, **kwargs)
+            batch = sample.shape[0]
+            if target[0] != batch:
+                args = tuple(_pad(a, batch, target[0]) for a in args)
+                kwargs = {k: _pad(v, batch, target[0]) for k, v in kwargs.items()}
+            # A dtype change (e.g. the VAE upcast to fp32) is a separate graph
+            key = (target, sample.dtype)
+            if key in seen:
+                output = compiled(*args, **kwargs)
+            else:
+                # First call at this shape compiles (or hits the loaded cache); persist its artifacts
+                start = time.perf_counter()
+                try:
+                    with _fresh_artifacts():
+                        output = compiled(*args, **kwargs)
+                        self._save_artifacts(model_hash, kind, target, sample.dtype)
+                except Exception as e:
+                    if is_out_of_memory(e):
+                        raise
+                    print(f"Compiling {kind} at {target} failed ({e}); running it eagerly.")
+                    self.failed.add((kind, target))
+                    return _unpad(eager(*args, **kwargs), batch)
+                seen.add(key)
+                with self.lock:
+                    self.counters["compiles"] += 1
+                    self.counters["compile_seconds"] += time.perf_counter() - start
+            with self.lock:
+                self.counters["compiled_calls"] += 1
+                if target[0] != batch:
+                    self.counters["padded_calls"] += 1
+            return _unpad(output, batch)
+
+        if hooked:
+            module._old_forward = forward
+        else:
+            module.forward = forward
+        module._prunejuice_compiled = True
+
+    def attach(self, pipe):
+        """Load the cached artifacts of `pipe`'s UNet and VAE decoder and route them through the buckets."""
+        self.vae_scale = getattr(pipe, "vae_scale_factor", VAE_SCALE)
+        for kind, path in COMPILED_MODULES.items():
+            module = pipe
+            for attr in path:
+                module = getattr(module, attr, None)
+            if not isinstance(module, torch.nn.Module) or getattr(module, "_prunejuice_compiled", False):
+                continue
+            model_hash = module_fingerprint(module)
+            self.load_artifacts(model_hash)
+            self.wrap(module, kind, model_hash)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, buckets=[f"{w}x{h}x{b}" for w, h, b in self.buckets],
+                        compile_seconds=round(self.counters["compile_seconds"], 2),
+                        backend=self.backend, failed=len(self.failed))
@@ -0,0 +1,514 @@
+import importlib
+import json
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from safetensors import safe_open
+from safetensors.torch import save_file
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+from optimization.semi_structured import SparseSemiStructuredTensor, convert_2_4, decode_2_4, encode_2_4, is_2_4
+from optimization.weight_only import WeightOnlyLinear, module_config, module_from_config
+from optimization.structured import STRUCTURE_MANIFEST_NAME, apply_structure_manifest, replace_module, structure_manifest
+
+# Sparse checkpoint written next to a component's config.json in place of the dense weights
+SPARSE_WEIGHTS_NAME = "sparse_model.safetensors"
+SPARSE_FORMAT = "prunejuice-sparse"
+# INT8 checkpoint of a dynamically quantized component
+QUANTIZED_WEIGHTS_NAME = "quantized_model.safetensors"
+QUANTIZED_FORMAT = "prunejuice-int8"
+PRUNABLE_COMPONENTS = ("unet", "text_encoder", "text_encoder_2")
+# Components with weights that load_mapped_pipeline maps instead of deserializing
+MAPPABLE_COMPONENTS = ("unet", "vae", "text_encoder", "text_encoder_2")
+DENSE_WEIGHT_SUFFIXES = (".safetensors", ".bin")
+# Page size used to fault mapped tensors in ahead of use
+PAGE_SIZE = 4096
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8,
+    "BOOL": torch.bool, "F8_E4M3": torch.float8_e4m3fn, "F8_E5M2": torch.float8_e5m2,
+}
+
+_BIT_WEIGHTS = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8)
+
+
+def pack_bitmask(mask: torch.Tensor) -> torch.Tensor:
+    """Pack a boolean tensor into uint8, 8 elements per byte (MSB first)."""
+    flat = mask.flatten().to(torch.uint8)
+    pad = (-flat.numel()) % 8
+    if pad:
+        flat = torch.cat([flat, flat.new_zeros(pad)])
+    return (flat.view(-1, 8) * _BIT_WEIGHTS).sum(dim=1, dtype=torch.uint8)
+
+
+def unpack_bitmask(packed: torch.Tensor, numel: int) -> torch.Tensor:
+    """Inverse of pack_bitmask: flat boolean tensor of length `numel`."""
+    return packed.unsqueeze(1).bitwise_and(_BIT_WEIGHTS).ne(0).flatten()[:numel]
+
+
+def encode_sparse(tensor: torch.Tensor):
+    """Split a tensor into a packed nonzero bitmask and its packed nonzero values."""
+    mask = tensor != 0
+    return pack_bitmask(mask), tensor[mask].contiguous()
+
+
+def decode_sparse(mask: torch.Tensor, values: torch.Tensor, shape) -> torch.Tensor:
+    numel = 1
+    for dim in shape:
+        numel *= dim
+    dense = values.new_zeros(numel)
+    dense[unpack_bitmask(mask, numel)] = values
+    return dense.view(*shape)
+
+
+def encode_tensor(name: str, tensor: torch.Tensor, tensors: Dict[str, torch.Tensor], min_sparsity: float = 0.25) -> dict:
+    """
+    Add `tensor` to `tensors` in its most compact sparse form and return its
+    layout entry. Weights following the 2:4 pattern keep it: their kept values
+    plus 2-bit in-group positions. Other tensors at least `min_sparsity` zero
+    are stored as a bitmask plus packed nonzeros; anything denser (biases,
+    norms) is stored as is, since the mask would cost more than it saves.
+    """
+    if SparseSemiStructuredTensor is not None and isinstance(tensor, SparseSemiStructuredTensor):
+        tensor = tensor.to_dense()
+    tensor = tensor.detach().cpu().contiguous()
+    sparsity = (tensor == 0).sum().item() / max(tensor.numel(), 1)
+    if tensor.is_floating_point() and sparsity >= 0.5 and is_2_4(tensor):
+        values, indices = encode_2_4(tensor)
+        tensors[f"{name}.__values__"] = values
+        tensors[f"{name}.__indices__"] = indices
+        return {"encoding": "2:4", "shape": list(tensor.shape)}
+    if tensor.is_floating_point() and tensor.dim() > 1 and sparsity >= min_sparsity:
+        mask, values = encode_sparse(tensor)
+        tensors[f"{name}.__mask__"] = mask
+        tensors[f"{name}.__values__"] = values
+        return {"encoding": "bitmask", "shape": list(tensor.shape)}
+    tensors[name] = tensor
+    return {"encoding": "dense"}
+
+
+def decode_tensor(get_tensor, name: str, entry: dict) -> torch.Tensor:
+    """Dense tensor `name` from a layout entry written by encode_tensor."""
+    if entry["encoding"] == "dense":
+        return get_tensor(name)
+    if entry["encoding"] == "2:4":
+        return decode_2_4(get_tensor(f"{name}.__values__"), get_tensor(f"{name}.__indices__"), entry["shape"])
+    return decode_sparse(get_tensor(f"{name}.__mask__"), get_tensor(f"{name}.__values__"), entry["shape"])
+
+
+def save_sparse_state_dict(state_dict: Dict[str, torch.Tensor], path: str, min_sparsity: float = 0.25):
+    """Write a state dict as a sparse safetensors file (see encode_tensor)."""
+    tensors = {}
+    layout = {name: encode_tensor(name, tensor, tensors, min_sparsity) for name, tensor in state_dict.items()}
+    save_file(tensors, path, metadata={"format": SPARSE_FORMAT, "layout": json.dumps(layout)})
+
+
+class SparseCheckpoint:
+    """
+    Lazy reader for a sparse checkpoint: each tensor is read and densified only
+    when requested, so peak memory is one dense tensor on top of the model.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.handle = safe_open(path, framework="pt")
+        metadata = self.handle.metadata() or {}
+        if metadata.get("format") != SPARSE_FORMAT:
+            raise ValueError(f"{path} is not a {SPARSE_FORMAT} checkpoint")
+        self.layout = json.loads(metadata["layout"])
+
+    def keys(self):
+        return self.layout.keys()
+
+    def get(self, name: str) -> torch.Tensor:
+        return decode_tensor(self.handle.get_tensor, name, self.layout[name])
+
+    def semi_structured(self):
+        """Names of the weights stored with the 2:4 pattern."""
+        return [name for name, entry in self.layout.items() if entry["encoding"] == "2:4"]
+
+
+def component_class(model_dir: str, name: str):
+    """Class of a pipeline component as recorded in model_index.json."""
+    with open(os.path.join(model_dir, "model_index.json")) as f:
+        library, class_name = json.load(f)[name]
+    return getattr(importlib.import_module(library), class_name)
+
+
+def build_empty_component(model_dir: str, name: str):
+    """
+    Instantiate a component from its config with parameters on the meta device,
+    so nothing is allocated or randomly initialized before the weights arrive.
+    """
+    cls = component_class(model_dir, name)
+    component_dir = os.path.join(model_dir, name)
+    with init_empty_weights():
+        if hasattr(cls, "load_config"):  # diffusers ModelMixin
+            return cls.from_config(cls.load_config(component_dir))
+        return cls(cls.config_class.from_pretrained(component_dir))  # transformers PreTrainedModel
+
+
+def prefault(tensor: torch.Tensor) -> torch.Tensor:
+    """Touch one byte per page so a memory-mapped tensor is read from disk now rather than on first use."""
+    if tensor.numel() and tensor.is_contiguous():
+        tensor.reshape(-1).view(torch.uint8)[::PAGE_SIZE].sum()
+    return tensor
+
+
+def load_component_tensors(model: torch.nn.Module, get_tensor, names, torch_dtype: Optional[torch.dtype] = None,
+                           workers: int = 1):
+    """
+    Materialize a meta-initialized model one tensor at a time.
+    `get_tensor(name)` returns the dense tensor for a state dict key.
+    With `workers` > 1, tensors are read (and cast to `torch_dtype`) on a
+    thread pool; torch releases the GIL for both, so disk reads overlap.
+    """
+    def read(name):
+        value = get_tensor(name)
+        if torch_dtype is not None and value.is_floating_point() and value.dtype != torch_dtype:
+            return value.to(torch_dtype)
+        return prefault(value) if workers > 1 else value
+
+    names = list(names)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tensor-read") as pool:
+            values = list(pool.map(read, names))
+    else:
+        values = map(read, names)
+    for name, value in zip(names, values):
+        dtype = torch_dtype if value.is_floating_point() else None
+        set_module_tensor_to_device(model, name, "cpu", value=value, dtype=dtype, clear_cache=False)
+
+    tensors = list(model.named_parameters()) + list(model.named_buffers())
+    missing = [n for n, t in tensors if t.device.type == "meta"]
+    if missing:
+        raise ValueError(f"Checkpoint is missing {len(missing)} parameters, e.g. {missing[:3]}")
+    return model.eval()
+
+
+def weight_files(component_dir: str, variant: Optional[str] = None):
+    """
+    Dense safetensors files of a component (all shards). `variant` files
+    (e.g. `diffusion_pytorch_model.fp16.safetensors`) are preferred when present.
+    """
+    names = [
+        f for f in sorted(os.listdir(component_dir))
+        if f.endswith(".safetensors") and f not in (SPARSE_WEIGHTS_NAME, QUANTIZED_WEIGHTS_NAME)
+    ]
+    variant_names = [f for f in names if variant and (f".{variant}." in f or f".{variant}-" in f)]
+    # Variant files carry an extra dot in their stem (model.fp16.safetensors)
+    default_names = [f for f in names if "." not in f[:-len(".safetensors")]]
+    return [os.path.join(component_dir, f) for f in variant_names or default_names or names]
+
+
+def read_safetensors_header(path: str):
+    """(byte offset of the tensor data, {name: dtype/shape/data_offsets}) of a safetensors file."""
+    with open(path, "rb") as f:
+        (length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length))
+    header.pop("__metadata__", None)
+    return 8 + length, header
+
+
+class DenseCheckpoint:
+    """
+    Zero-copy reader over the (possibly sharded) safetensors files of a component.
+
+    Each file is memory-mapped copy-on-write and tensors are views into the
+    mapping, so parameters built from them are backed by the page cache: no
+    intermediate CPU copy, pages read on demand, and server processes loading
+    the same file share its memory until one of them writes to a tensor.
+    Falls back to safetensors' copying reader where mapping is unavailable.
+    """
+
+    def __init__(self, component_dir: str, variant: Optional[str] = None):
+        self.entries = {}  # name -> (byte view of the mapping, start, end, dtype, shape)
+        self.handles = {}  # name -> safe_open handle (fallback)
+        for path in weight_files(component_dir, variant):
+            data_start, header = read_safetensors_header(path)
+            try:
+                storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+            except RuntimeError:
+                handle = safe_open(path, framework="pt")
+                self.handles.update((key, handle) for key in handle.keys())
+                continue
+            mapped = torch.empty(0, dtype=torch.uint8).set_(storage)
+            for name, info in header.items():
+                begin, end = info["data_offsets"]
+                self.entries[name] = (mapped, data_start + begin, data_start + end,
+                                      SAFETENSORS_DTYPES[info["dtype"]], info["shape"])
+
+    def keys(self):
+        return [*self.entries, *self.handles]
+
+    def get(self, name: str) -> torch.Tensor:
+        if name in self.handles:
+            return self.handles[name].get_tensor(name)
+        mapped, begin, end, dtype, shape = self.entries[name]
+        data = mapped[begin:end]
+        if begin % dtype.itemsize:
+            data = data.clone()  # misaligned for this dtype: one copy
+        return data.view(dtype).view(shape)
+
+
+def is_quantized(component) -> bool:
+    """True for a module containing dynamic INT8 or weight-only quantized layers."""
+    return isinstance(component, torch.nn.Module) and any(
+        isinstance(m, (DynamicQuantizedLinear, WeightOnlyLinear)) for m in component.modules()
+    )
+
+
+def is_cpu_quantized(component) -> bool:
+    """True for a module containing dynamically quantized INT8 layers, which only run on CPU."""
+    return isinstance(component, torch.nn.Module) and any(
+        isinstance(m, DynamicQuantizedLinear) for m in component.modules()
+    )
+
+
+def save_quantized_state_dict(model: torch.nn.Module, path: str, min_sparsity: float = 0.25):
+    """
+    Write a quantized model as safetensors. Dynamic quantized Linear layers
+    are stored as their int8 weight with per-output-channel scales and zero
+    points (plus fp32 bias); weight-only layers record their configuration
+    and keep their int8/int4 buffers; every other tensor goes through
+    encode_tensor, so layers a mixed plan kept 2:4 or sparse stay that way.
+    """
+    tensors = {}
+    layout = {}
+    quantized = []
+    for name, module in model.named_modules():
+        if isinstance(module, WeightOnlyLinear):
+            layout[name] = {"encoding": "weight_only", **module_config(module)}
+            continue
+        if not isinstance(module, DynamicQuantizedLinear):
+            continue
+        weight = module.weight()
+        if weight.qscheme() not in (torch.per_channel_affine, torch.per_channel_symmetric):
+            raise ValueError(f"{name} is not per-channel quantized; use per_channel_dynamic_qconfig")
+        tensors[f"{name}.weight.__int8__"] = weight.int_repr().contiguous()
+        tensors[f"{name}.weight.__scales__"] = weight.q_per_channel_scales().contiguous()
+        tensors[f"{name}.weight.__zero_points__"] = weight.q_per_channel_zero_points().contiguous()
+        bias = module.bias()
+        if bias is not None:
+            tensors[f"{name}.bias"] = bias.detach().contiguous()
+        layout[name] = {
+            "encoding": "int8_per_channel",
+            "in_features": module.in_features,
+            "out_features": module.out_features,
+            "axis": weight.q_per_channel_axis(),
+            "bias": bias is not None,
+        }
+        quantized.append(name + ".")
+
+    for key, value in model.state_dict().items():
+        if isinstance(value, torch.Tensor) and not key.startswith(tuple(quantized)):
+            layout[key] = encode_tensor(key, value, tensors, min_sparsity)
+
+    save_file(tensors, path, metadata={"format": QUANTIZED_FORMAT, "layout": json.dumps(layout)})
+
+
+def _quantized_layout(path: str) -> dict:
+    metadata = safe_open(path, framework="pt").metadata() or {}
+    if metadata.get("format") != QUANTIZED_FORMAT:
+        raise ValueError(f"{path} is not a {QUANTIZED_FORMAT} checkpoint")
+    return json.loads(metadata["layout"])
+
+
+def load_quantized_tensors(model: torch.nn.Module, path: str, torch_dtype: Optional[torch.dtype] = None) -> torch.nn.Module:
+    """
+    Fill a meta-initialized model from a quantized checkpoint, rebuilding the
+    quantized layers straight from their integer weights so the full-precision
+    weights are never materialized. Components with dynamic INT8 layers load
+    their other tensors as fp32 (what those layers consume and produce);
+    weight-only components use `torch_dtype`.
+    """
+    handle = safe_open(path, framework="pt")
+    layout = _quantized_layout(path)
+    if any(entry["encoding"] == "int8_per_channel" for entry in layout.values()):
+        torch_dtype = torch.float32
+
+    for name, entry in layout.items():
+        if entry["encoding"] == "weight_only":
+            config = {k: v for k, v in entry.items() if k != "encoding"}
+            replace_module(model, name, module_from_config(config, device="meta", dtype=torch_dtype or torch.float16))
+            continue
+        if entry["encoding"] != "int8_per_channel":
+            continue
+        weight = torch._make_per_channel_quantized_tensor(
+            handle.get_tensor(f"{name}.weight.__int8__"),
+            handle.get_tensor(f"{name}.weight.__scales__"),
+            handle.get_tensor(f"{name}.weight.__zero_points__"),
+            entry["axis"],
+        )
+        module = DynamicQuantizedLinear(entry["in_features"], entry["out_features"], dtype=torch.qint8)
+        module.set_weight_bias(weight, handle.get_tensor(f"{name}.bias") if entry["bias"] else None)
+        replace_module(model, name, module)
+
+    plain = [name for name, entry in layout.items() if entry["encoding"] in ("dense", "2:4", "bitmask")]
+    model = load_component_tensors(model, lambda name: decode_tensor(handle.get_tensor, name, layout[name]), plain,
+                                   torch_dtype)
+    convert_2_4(model, [name for name in plain if layout[name]["encoding"] == "2:4"])
+    return model
+
+
+def load_component(model_dir: str, name: str, torch_dtype: Optional[torch.dtype] = None):
+    """
+    Build a pipeline component saved by save_pruned_pipeline or
+    save_quantized_pipeline: resize it to its structure manifest (structured
+    pruning), then fill it tensor by tensor from the quantized, sparse or
+    dense checkpoint, densifying each layer as it is loaded.
+    """
+    component_dir = os.path.join(model_dir, name)
+    model = build_empty_component(model_dir, name)
+    manifest_path = os.path.join(component_dir, STRUCTURE_MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            apply_structure_manifest(model, json.load(f))
+
+    quantized_path = os.path.join(component_dir, QUANTIZED_WEIGHTS_NAME)
+    if os.path.exists(quantized_path):
+        return load_quantized_tensors(model, quantized_path, torch_dtype)
+
+    sparse_path = os.path.join(component_dir, SPARSE_WEIGHTS_NAME)
+    if not os.path.exists(sparse_path):
+        checkpoint = DenseCheckpoint(component_dir)
+        return load_component_tensors(model, checkpoint.get, checkpoint.keys(), torch_dtype)
+    checkpoint = SparseCheckpoint(sparse_path)
+    model = load_component_tensors(model, checkpoint.get, checkpoint.keys(), torch_dtype)
+    # 2:4 layers run on sparse tensor cores once they are moved to a capable GPU
+    convert_2_4(model, checkpoint.semi_structured())
+    return model
+
+
+def _components_with(model_dir: str, filenames):
+    if not os.path.isdir(model_dir):
+        return []
+    return [
+        name for name in PRUNABLE_COMPONENTS
+        if any(os.path.exists(os.path.join(model_dir, name, f)) for f in filenames)
+    ]
+
+
+def custom_components(model_dir: str):
+    """Components under `model_dir` that from_pretrained cannot load (sparse, resized or quantized)."""
+    return _components_with(model_dir, (SPARSE_WEIGHTS_NAME, STRUCTURE_MANIFEST_NAME, QUANTIZED_WEIGHTS_NAME))
+
+
+def quantized_components(model_dir: str):
+    """Components stored with dynamic INT8 or weight-only quantized layers."""
+    return _components_with(model_dir, (QUANTIZED_WEIGHTS_NAME,))
+
+
+def cpu_quantized_components(model_dir: str):
+    """Quantized components with dynamic INT8 layers; these only run on CPU, in fp32 pipelines."""
+    return [
+        name for name in quantized_components(model_dir)
+        if any(entry["encoding"] == "int8_per_channel"
+               for entry in _quantized_layout(os.path.join(model_dir, name, QUANTIZED_WEIGHTS_NAME)).values())
+    ]
+
+
+def _write_structure_manifest(component, component_dir: str):
+    manifest = structure_manifest(component)
+    if manifest:
+        with open(os.path.join(component_dir, STRUCTURE_MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+
+def save_pruned_pipeline(pipe, output_path: str, sparse: bool = True, min_sparsity: float = 0.25):
+    """
+    Save a pruned pipeline. Components shrunk by structured pruning get a
+    structure manifest; with `sparse`, the UNet and text encoders are stored
+    as bitmask + nonzeros instead of dense weights.
+    """
+    pipe.save_pretrained(output_path, safe_serialization=True)
+    for name in PRUNABLE_COMPONENTS:
+        component = getattr(pipe, name, None)
+        if component is None:
+            continue
+        component_dir = os.path.join(output_path, name)
+        _write_structure_manifest(component, component_dir)
+        if not sparse:
+            continue
+        save_sparse_state_dict(component.state_dict(), os.path.join(component_dir, SPARSE_WEIGHTS_NAME), min_sparsity)
+        for filename in os.listdir(component_dir):
+            if filename.endswith(DENSE_WEIGHT_SUFFIXES) and filename != SPARSE_WEIGHTS_NAME:
+                os.remove(os.path.join(component_dir, filename))
+
+
+def save_quantized_pipeline(pipe, output_path: str):
+    """
+    Save a pipeline whose components were dynamically quantized. Quantized
+    components get their config plus an INT8 checkpoint; everything else
+    (VAE, tokenizers, scheduler) is saved the usual way.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    pipe.save_config(output_path)
+    for name, component in pipe.components.items():
+        if component is None:
+            continue
+        component_dir = os.path.join(output_path, name)
+        if not is_quantized(component):
+            component.save_pretrained(component_dir)
+            continue
+        os.makedirs(component_dir, exist_ok=True)
+        if hasattr(component, "save_config"):  # diffusers ModelMixin
+            component.save_config(component_dir)
+        else:  # transformers PreTrainedModel
+            component.config.save_pretrained(component_dir)
+        _write_structure_manifest(component, component_dir)
+        save_quantized_state_dict(component, os.path.join(component_dir, QUANTIZED_WEIGHTS_NAME))
+
+
+def load_mapped_pipeline(pipeline_cls, model_dir: str, torch_dtype: Optional[torch.dtype] = None,
+                         variant: Optional[str] = None, workers: int = 8, **kwargs):
+    """
+    Load a diffusers pipeline directory with its UNet, VAE and text encoders
+    built from memory-mapped weights (see DenseCheckpoint) instead of being
+    deserialized and copied by from_pretrained. Tensors are read in parallel
+    on `workers` threads. Components passed in `kwargs`, without safetensors
+    weights, or whose keys do not match the model fall back to from_pretrained.
+    """
+    with open(os.path.join(model_dir, "model_index.json")) as f:
+        index = json.load(f)
+    components = {}
+    for name in MAPPABLE_COMPONENTS:
+        component_dir = os.path.join(model_dir, name)
+        if name in kwargs or not (index.get(name) or [None])[0] or not os.path.isdir(component_dir):
+            continue
+        if not weight_files(component_dir, variant):
+            continue
+        try:
+            model = build_empty_component(model_dir, name)
+            checkpoint = DenseCheckpoint(component_dir, variant)
+            expected = {n for n, _ in model.named_parameters()} | {n for n, _ in model.named_buffers()}
+            names = [n for n in checkpoint.keys() if n in expected]
+            components[name] = load_component_tensors(model, checkpoint.get, names, torch_dtype, workers)
+        except (ValueError, KeyError, AttributeError) as e:
+            print(f"Mapped loading of {name} failed ({e}); using from_pretrained.")
+    remaining = [n for n in MAPPABLE_COMPONENTS if (index.get(n) or [None])[0] and n not in components and n not in kwargs]
+    return pipeline_cls.from_pretrained(
+        model_dir, torch_dtype=torch_dtype, variant=variant if remaining else None, **components, **kwargs
+    )
+
+
+def load_custom_pipeline(pipeline_cls, model_dir: str, torch_dtype: Optional[torch.dtype] = None, **kwargs):
+    """
+    Load a pipeline saved by save_pruned_pipeline or save_quantized_pipeline.
+    Custom components are built directly from their checkpoints; the rest go
+    through from_pretrained. Pipelines with dynamic INT8 components load in fp32.
+    """
+    if cpu_quantized_components(model_dir):
+        torch_dtype = torch.float32
+    components = {
+        name: load_component(model_dir, name, torch_dtype)
+        for name in custom_components(model_dir)
+        if name not in kwargs
+    }
+    return pipeline_cls.from_pretrained(model_dir, torch_dtype=torch_dtype, **components, **kwargs)
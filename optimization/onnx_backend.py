@@ -0,0 +1,296 @@
+import copy
+import json
+import os
+from types import SimpleNamespace
+
+import torch
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+from optimization.structured import replace_module
+
+# Written next to a model's pipeline files: <model dir>/onnx/
+ONNX_DIR_NAME = "onnx"
+ONNX_MANIFEST_NAME = "onnx_manifest.json"
+ONNX_FORMAT = "prunejuice-onnx"
+ONNX_COMPONENTS = ("text_encoder", "text_encoder_2", "unet", "vae_decoder")
+# Upper bound of the dynamic batch dimension (the UNet batch is doubled by classifier-free guidance)
+ONNX_MAX_BATCH = 32
+
+_NUMPY_TYPES = {"tensor(float)": "float32", "tensor(float16)": "float16", "tensor(int64)": "int64",
+                "tensor(int32)": "int32"}
+
+
+def onnx_export_dir(model_dir):
+    """ONNX export of the pipeline in `model_dir`, or None if it has not been exported."""
+    path = os.path.join(model_dir, ONNX_DIR_NAME)
+    return path if os.path.exists(os.path.join(path, ONNX_MANIFEST_NAME)) else None
+
+
+class _TextEncoderGraph(torch.nn.Module):
+    """Outputs the pipeline reads: the first output (pooled/projected for text_encoder_2) and the penultimate layer."""
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids):
+        output = self.encoder(input_ids, output_hidden_states=True)
+        return output[0], output.hidden_states[-2]
+
+
+class _UNetGraph(torch.nn.Module):
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, sample, timestep, encoder_hidden_states, text_embeds, time_ids):
+        # The UNet concatenates text_embeds with the always-float32 time id embedding; eager
+        # type promotion is not exported, so an fp16 graph would fail to load without this cast
+        added_cond_kwargs = {"text_embeds": text_embeds.float(), "time_ids": time_ids}
+        return self.unet(sample, timestep, encoder_hidden_states, added_cond_kwargs=added_cond_kwargs,
+                         return_dict=False)[0]
+
+
+class _VAEDecoderGraph(torch.nn.Module):
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, latent):
+        return self.vae.decode(latent, return_dict=False)[0]
+
+
+def _export_copy(module, dtype):
+    """
+    `module` ready for export: cast to `dtype`, with dynamic INT8 Linear layers
+    turned back into float Linear layers (the exporter cannot trace them; the
+    graph is re-quantized with ONNX Runtime instead). Copies only when needed.
+
+    Returns:
+        (module, dynamic INT8 layers were replaced)
+    """
+    quantized = [name for name, m in module.named_modules() if isinstance(m, DynamicQuantizedLinear)]
+    if not quantized and all(p.dtype == dtype for p in module.parameters() if p.is_floating_point()):
+        return module, False
+    module = copy.deepcopy(module)
+    for name in quantized:
+        layer = module.get_submodule(name)
+        linear = torch.nn.Linear(layer.in_features, layer.out_features, bias=layer.bias() is not None)
+        with torch.no_grad():
+            linear.weight.copy_(layer.weight().dequantize())
+            if layer.bias() is not None:
+                linear.bias.copy_(layer.bias())
+        replace_module(module, name, linear)
+    return module.to(dtype), bool(quantized)
+
+
+def _export_graph(module, args, path, input_names, output_names, dynamic_shapes, opset):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.onnx.export(module.eval(), args, path, dynamo=True, opset_version=opset, input_names=input_names,
+                      output_names=output_names, dynamic_shapes=dynamic_shapes, external_data=True)
+
+
+def _quantize_graph(float_path, path):
+    """Re-apply dynamic INT8 (per-channel weights) to an exported float graph, writing `path`."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(float_path, path, per_channel=True, weight_type=QuantType.QInt8, use_external_data_format=True)
+    for leftover in (float_path, float_path + ".data"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def export_pipeline_onnx(pipe, output_dir, dtype=torch.float32, opset=18):
+    """
+    Export the text encoders, UNet and VAE decoder of an SDXL pipeline to
+    ONNX, with dynamic batch and resolution, plus the tokenizers, scheduler
+    and component configs load_onnx_pipeline needs. Pruned (structured or
+    sparse) components export like dense ones; dynamic INT8 components are
+    exported in float and re-quantized to INT8 with ONNX Runtime; weight-only
+    components keep their integer weights and dequantize inside the graph.
+
+    Args:
+        output_dir: Usually `<model dir>/onnx`, where FooocusConnector looks for it
+        dtype: Float type of the graphs (float32 for the CPU execution provider)
+    """
+    # The dynamo exporter with automatic dynamic dims (Dim.AUTO) arrived in torch 2.6
+    if not hasattr(getattr(torch.export, "Dim", None), "AUTO"):
+        raise RuntimeError(f"ONNX export needs torch >= 2.6 (dynamo exporter with Dim.AUTO); found {torch.__version__}")
+    batch = torch.export.Dim("batch", max=ONNX_MAX_BATCH)
+    height, width = torch.export.Dim.AUTO, torch.export.Dim.AUTO
+    components = {}
+
+    def export(name, module, wrapper, args, input_names, output_names, dynamic_shapes):
+        module, requantize = _export_copy(module, dtype)
+        path = os.path.join(output_dir, name, "model.onnx")
+        print(f"Exporting {name} to ONNX...")
+        # The external weights file is referenced by name, so the float graph is written under its own
+        float_path = os.path.join(output_dir, name, "model.float.onnx") if requantize else path
+        _export_graph(wrapper(module), args, float_path, input_names, output_names, dynamic_shapes, opset)
+        if requantize:
+            _quantize_graph(float_path, path)
+        components[name] = {"path": os.path.relpath(path, output_dir), "quantized": requantize}
+
+    # Example batch of 2: a batch of 1 specializes the traced graph to it
+    max_length = pipe.tokenizer.model_max_length
+    for name in ("text_encoder", "text_encoder_2"):
+        ids = torch.zeros(2, max_length, dtype=torch.long)
+        export(name, getattr(pipe, name), _TextEncoderGraph, (ids,), ["input_ids"], ["output", "penultimate_hidden_state"],
+               {"input_ids": {0: batch}})
+
+    unet = pipe.unet
+    text_embeds_dim = pipe.text_encoder_2.config.projection_dim
+    time_ids = (unet.add_embedding.linear_1.in_features - text_embeds_dim) // unet.config.addition_time_embed_dim
+    size = unet.config.sample_size
+    args = (torch.randn(2, unet.config.in_channels, size, size, dtype=dtype), torch.tensor([1.0], dtype=dtype),
+            torch.randn(2, max_length, unet.config.cross_attention_dim, dtype=dtype),
+            torch.randn(2, text_embeds_dim, dtype=dtype), torch.randn(2, time_ids, dtype=dtype))
+    export("unet", unet, _UNetGraph, args, ["sample", "timestep", "encoder_hidden_states", "text_embeds", "time_ids"],
+           ["noise_pred"], {"sample": {0: batch, 2: height, 3: width}, "timestep": None,
+                            "encoder_hidden_states": {0: batch}, "text_embeds": {0: batch}, "time_ids": {0: batch}})
+
+    latent = torch.randn(2, pipe.vae.config.latent_channels, size, size, dtype=dtype)
+    export("vae_decoder", pipe.vae, _VAEDecoderGraph, (latent,), ["latent"], ["image"],
+           {"latent": {0: batch, 2: height, 3: width}})
+
+    pipe.tokenizer.save_pretrained(os.path.join(output_dir, "tokenizer"))
+    pipe.tokenizer_2.save_pretrained(os.path.join(output_dir, "tokenizer_2"))
+    pipe.scheduler.save_pretrained(os.path.join(output_dir, "scheduler"))
+    manifest = {
+        "format": ONNX_FORMAT,
+        "torch_version": torch.__version__,
+        "opset": opset,
+        "dtype": str(dtype).replace("torch.", ""),
+        "components": components,
+        "configs": {
+            "unet": dict(unet.config),
+            "vae": dict(pipe.vae.config),
+            "text_encoder": pipe.text_encoder.config.to_dict(),
+            "text_encoder_2": pipe.text_encoder_2.config.to_dict(),
+        },
+        "add_embedding_in_features": unet.add_embedding.linear_1.in_features,
+    }
+    with open(os.path.join(output_dir, ONNX_MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    print(f"ONNX export written to {output_dir}")
+    return output_dir
+
+
+class OnnxComponent(torch.nn.Module):
+    """
+    An ONNX Runtime session standing in for a pipeline component. It has no
+    parameters; it exposes the `config`, `device` and `dtype` the diffusers
+    pipeline reads, and converts torch tensors to and from numpy per call.
+    """
+
+    def __init__(self, path, config, providers, session_options=None):
+        super().__init__()
+        import onnxruntime
+        from diffusers.configuration_utils import FrozenDict
+
+        self.session = onnxruntime.InferenceSession(path, session_options, providers=providers)
+        self.input_types = {i.name: _NUMPY_TYPES.get(i.type, "float32") for i in self.session.get_inputs()}
+        self.config = FrozenDict(config)
+
+    @property
+    def device(self):
+        # Inputs and outputs go through host memory whatever the execution provider
+        return torch.device("cpu")
+
+    @property
+    def dtype(self):
+        return torch.float16 if "float16" in self.input_types.values() else torch.float32
+
+    def run(self, **inputs):
+        feed = {name: value.detach().cpu().numpy().astype(self.input_types[name], copy=False)
+                for name, value in inputs.items()}
+        return [torch.from_numpy(output) for output in self.session.run(None, feed)]
+
+
+class _EncoderOutput(tuple):
+    """(first output,) plus `hidden_states`; only [-2], the penultimate layer SDXL uses, is exported."""
+
+    def __new__(cls, output, penultimate):
+        instance = super().__new__(cls, (output,))
+        instance.hidden_states = (penultimate, None)
+        return instance
+
+
+class OnnxTextEncoder(OnnxComponent):
+    def forward(self, input_ids, output_hidden_states=True, **kwargs):
+        output, penultimate = self.run(input_ids=input_ids)
+        return _EncoderOutput(output, penultimate)
+
+
+class OnnxUNet(OnnxComponent):
+    def __init__(self, path, config, providers, add_embedding_in_features, session_options=None):
+        super().__init__(path, config, providers, session_options)
+        # Read by the pipeline to validate the size of the SDXL time ids
+        self.add_embedding = SimpleNamespace(linear_1=SimpleNamespace(in_features=add_embedding_in_features))
+
+    def forward(self, sample, timestep, encoder_hidden_states, timestep_cond=None, cross_attention_kwargs=None,
+                added_cond_kwargs=None, return_dict=True, **kwargs):
+        timestep = torch.as_tensor(timestep, dtype=torch.float32).reshape(-1)[:1]
+        (noise_pred,) = self.run(sample=sample, timestep=timestep, encoder_hidden_states=encoder_hidden_states,
+                                 text_embeds=added_cond_kwargs["text_embeds"], time_ids=added_cond_kwargs["time_ids"])
+        noise_pred = noise_pred.to(sample.dtype)
+        return SimpleNamespace(sample=noise_pred) if return_dict else (noise_pred,)
+
+
+class OnnxVAE(OnnxComponent):
+    """VAE with only the decoder exported (the text-to-image loop never encodes)."""
+
+    def decode(self, latent, return_dict=True, **kwargs):
+        (image,) = self.run(latent=latent)
+        return SimpleNamespace(sample=image) if return_dict else (image,)
+
+    def forward(self, latent):
+        return self.decode(latent, return_dict=False)[0]
+
+
+def is_onnx_pipeline(pipe):
+    return isinstance(getattr(pipe, "unet", None), OnnxUNet)
+
+
+def load_onnx_pipeline(pipeline_cls, export_dir, providers=None, intra_op_threads=0):
+    """
+    Assemble a diffusers pipeline whose text encoders, UNet and VAE decoder
+    run on ONNX Runtime. The pipeline's own denoising loop, schedulers and
+    callbacks are unchanged; only the module calls go to the sessions.
+
+    Args:
+        providers: ONNX Runtime execution providers in order of preference
+            (default: CUDA when available, then CPU)
+        intra_op_threads: Threads per session (0 lets ONNX Runtime decide)
+    """
+    import onnxruntime
+    import diffusers
+    from transformers import AutoTokenizer
+
+    with open(os.path.join(export_dir, ONNX_MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != ONNX_FORMAT:
+        raise ValueError(f"{export_dir} is not a {ONNX_FORMAT} export")
+    available = onnxruntime.get_available_providers()
+    providers = [p for p in (providers or ["CUDAExecutionProvider", "CPUExecutionProvider"]) if p in available]
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    def path(name):
+        return os.path.join(export_dir, manifest["components"][name]["path"])
+
+    configs = manifest["configs"]
+    with open(os.path.join(export_dir, "scheduler", "scheduler_config.json")) as f:
+        scheduler_cls = getattr(diffusers, json.load(f)["_class_name"])
+    print(f"Loading ONNX pipeline ({', '.join(providers)})...")
+    return pipeline_cls(
+        # The exported decoder runs in its export dtype; there is no torch decoder to upcast
+        vae=OnnxVAE(path("vae_decoder"), dict(configs["vae"], force_upcast=False), providers, options),
+        text_encoder=OnnxTextEncoder(path("text_encoder"), configs["text_encoder"], providers, options),
+        text_encoder_2=OnnxTextEncoder(path("text_encoder_2"), configs["text_encoder_2"], providers, options),
+        tokenizer=AutoTokenizer.from_pretrained(os.path.join(export_dir, "tokenizer")),
+        tokenizer_2=AutoTokenizer.from_pretrained(os.path.join(export_dir, "tokenizer_2")),
+        unet=OnnxUNet(path("unet"), configs["unet"], providers, manifest["add_embedding_in_features"], options),
+        scheduler=scheduler_cls.from_pretrained(export_dir, subfolder="scheduler"),
+    )
@@ -0,0 +1,252 @@
+import heapq
+import json
+import math
+from typing import Callable, Dict, Iterable, Optional
+
+import torch
+import torch.nn.functional as F
+
+from optimization.semi_structured import GROUP, mask_2_4
+from optimization.weight_only import dequantize_weight, quantizable_layers, quantize_weight
+
+# Per-weight cost of each treatment:
+#   vram:    bytes resident on the GPU (2:4 = kept fp16 values + metadata in the compressed form)
+#   disk:    bytes in the saved checkpoint (unstructured pruning = bitmask + nonzeros)
+#   latency: runtime relative to fp16, applied to the layer's MACs. Rough figures for
+#            Ampere+ GPUs with per-layer dequantization; re-measure for your card.
+FP16_COSTS = {"vram": 2.0, "disk": 2.0, "latency": 1.0}
+TREATMENT_COSTS = {
+    "fp16": FP16_COSTS,
+    "int8": {"vram": 1.0, "disk": 1.0, "latency": 1.1},
+    "int4": {"vram": 0.5, "disk": 0.5, "latency": 1.15},
+    "2:4": {"vram": 1.125, "disk": 1.125, "latency": 0.6},
+}
+BUDGET_KINDS = ("vram", "disk", "latency")
+
+
+def treatment_costs(treatment: str) -> dict:
+    """Cost table entry; `prune_<ratio>` is unstructured magnitude pruning at that ratio."""
+    if treatment.startswith("prune_"):
+        ratio = float(treatment[len("prune_"):])
+        return {"vram": 2.0, "disk": 2.0 * (1 - ratio) + 0.125, "latency": 1.0}
+    return TREATMENT_COSTS[treatment]
+
+
+def candidate_weight(weight: torch.Tensor, treatment: str, group_size: Optional[int] = None) -> torch.Tensor:
+    """The weight a layer would effectively compute with under `treatment`."""
+    if treatment == "fp16":
+        return weight
+    if treatment in ("int8", "int4"):
+        bits = 8 if treatment == "int8" else 4
+        qweight, scales = quantize_weight(weight, bits, group_size if bits == 4 else None)
+        return dequantize_weight(qweight, scales, bits, weight.shape, weight.dtype)
+    if treatment == "2:4":
+        return weight * mask_2_4(weight)
+    ratio = float(treatment[len("prune_"):])
+    magnitude = weight.abs().flatten().float()
+    k = int(magnitude.numel() * ratio)
+    if k == 0:
+        return weight
+    threshold = magnitude.kthvalue(k).values
+    return weight * (weight.abs() > threshold)
+
+
+def _applies(module: torch.nn.Module, treatment: str) -> bool:
+    return treatment != "2:4" or (isinstance(module, torch.nn.Linear) and module.in_features % GROUP == 0)
+
+
+def _macs(module: torch.nn.Module, output: torch.Tensor) -> int:
+    if isinstance(module, torch.nn.Conv2d):
+        return output.numel() * module.weight[0].numel()
+    return output.numel() * module.in_features
+
+
+class MixedPrecisionPlanner:
+    """
+    Chooses a treatment per UNet layer (fp16, int8, int4, 2:4, unstructured
+    pruning at several ratios) to meet a VRAM, disk or latency budget with the
+    least calibration error.
+
+    1. calibrate(): drives the UNet on a few prompts; forward hooks measure, for
+       every layer and candidate treatment, the relative output error against the
+       unmodified layer, and the layer's MACs.
+    2. plan(): greedy on each layer's error/cost convex hull, cheapest error per
+       unit of budget saved first, until the budget is met.
+
+    Plans are consumed by ModelPruner.apply_plan and ModelQuantizer.apply_plan.
+    """
+
+    def __init__(self, unet: torch.nn.Module, treatments: Iterable[str] = ("fp16", "int8", "int4", "2:4", "prune_0.3", "prune_0.5"),
+                 group_size: int = 64, include_conv: bool = True, min_features: int = 64):
+        """
+        Args:
+            unet: Model to plan for (unmodified, fp16/fp32)
+            treatments: Candidates; "fp16" (no change) is always included
+            group_size: INT4 group size used for both measurement and application
+            include_conv: Plan Conv2d layers as well as Linear
+            min_features: Narrower layers are left out of the plan (kept fp16)
+        """
+        self.unet = unet
+        self.treatments = ["fp16"] + [t for t in treatments if t != "fp16"]
+        self.group_size = group_size
+        self.layers = dict(quantizable_layers(unet, include_conv, min_features))
+        self.report = {}
+
+    @torch.no_grad()
+    def calibrate(self, run: Callable[[], None]) -> Dict[str, dict]:
+        """
+        Measure every candidate treatment on every layer while `run()` drives
+        the model. Candidate weights are built inside the hook, one layer at a
+        time, so calibration needs no extra copies of the model.
+
+        Returns:
+            layer -> {"numel", "macs", "errors": {treatment: relative output error}}
+        """
+        stats = {name: {"signal": 0.0, "noise": dict.fromkeys(self.treatments, 0.0), "macs": 0}
+                 for name in self.layers}
+
+        def hook(name, module):
+            def fn(_, inputs, output):
+                x = inputs[0]
+                entry = stats[name]
+                entry["signal"] += output.float().pow(2).sum().item()
+                entry["macs"] += _macs(module, output)
+                for treatment in self.treatments[1:]:
+                    if not _applies(module, treatment):
+                        continue
+                    weight = candidate_weight(module.weight, treatment, self.group_size)
+                    if isinstance(module, torch.nn.Conv2d):
+                        approx = F.conv2d(x, weight, module.bias, module.stride, module.padding,
+                                          module.dilation, module.groups)
+                    else:
+                        approx = F.linear(x, weight, module.bias)
+                    entry["noise"][treatment] += (approx.float() - output.float()).pow(2).sum().item()
+            return fn
+
+        handles = [module.register_forward_hook(hook(name, module)) for name, module in self.layers.items()]
+        try:
+            run()
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        self.report = {}
+        for name, entry in stats.items():
+            if entry["signal"] == 0:
+                continue  # Not reached by the calibration run
+            module = self.layers[name]
+            self.report[name] = {
+                "numel": module.weight.numel(),
+                "macs": entry["macs"],
+                "errors": {
+                    t: math.sqrt(entry["noise"][t] / entry["signal"])
+                    for t in self.treatments if _applies(module, t)
+                },
+            }
+        return self.report
+
+    def _cost(self, name: str, treatment: str, kind: str) -> float:
+        entry = self.report[name]
+        if kind == "latency":
+            return entry["macs"] * treatment_costs(treatment)["latency"]
+        return entry["numel"] * treatment_costs(treatment)[kind]
+
+    def _unplanned_cost(self, kind: str) -> float:
+        """Bytes of the parameters outside the plan, which stay fp16 (latency is relative to planned layers only)."""
+        if kind == "latency":
+            return 0.0
+        planned = {id(self.layers[name].weight) for name in self.report}
+        return sum(p.numel() * FP16_COSTS[kind] for p in self.unet.parameters() if id(p) not in planned)
+
+    def _hull(self, name: str, kind: str):
+        """Treatments on the lower-left convex hull of (cost, error), from fp16 toward cheaper."""
+        points = sorted(((self._cost(name, t, kind), e, t) for t, e in self.report[name]["errors"].items()),
+                        key=lambda p: (-p[0], p[1]))
+        hull = [p for p in points if p[2] == "fp16"]
+        for cost, error, treatment in points:
+            if cost >= hull[-1][0]:
+                continue
+            # Drop previous points that would make the hull non-convex
+            while len(hull) >= 2:
+                (c1, e1, _), (c2, e2, _) = hull[-2], hull[-1]
+                if (e2 - e1) * (c1 - cost) >= (error - e1) * (c1 - c2):
+                    hull.pop()
+                else:
+                    break
+            hull.append((cost, error, treatment))
+        return hull
+
+    def plan(self, budget: float, kind: str = "vram") -> dict:
+        """
+        Per-layer treatments meeting `budget` with the least total calibration error.
+
+        Args:
+            budget: Bytes for "vram" / "disk" (whole UNet, including layers outside
+                the plan); for "latency" a fraction of the fp16 latency, e.g. 0.8
+            kind: "vram", "disk" or "latency"
+        """
+        if not self.report:
+            raise RuntimeError("Run calibrate() before plan()")
+        if kind not in BUDGET_KINDS:
+            raise ValueError(f"Unknown budget kind '{kind}'; expected one of {BUDGET_KINDS}")
+
+        fixed = self._unplanned_cost(kind)
+        # Latency budgets are relative to the fp16 latency of the planned layers
+        scale = sum(self._cost(name, "fp16", kind) for name in self.report) if kind == "latency" else 1.0
+        target = budget * scale
+
+        hulls = {name: self._hull(name, kind) for name in self.report}
+        position = dict.fromkeys(hulls, 0)
+        total = fixed + sum(hull[0][0] for hull in hulls.values())
+        heap = []
+
+        def push(name):
+            i = position[name]
+            if i + 1 < len(hulls[name]):
+                (c1, e1, _), (c2, e2, _) = hulls[name][i], hulls[name][i + 1]
+                heapq.heappush(heap, ((e2 - e1) / (c1 - c2), name))
+
+        for name in hulls:
+            push(name)
+        while total > target and heap:
+            _, name = heapq.heappop(heap)
+            i = position[name]
+            total -= hulls[name][i][0] - hulls[name][i + 1][0]
+            position[name] = i + 1
+            push(name)
+
+        if total > target:
+            raise ValueError(f"{kind} budget {budget} is unreachable; the cheapest plan needs {total / scale:.4g}")
+
+        layers = {name: hulls[name][position[name]][2] for name in hulls}
+        estimate = {
+            k: self._unplanned_cost(k) + sum(self._cost(name, t, k) for name, t in layers.items())
+            for k in BUDGET_KINDS
+        }
+        estimate["latency"] /= sum(self._cost(name, "fp16", "latency") for name in layers) or 1.0
+        return {
+            "budget": {"kind": kind, "value": budget},
+            "group_size": self.group_size,
+            "estimate": estimate,
+            "error": sum(hulls[name][position[name]][1] for name in hulls),
+            "layers": layers,
+        }
+
+
+def save_plan(plan: dict, path: str):
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=2)
+
+
+def load_plan(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def calibration_run(pipe, prompts, steps: int = 4, resolution: int = 512, seed: int = 0):
+    """Callable running a short, seeded generation per prompt (latents only), for calibrate()."""
+    def run():
+        for prompt in prompts:
+            pipe(prompt, num_inference_steps=steps, height=resolution, width=resolution,
+                 generator=torch.Generator(device="cpu").manual_seed(seed), output_type="latent")
+    return run
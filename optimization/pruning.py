@@ -3,8 +3,17 @@ import torch.nn.utils.prune as prune
 from diffusers import StableDiffusionXLPipeline, UNet2DConditionModel
 import gc
 import os
+import sys
 from typing import Optional, Dict
 
+# Allow running as a script from anywhere
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from optimization.model_io import save_pruned_pipeline
+from optimization.quality import QualityEvaluator, summarize_quality
+from optimization.semi_structured import prune_2_4, prune_module_2_4
+from optimization.structured import prune_structured
+
 class ModelPruner:
     def __init__(self, model_path: str = "stabilityai/stable-diffusion-xl-base-1.0"):
         """
@@ -17,14 +26,20 @@ class ModelPruner:
         # Load in fp16 to save memory during loading, but we might need fp32 for pruning precision 
         # depending on the technique. For L1 unstructured, fp16 is usually fine.
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.pipe = StableDiffusionXLPipeline.from_pretrained(
+        self.model_path = model_path
+        self.pipe = self._load(model_path)
+        self.pipe.to("cpu") # Keep on CPU initially
+        self.quality_report = None
+        print("Model loaded.")
+
+    @staticmethod
+    def _load(model_path: str) -> StableDiffusionXLPipeline:
+        return StableDiffusionXLPipeline.from_pretrained(
             model_path, 
             torch_dtype=torch.float16, 
             use_safetensors=True, 
             variant="fp16"
         )
-        self.pipe.to("cpu") # Keep on CPU initially
-        print("Model loaded.")
 
     def prune_unet(self, amount: float = 0.50):
         """
@@ -33,6 +48,7 @@ class ModelPruner:
         Args:
             amount: Fraction of weights to prune (0.0 to 1.0)
         """
+        self.quality_report = None  # The weights change, so any earlier validation no longer applies
         print(f"Pruning UNet by {amount*100}%...")
         unet = self.pipe.unet
         
@@ -58,10 +74,50 @@ class ModelPruner:
         print("UNet pruning complete.")
         self._print_sparsity(unet)
 
+    def prune_unet_2_4(self, min_features: int = 64):
+        """
+        Prune the UNet's Linear layers to the 2:4 semi-structured pattern (two
+        of every four consecutive weights zeroed), which sparse tensor cores on
+        Ampere+ GPUs execute at up to 2x dense throughput. Unlike unstructured
+        50% sparsity this speeds up inference, not just storage.
+
+        Args:
+            min_features: Skip layers narrower than this (too small to benefit)
+        """
+        self.quality_report = None
+        print("Pruning UNet Linear layers to 2:4 sparsity...")
+        converted = prune_2_4(self.pipe.unet, min_features)
+        print(f"{converted} Linear layers converted to 2:4.")
+        self._print_sparsity(self.pipe.unet)
+
+    def apply_plan(self, plan: dict):
+        """
+        Apply the pruning part of a mixed-precision plan (optimization/planner.py)
+        to the UNet: "2:4" layers get the semi-structured pattern, "prune_<ratio>"
+        layers L1 unstructured pruning at their own ratio. Quantization entries
+        are left for ModelQuantizer.apply_plan.
+        """
+        self.quality_report = None
+        print(f"Applying plan ({plan['budget']['kind']} budget {plan['budget']['value']}) to UNet...")
+        counts = {}
+        for name, treatment in plan["layers"].items():
+            module = self.pipe.unet.get_submodule(name)
+            if treatment == "2:4":
+                prune_module_2_4(module)
+            elif treatment.startswith("prune_"):
+                prune.l1_unstructured(module, "weight", amount=float(treatment[len("prune_"):]))
+                prune.remove(module, "weight")
+            else:
+                continue
+            counts[treatment] = counts.get(treatment, 0) + 1
+        print(f"Pruned layers: {counts or 'none'}")
+        self._print_sparsity(self.pipe.unet)
+
     def prune_text_encoders(self, amount: float = 0.30):
         """
         Prune text encoders (usually less aggressive than UNet).
         """
+        self.quality_report = None
         print(f"Pruning Text Encoders by {amount*100}%...")
         
         for i, text_encoder in enumerate([self.pipe.text_encoder, self.pipe.text_encoder_2]):
@@ -84,6 +140,40 @@ class ModelPruner:
             print(f"Text Encoder {i+1} pruning complete.")
             self._print_sparsity(text_encoder)
 
+    def prune_unet_structured(self, amount: float = 0.25, block_ratios: Optional[Dict[str, float]] = None,
+                              norm: str = "l1"):
+        """
+        Structured UNet pruning: removes whole attention heads, feed-forward
+        hidden units and ResNet channel groups, shrinking the modules so dense
+        kernels actually do less work.
+
+        Args:
+            amount: Default fraction of each structure to remove
+            block_ratios: Per-block ratios by module prefix, e.g. {"down_blocks.1": 0.1, "mid_block": 0.0}
+            norm: Rank units by "l1" or "l2" weight norm
+        """
+        self.quality_report = None
+        print(f"Structured pruning of UNet ({amount*100}% default)...")
+        before = sum(p.numel() for p in self.pipe.unet.parameters())
+        removed = prune_structured(self.pipe.unet, amount, block_ratios, norm)
+        after = sum(p.numel() for p in self.pipe.unet.parameters())
+        print(f"Removed {removed['heads']} heads, {removed['ff_units']} FF units, "
+              f"{removed['resnet_channels']} ResNet channels")
+        print(f"UNet parameters: {before/1e6:.1f}M -> {after/1e6:.1f}M")
+
+    def prune_text_encoders_structured(self, amount: float = 0.15, block_ratios: Optional[Dict[str, float]] = None,
+                                       norm: str = "l1"):
+        """
+        Structured pruning of the text encoders' MLP hidden units (attention
+        widths are fixed by the CLIP implementation).
+        """
+        self.quality_report = None
+        print(f"Structured pruning of Text Encoders ({amount*100}% default)...")
+        for i, text_encoder in enumerate([self.pipe.text_encoder, self.pipe.text_encoder_2]):
+            if text_encoder is None: continue
+            removed = prune_structured(text_encoder, amount, block_ratios, norm)
+            print(f"Text Encoder {i+1}: removed {removed['ff_units']} MLP units")
+
     def _print_sparsity(self, model):
         """Helper to calculate and print global sparsity"""
         total_zeros = 0
@@ -96,30 +186,63 @@ class ModelPruner:
         if total_elements > 0:
             print(f"Global Sparsity: {100. * total_zeros / total_elements:.2f}%")
 
-    def validate_quality(self, test_prompts: list = None):
+    def validate_quality(self, test_prompts: list = None, steps: int = 20, resolution: int = 1024,
+                         batch_size: int = 2, thresholds: Optional[Dict[str, float]] = None,
+                         reference_path: Optional[str] = None, cache_dir: Optional[str] = None,
+                         report_path: Optional[str] = None) -> dict:
         """
-        Generate test images to validate quality hasn't degraded too much.
+        Compare the pruned pipeline with the unpruned model on a fixed prompt
+        suite and seeds (see optimization/quality.py). The result is kept in
+        `self.quality_report` and gates save_pruned_model.
+
+        Args:
+            test_prompts: Prompt suite; defaults to quality.DEFAULT_PROMPTS
+            thresholds: e.g. {"min_psnr": 18, "min_ssim": 0.6, "max_frechet": 5}; quality.DEFAULT_THRESHOLDS if omitted
+            reference_path: Reference model; defaults to the model this pruner loaded
+            cache_dir: Reuse reference images across runs with the same suite and settings
+            report_path: Write the full per-image report as JSON
         """
-        if test_prompts is None:
-            test_prompts = ["A professional photograph of an astronaut riding a horse", "An oil painting of a cottage"]
-            
-        print("Running validation generation...")
-        self.pipe.to(self.device)
-        
-        # Simple generation test
-        images = self.pipe(prompt=test_prompts, num_inference_steps=20).images
-        
-        # In a real scenario, we would calculate FID scores here.
-        # For now, we return the images for manual inspection or save them.
-        for i, img in enumerate(images):
-            img.save(f"prune_test_{i}.png")
-        print("Validation images saved.")
-        self.pipe.to("cpu")
-
-    def save_pruned_model(self, output_path: str):
-        """Save the pruned pipeline."""
+        evaluator = QualityEvaluator(test_prompts, steps=steps, resolution=resolution,
+                                     batch_size=batch_size, cache_dir=cache_dir)
+
+        try:
+            print("Running validation generation (reference)...")
+            reference = self._load(reference_path or self.model_path).to(self.device)
+            evaluator.record_reference(reference)
+            del reference
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+            print("Running validation generation (pruned)...")
+            self.pipe.to(self.device)
+            self.quality_report = evaluator.compare(self.pipe, thresholds, report_path)
+            self.pipe.to("cpu")
+        finally:
+            evaluator.close()
+        print(summarize_quality(self.quality_report))
+        return self.quality_report
+
+    def save_pruned_model(self, output_path: str, sparse: bool = True, force: bool = False):
+        """
+        Save the pruned pipeline. Refuses to save unless the last
+        validate_quality run passed its thresholds, or `force` is set.
+
+        Args:
+            output_path: Directory to write the pipeline to
+            sparse: Store pruned components as bitmask + nonzeros instead of dense weights
+            force: Save without quality validation, or despite a failed one
+        """
+        if self.quality_report is None:
+            if not force:
+                raise RuntimeError("Pruned model has not been validated: run validate_quality() first "
+                                   "(pass force=True to save anyway)")
+            print("Warning: saving without validate_quality(); quality is unchecked.")
+        elif not self.quality_report["passed"] and not force:
+            raise RuntimeError("Pruned model failed quality validation: "
+                               + "; ".join(self.quality_report["failures"]) + " (pass force=True to save anyway)")
         print(f"Saving pruned model to {output_path}...")
-        self.pipe.save_pretrained(output_path, safe_serialization=True)
+        save_pruned_pipeline(self.pipe, output_path, sparse=sparse)
         print("Save complete.")
 
 if __name__ == "__main__":
@@ -127,4 +250,10 @@ if __name__ == "__main__":
     pruner = ModelPruner()
     pruner.prune_unet(amount=0.50)
     pruner.prune_text_encoders(amount=0.30)
+    pruner.validate_quality(cache_dir="outputs/quality_reference")
+    # Or plan per layer for a memory target instead of one global amount:
+    # planner = MixedPrecisionPlanner(pruner.pipe.unet)
+    # planner.calibrate(calibration_run(pruner.pipe, ["a photo of a cat", "an oil painting of a cottage"]))
+    # plan = planner.plan(3.0 * 1024**3, kind="vram")
+    # pruner.apply_plan(plan)  # then ModelQuantizer(...).apply_plan(plan)
     # pruner.save_pruned_model("models/pruned_sdxl")
@@ -0,0 +1,375 @@
+import copy
+import hashlib
+import json
+import math
+import os
+import tempfile
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import torch
+import torch.nn.functional as F
+
+# A small fixed suite covering portraits, text-free scenes, fine texture and flat
+# illustration; use load_prompts() for a larger one (hundreds of prompts stream fine).
+DEFAULT_PROMPTS = [
+    "A professional photograph of an astronaut riding a horse",
+    "An oil painting of a cottage in a misty forest",
+    "Close-up portrait of an elderly fisherman, natural light, 85mm",
+    "A bowl of ramen on a wooden table, food photography",
+    "Isometric illustration of a tiny city on a floating island",
+    "Macro photo of a dragonfly wing with water droplets",
+    "A red vintage car parked on a cobblestone street at dusk",
+    "Flat vector logo of a fox, two colors, white background",
+]
+
+# Applied to the suite means; rough floors for "same seed, visibly the same image"
+DEFAULT_THRESHOLDS = {"min_psnr": 18.0, "min_ssim": 0.6}
+
+PSNR_CAP = 100.0  # dB reported for identical images
+FEATURE_RESOLUTION = 256  # Images are resized to this before VAE feature extraction
+
+
+def load_prompts(path: str) -> List[str]:
+    """One prompt per line; blank lines and '#' comments are ignored."""
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def psnr(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    """Per-image PSNR in dB of (N, C, H, W) images in [0, 1]."""
+    mse = (a.float() - b.float()).pow(2).flatten(1).mean(dim=1)
+    return (10 * torch.log10(1.0 / mse.clamp_min(10 ** (-PSNR_CAP / 10)))).clamp_max(PSNR_CAP)
+
+
+def _gaussian_window(size: int, sigma: float, channels: int, device) -> torch.Tensor:
+    coords = torch.arange(size, dtype=torch.float32, device=device) - (size - 1) / 2
+    g = torch.exp(-coords.pow(2) / (2 * sigma ** 2))
+    g = g / g.sum()
+    return (g[:, None] * g[None, :]).expand(channels, 1, size, size).contiguous()
+
+
+def ssim(a: torch.Tensor, b: torch.Tensor, window: int = 11, sigma: float = 1.5) -> torch.Tensor:
+    """Per-image SSIM (Gaussian 11x11 window, averaged over channels) of (N, C, H, W) images in [0, 1]."""
+    a, b = a.float(), b.float()
+    channels = a.shape[1]
+    kernel = _gaussian_window(window, sigma, channels, a.device)
+
+    def blur(x):
+        return F.conv2d(x, kernel, groups=channels)
+
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a.pow(2)
+    var_b = blur(b * b) - mu_b.pow(2)
+    cov = blur(a * b) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a.pow(2) + mu_b.pow(2) + c1) * (var_a + var_b + c2))
+    return ssim_map.flatten(1).mean(dim=1)
+
+
+def latent_distance(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    """Per-sample relative L2 distance of final latents, ||a - b|| / ||b||."""
+    a, b = a.float().flatten(1), b.float().flatten(1)
+    return (a - b).norm(dim=1) / b.norm(dim=1).clamp_min(1e-12)
+
+
+class RunningStats:
+    """
+    Streaming mean and covariance of feature vectors (float64 sums), so the
+    distribution of hundreds of images is summarized in O(d^2) memory.
+    """
+
+    def __init__(self, dim: int):
+        self.count = 0
+        self.sum = torch.zeros(dim, dtype=torch.float64)
+        self.outer = torch.zeros(dim, dim, dtype=torch.float64)
+
+    def update(self, features: torch.Tensor):
+        features = features.detach().to("cpu", torch.float64)
+        self.count += features.shape[0]
+        self.sum += features.sum(dim=0)
+        self.outer += features.T @ features
+
+    def mean(self) -> torch.Tensor:
+        return self.sum / self.count
+
+    def covariance(self) -> torch.Tensor:
+        mean = self.mean()
+        return (self.outer - self.count * torch.outer(mean, mean)) / max(self.count - 1, 1)
+
+    def state_dict(self) -> dict:
+        return {"count": self.count, "sum": self.sum, "outer": self.outer}
+
+    @classmethod
+    def from_state_dict(cls, state: dict) -> "RunningStats":
+        stats = cls(state["sum"].numel())
+        stats.count, stats.sum, stats.outer = state["count"], state["sum"], state["outer"]
+        return stats
+
+
+def _sqrt_psd(matrix: torch.Tensor) -> torch.Tensor:
+    eigenvalues, eigenvectors = torch.linalg.eigh(matrix)
+    return (eigenvectors * eigenvalues.clamp_min(0).sqrt()) @ eigenvectors.T
+
+
+def frechet_distance(a: RunningStats, b: RunningStats) -> float:
+    """
+    Fréchet distance between the Gaussians fitted to two feature sets (the FID
+    formula). tr(sqrt(Sa Sb)) is computed as tr(sqrt(Sa^1/2 Sb Sa^1/2)), which
+    stays symmetric and needs no scipy.
+    """
+    cov_a, cov_b = a.covariance(), b.covariance()
+    root_a = _sqrt_psd(cov_a)
+    cross = torch.linalg.eigvalsh(root_a @ cov_b @ root_a).clamp_min(0).sqrt().sum()
+    distance = (a.mean() - b.mean()).pow(2).sum() + cov_a.trace() + cov_b.trace() - 2 * cross
+    return max(float(distance), 0.0)
+
+
+class VAEFeatures:
+    """
+    Multi-scale features from a (frozen copy of the) VAE encoder, used instead
+    of an ImageNet network since the pipeline already ships one:
+
+    - perceptual(): LPIPS-style distance, channel-normalized feature
+      differences averaged over every down block (no learned weights)
+    - embed(): global-average-pooled deepest features, for Fréchet distance
+    """
+
+    def __init__(self, vae: torch.nn.Module, resolution: int = FEATURE_RESOLUTION):
+        self.encoder = copy.deepcopy(vae.encoder).float().eval().requires_grad_(False)
+        self.resolution = resolution
+        self.dim = self.encoder.down_blocks[-1].resnets[-1].out_channels
+
+    @torch.no_grad()
+    def _features(self, images: torch.Tensor) -> List[torch.Tensor]:
+        self.encoder.to(images.device)
+        x = F.interpolate(images.float(), size=(self.resolution, self.resolution), mode="bilinear",
+                          antialias=True, align_corners=False) * 2 - 1
+        features = []
+        x = self.encoder.conv_in(x)
+        for block in self.encoder.down_blocks:
+            x = block(x)
+            features.append(x)
+        return features
+
+    def embed(self, images: torch.Tensor) -> torch.Tensor:
+        return self._features(images)[-1].mean(dim=(2, 3))
+
+    def perceptual(self, a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+        distance = 0
+        features_a, features_b = self._features(a), self._features(b)
+        for fa, fb in zip(features_a, features_b):
+            fa = fa / (fa.norm(dim=1, keepdim=True) + 1e-10)
+            fb = fb / (fb.norm(dim=1, keepdim=True) + 1e-10)
+            distance = distance + (fa - fb).pow(2).sum(dim=1).mean(dim=(1, 2))
+        return distance / len(features_a)
+
+
+def _to_uint8(images: torch.Tensor) -> torch.Tensor:
+    return (images.float().clamp(0, 1) * 255).round().to(torch.uint8)
+
+
+def _check(means: dict, frechet: float, thresholds: Dict[str, float]) -> List[str]:
+    """Threshold keys are min_<metric> / max_<metric>, metric in the report means or "frechet"."""
+    values = dict(means, frechet=frechet)
+    failures = []
+    for key, limit in thresholds.items():
+        bound, _, metric = key.partition("_")
+        if metric not in values or bound not in ("min", "max"):
+            raise ValueError(f"Unknown quality threshold '{key}'")
+        value = values[metric]
+        if (bound == "min" and value < limit) or (bound == "max" and value > limit):
+            failures.append(f"{metric} {value:.4g} {'<' if bound == 'min' else '>'} {limit}")
+    return failures
+
+
+def pipeline_fingerprint(pipe) -> str:
+    """
+    Hash of a pipeline's weights: every tensor's name, shape, dtype and sum.
+    Identifies the reference model a cached reference was generated with.
+    """
+    digest = hashlib.sha256()
+    for name, component in sorted(pipe.components.items()):
+        if not isinstance(component, torch.nn.Module):
+            continue
+        for key, tensor in component.state_dict().items():
+            if not isinstance(tensor, torch.Tensor):
+                continue
+            if tensor.is_quantized:
+                tensor = tensor.dequantize()
+            total = tensor.detach().double().sum().item()
+            digest.update(f"{name}.{key}:{tuple(tensor.shape)}:{tensor.dtype}:{total!r}".encode())
+    return digest.hexdigest()
+
+
+class QualityEvaluator:
+    """
+    Quality-regression harness comparing an optimized pipeline with a reference
+    on a fixed prompt suite and fixed per-prompt seeds.
+
+    1. record_reference(pipe): generates the reference images in batches and
+       writes them (uint8 images + final latents) to `cache_dir`, one file per
+       batch. A cache from an earlier run with the same settings and
+       reference model is reused.
+    2. compare(pipe): generates the same batches with the candidate and, per
+       image, computes PSNR, SSIM, latent distance and a VAE-feature perceptual
+       distance; plus a Fréchet distance between the two feature distributions.
+
+    Only one batch of images is held in memory at a time, so suites of hundreds
+    of prompts run in bounded memory.
+    """
+
+    def __init__(self, prompts: Optional[Iterable[str]] = None, steps: int = 20, resolution: int = 1024,
+                 seed: int = 0, batch_size: int = 4, guidance_scale: float = 5.0, cache_dir: Optional[str] = None):
+        """
+        Args:
+            prompts: Prompt suite (DEFAULT_PROMPTS if omitted); prompt i uses seed `seed + i`
+            steps: Inference steps per image
+            resolution: Square output size
+            batch_size: Images generated (and held in memory) at once
+            cache_dir: Where reference batches are stored (a temp dir removed by close() if omitted)
+        """
+        self.prompts = list(prompts) if prompts is not None else list(DEFAULT_PROMPTS)
+        self.steps = steps
+        self.resolution = resolution
+        self.seed = seed
+        self.batch_size = batch_size
+        self.guidance_scale = guidance_scale
+        self.temp_dir = None if cache_dir else tempfile.TemporaryDirectory(prefix="prunejuice-quality-")
+        self.cache_dir = cache_dir or self.temp_dir.name
+        self.features = None
+        self.reference_stats = None
+        self.reference_id = None
+
+    def close(self):
+        """Delete the temporary reference cache; a caller-provided `cache_dir` is kept."""
+        if self.temp_dir is not None:
+            self.temp_dir.cleanup()
+            self.temp_dir = None
+
+    def _settings(self) -> dict:
+        return {
+            "prompts_sha256": hashlib.sha256("\n".join(self.prompts).encode()).hexdigest(),
+            "count": len(self.prompts), "steps": self.steps, "resolution": self.resolution,
+            "seed": self.seed, "batch_size": self.batch_size, "guidance_scale": self.guidance_scale,
+            "reference": self.reference_id,
+        }
+
+    def _batch_path(self, index: int) -> str:
+        return os.path.join(self.cache_dir, f"reference_{index:05d}.pt")
+
+    @torch.no_grad()
+    def generate(self, pipe) -> Iterator[tuple]:
+        """Yield (batch index, prompts, seeds, images (N, 3, H, W) in [0, 1], final latents) per batch."""
+        for index, start in enumerate(range(0, len(self.prompts), self.batch_size)):
+            prompts = self.prompts[start:start + self.batch_size]
+            seeds = [self.seed + start + i for i in range(len(prompts))]
+            final = {}
+
+            def keep_latents(_pipe, _step, _timestep, callback_kwargs):
+                final["latents"] = callback_kwargs["latents"]
+                return callback_kwargs
+
+            images = pipe(
+                prompt=prompts, num_inference_steps=self.steps, height=self.resolution, width=self.resolution,
+                guidance_scale=self.guidance_scale, output_type="pt",
+                generator=[torch.Generator(device="cpu").manual_seed(s) for s in seeds],
+                callback_on_step_end=keep_latents,
+            ).images
+            yield index, prompts, seeds, images, final["latents"]
+
+    def record_reference(self, pipe, reference_id: Optional[str] = None):
+        """
+        Generate (or reuse from cache_dir) the reference batches and their feature statistics.
+
+        Args:
+            reference_id: Identity of the reference model in the cache key; a hash of its weights if omitted
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.reference_id = reference_id or pipeline_fingerprint(pipe)
+        self.features = VAEFeatures(pipe.vae)
+        meta_path = os.path.join(self.cache_dir, "reference.json")
+        stats_path = os.path.join(self.cache_dir, "reference_stats.pt")
+        if os.path.exists(meta_path) and os.path.exists(stats_path):
+            with open(meta_path) as f:
+                if json.load(f) == self._settings():
+                    print(f"Using cached reference images from {self.cache_dir}")
+                    self.reference_stats = RunningStats.from_state_dict(torch.load(stats_path))
+                    return
+
+        print(f"Generating reference images for {len(self.prompts)} prompts...")
+        stats = RunningStats(self.features.dim)
+        for index, prompts, seeds, images, latents in self.generate(pipe):
+            images = _to_uint8(images)
+            stats.update(self.features.embed(images.float() / 255))
+            torch.save({"prompts": prompts, "seeds": seeds, "images": images.cpu(),
+                        "latents": latents.cpu()}, self._batch_path(index))
+        torch.save(stats.state_dict(), stats_path)
+        with open(meta_path, "w") as f:
+            json.dump(self._settings(), f, indent=2)  # Written last: marks the cache complete
+        self.reference_stats = stats
+
+    def compare(self, pipe, thresholds: Optional[Dict[str, float]] = None, report_path: Optional[str] = None) -> dict:
+        """
+        Score `pipe` against the recorded reference.
+
+        Args:
+            thresholds: e.g. {"min_psnr": 18, "min_ssim": 0.6, "max_perceptual": 0.2, "max_frechet": 5};
+                checked against the suite means (DEFAULT_THRESHOLDS if omitted)
+            report_path: Also write the report as JSON here
+
+        Returns:
+            {"images": [per-image metrics], "mean", "worst", "frechet", "thresholds", "failures", "passed"}
+        """
+        if self.reference_stats is None:
+            raise RuntimeError("Run record_reference() before compare()")
+        thresholds = DEFAULT_THRESHOLDS if thresholds is None else thresholds
+
+        print(f"Scoring candidate on {len(self.prompts)} prompts...")
+        stats = RunningStats(self.features.dim)
+        records = []
+        for index, prompts, seeds, images, latents in self.generate(pipe):
+            reference = torch.load(self._batch_path(index))
+            ref_images = reference["images"].to(images.device).float() / 255
+            images = _to_uint8(images).float() / 255
+            stats.update(self.features.embed(images))
+            scores = {
+                "psnr": psnr(images, ref_images),
+                "ssim": ssim(images, ref_images),
+                "latent_distance": latent_distance(latents, reference["latents"].to(latents.device)),
+                "perceptual": self.features.perceptual(images, ref_images),
+            }
+            for i, (prompt, seed) in enumerate(zip(prompts, seeds)):
+                records.append(dict({"prompt": prompt, "seed": seed},
+                                    **{metric: float(values[i]) for metric, values in scores.items()}))
+
+        metrics = ("psnr", "ssim", "latent_distance", "perceptual")
+        higher_is_better = {"psnr", "ssim"}
+        mean = {m: math.fsum(r[m] for r in records) / len(records) for m in metrics}
+        worst = {m: (min if m in higher_is_better else max)(records, key=lambda r: r[m]) for m in metrics}
+        frechet = frechet_distance(stats, self.reference_stats)
+        failures = _check(mean, frechet, thresholds)
+        report = {
+            "settings": self._settings(),
+            "images": records,
+            "mean": mean,
+            "worst": {m: {"prompt": r["prompt"], "seed": r["seed"], "value": r[m]} for m, r in worst.items()},
+            "frechet": frechet,
+            "thresholds": thresholds,
+            "failures": failures,
+            "passed": not failures,
+        }
+        if report_path:
+            with open(report_path, "w") as f:
+                json.dump(report, f, indent=2)
+        return report
+
+
+def summarize_quality(report: dict) -> str:
+    mean = report["mean"]
+    lines = [
+        f"PSNR {mean['psnr']:.2f} dB | SSIM {mean['ssim']:.4f} | latent dist {mean['latent_distance']:.4f} | "
+        f"perceptual {mean['perceptual']:.4f} | Fréchet {report['frechet']:.4g} ({len(report['images'])} images)",
+        f"Worst PSNR: {report['worst']['psnr']['value']:.2f} dB on '{report['worst']['psnr']['prompt']}'",
+    ]
+    lines.append("PASSED" if report["passed"] else "FAILED: " + "; ".join(report["failures"]))
+    return "\n".join(lines)
@@ -1,8 +1,16 @@
 import torch
 from diffusers import StableDiffusionXLPipeline
-from torch.ao.quantization import quantize_dynamic
+from torch.ao.quantization import quantize_dynamic, per_channel_dynamic_qconfig
 import os
-import time
+import sys
+
+# Allow running as a script from anywhere
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from optimization.benchmark import benchmark_config, preserved_state
+from optimization.model_io import custom_components, is_cpu_quantized, load_custom_pipeline, save_quantized_pipeline
+from optimization.onnx_backend import export_pipeline_onnx
+from optimization.weight_only import calibrate_weight_only, quantize_layers, quantize_weight_only, summarize_report
 
 class ModelQuantizer:
     def __init__(self, model_path: str):
@@ -10,11 +18,15 @@ class ModelQuantizer:
         Load a model (presumably pruned) for quantization.
         """
         print(f"Loading model for quantization from {model_path}...")
-        self.pipe = StableDiffusionXLPipeline.from_pretrained(
-            model_path,
-            torch_dtype=torch.float32, # Dynamic quantization requires fp32 input usually
-            use_safetensors=True
-        )
+        if custom_components(model_path):
+            # Sparse / structurally pruned checkpoint from ModelPruner.save_pruned_model
+            self.pipe = load_custom_pipeline(StableDiffusionXLPipeline, model_path, torch_dtype=torch.float32)
+        else:
+            self.pipe = StableDiffusionXLPipeline.from_pretrained(
+                model_path,
+                torch_dtype=torch.float32, # Dynamic quantization requires fp32 input usually
+                use_safetensors=True
+            )
         print("Model loaded.")
 
     def quantize_unet(self):
@@ -26,9 +38,10 @@ class ModelQuantizer:
         # We target Linear and LSTM layers for dynamic quantization. 
         # SDXL UNet is mostly Conv2d and Linear (in attention).
         # Dynamic quantization is effective for Linear layers.
+        # Per-output-channel scales keep accuracy on layers with uneven row magnitudes.
         self.pipe.unet = quantize_dynamic(
             self.pipe.unet,
-            {torch.nn.Linear},
+            {torch.nn.Linear: per_channel_dynamic_qconfig},
             dtype=torch.qint8
         )
         print("UNet quantization complete.")
@@ -40,74 +53,142 @@ class ModelQuantizer:
         print("Quantizing Text Encoders...")
         self.pipe.text_encoder = quantize_dynamic(
             self.pipe.text_encoder,
-            {torch.nn.Linear},
+            {torch.nn.Linear: per_channel_dynamic_qconfig},
             dtype=torch.qint8
         )
         self.pipe.text_encoder_2 = quantize_dynamic(
             self.pipe.text_encoder_2,
-            {torch.nn.Linear},
+            {torch.nn.Linear: per_channel_dynamic_qconfig},
             dtype=torch.qint8
         )
         print("Text Encoder quantization complete.")
 
-    def benchmark_memory(self):
+    def quantize_weight_only(self, bits: int = 8, group_size: int = None, include_conv: bool = True,
+                             calibration_prompt: str = "A professional photograph of an astronaut riding a horse",
+                             calibration_steps: int = 4, max_layer_error: float = None):
         """
-        Measure VRAM usage of the current model state.
+        Weight-only quantization of the UNet and text encoders for GPU inference.
+        Linear (and Conv2d) weights are stored as INT8 or grouped INT4 and
+        dequantized into fp16 matmuls, so unlike quantize_dynamic the model
+        keeps running on CUDA with ~1/2 (INT8) or ~1/4 (INT4) of the weight memory.
+
+        Before quantizing, a short fp16 calibration generation measures each
+        layer's output error against the fp16 baseline. The report is kept in
+        `self.weight_only_report`.
+
+        Args:
+            bits: 8 or 4
+            group_size: Weights per scale; None = per output channel (use 64-128 for INT4)
+            include_conv: Also quantize Conv2d layers
+            calibration_prompt: Prompt for the calibration run
+            calibration_steps: Denoising steps of the calibration run
+            max_layer_error: Keep layers whose relative output error exceeds this in fp16
         """
-        if not torch.cuda.is_available():
-            print("CUDA not available, skipping VRAM benchmark.")
-            return
-            
-        torch.cuda.reset_peak_memory_stats()
-        torch.cuda.empty_cache()
-        
-        self.pipe.to("cuda")
-        
-        # Run a dummy inference to trigger peak usage
-        self.pipe("benchmark", num_inference_steps=1)
-        
-        max_mem = torch.cuda.max_memory_allocated() / 1024**3
-        print(f"Peak VRAM Usage: {max_mem:.2f} GB")
-        
+        print(f"Weight-only INT{bits} quantization (group size {group_size or 'per-channel'})...")
+        components = {name: getattr(self.pipe, name) for name in ("unet", "text_encoder", "text_encoder_2")
+                      if getattr(self.pipe, name) is not None}
+        dynamic = [name for name, component in components.items() if is_cpu_quantized(component)]
+        if dynamic:
+            raise RuntimeError(f"{', '.join(dynamic)} already dynamically quantized (quantize_unet / "
+                               "quantize_text_encoders); weight-only quantization needs float weights")
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        # Only the components being quantized go to fp16; the VAE keeps its dtype
+        for component in components.values():
+            component.to(torch.float16)
+        self.pipe.to(device)
+
+        print("Calibrating against the fp16 baseline...")
+        report = calibrate_weight_only(
+            torch.nn.ModuleDict(components),
+            lambda: self.pipe(calibration_prompt, num_inference_steps=calibration_steps,
+                              height=512, width=512, output_type="latent"),
+            bits, group_size, include_conv,
+        )
+        skip = {name for name, entry in report.items()
+                if max_layer_error is not None and entry["rel_error"] > max_layer_error}
+
+        for name, component in components.items():
+            prefix = name + "."
+            count = quantize_weight_only(component, bits, group_size, include_conv,
+                                         skip={layer[len(prefix):] for layer in skip if layer.startswith(prefix)})
+            print(f"{name}: {count} layers quantized")
+        if skip:
+            print(f"Kept {len(skip)} high-error layers in fp16")
+
+        summary = summarize_report(report)
+        self.weight_only_report = {"bits": bits, "group_size": group_size, "skipped": sorted(skip),
+                                   "summary": summary, "layers": report}
+        if summary["layers"]:
+            print(f"Mean layer error: {summary['mean_rel_error']:.4f}, max: {summary['max_rel_error']:.4f} "
+                  f"({summary['worst'][0]['layer']})")
         self.pipe.to("cpu")
+        return self.weight_only_report
 
-    def benchmark_speed(self):
+    def apply_plan(self, plan: dict):
         """
-        Measure generation speed.
+        Apply the quantization part of a mixed-precision plan (optimization/planner.py)
+        to the UNet: "int8" / "int4" layers become weight-only quantized modules.
+        Pruning entries are applied by ModelPruner.apply_plan beforehand.
         """
-        if not torch.cuda.is_available():
-            print("CUDA not available, skipping Speed benchmark.")
-            return
+        bits_by_layer = {name: 8 if treatment == "int8" else 4
+                         for name, treatment in plan["layers"].items() if treatment in ("int8", "int4")}
+        print(f"Applying plan: {len(bits_by_layer)} UNet layers to weight-only INT8/INT4...")
+        quantize_layers(self.pipe.unet, bits_by_layer, plan.get("group_size"))
+        print("Plan applied.")
 
-        self.pipe.to("cuda")
-        print("Warming up...")
-        self.pipe("warmup", num_inference_steps=5)
-        
-        print("Benchmarking speed (1024x1024, 20 steps)...")
-        start = time.time()
-        self.pipe("benchmark prompt", num_inference_steps=20)
-        end = time.time()
-        
-        print(f"Generation Time: {end - start:.2f} seconds")
+    def _benchmark_device(self) -> str:
+        # Dynamic INT8 kernels are CPU-only
+        if not torch.cuda.is_available() or any(is_cpu_quantized(m) for m in self.pipe.components.values()):
+            return "cpu"
+        return "cuda"
+
+    def benchmark_memory(self, resolution: int = 1024, steps: int = 1):
+        """
+        Measure peak RAM (and VRAM on CUDA) of one generation in the current
+        model state. Runs on CPU when CUDA is unavailable.
+        """
+        device = self._benchmark_device()
+        with preserved_state(self.pipe):
+            result = benchmark_config(self.pipe, device, resolution, steps, warmup=0, trials=1)
+        print(f"Peak RAM Usage: {result['peak_ram_mb'] / 1024:.2f} GB")
+        if result["peak_vram_mb"] is not None:
+            print(f"Peak VRAM Usage: {result['peak_vram_mb'] / 1024:.2f} GB")
         self.pipe.to("cpu")
+        return result
+
+    def benchmark_speed(self, resolution: int = 1024, steps: int = 20, warmup: int = 1, trials: int = 3):
+        """
+        Measure generation latency (p50/p95 over `trials` after `warmup` runs)
+        and denoising it/s. Runs on CPU when CUDA is unavailable; see
+        scripts/benchmark.py for full matrices and baseline comparison.
+        """
+        device = self._benchmark_device()
+        print(f"Benchmarking speed ({resolution}x{resolution}, {steps} steps, {device})...")
+        with preserved_state(self.pipe):
+            result = benchmark_config(self.pipe, device, resolution, steps, warmup=warmup, trials=trials)
+        print(f"Generation Time: p50 {result['latency_p50']:.2f}s, p95 {result['latency_p95']:.2f}s, "
+              f"{result['its']:.2f} it/s")
+        self.pipe.to("cpu")
+        return result
 
     def save_quantized_model(self, output_path: str):
         """
-        Save the quantized model.
-        Note: Standard save_pretrained might not preserve dynamic quantization wrappers 
-        correctly without specific handling or pickling, but for this prototype we'll try standard save.
+        Save the quantized model as INT8 weights with per-channel scales and
+        zero points (see optimization/model_io.py). The backend rebuilds the
+        quantized layers directly from them, without re-quantizing from fp32.
         """
         print(f"Saving quantized model to {output_path}...")
-        # Torchscript or saving via torch.save might be necessary for quantized modules
-        # but Diffusers has some support. We will use a custom save for the dict
-        # or rely on local caching.
-        
-        # For full robust saving, usually we export to ONNX or use torch.jit.save
-        # Here we will attempt standard saving, but note that dynamic quantization 
-        # is often runtime-applied.
-        self.pipe.save_pretrained(output_path)
+        save_quantized_pipeline(self.pipe, output_path)
         print("Save complete.")
 
+    def export_onnx(self, output_path: str):
+        """
+        Export the quantized pipeline to ONNX for the ONNX Runtime backend
+        (see optimization/onnx_backend.py). Dynamic INT8 components are
+        re-quantized per channel in the exported graphs.
+        """
+        export_pipeline_onnx(self.pipe, output_path)
+
 if __name__ == "__main__":
     # Example usage
     # quantizer = ModelQuantizer("models/pruned_sdxl")
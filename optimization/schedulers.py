@@ -0,0 +1,9 @@
+from diffusers import DPMSolverMultistepScheduler, EulerAncestralDiscreteScheduler
+
+# Scheduler family -> (class, options applied on top of the model's scheduler config)
+SCHEDULER_FAMILIES = {
+    # Lightning/Turbo checkpoints need trailing spacing at very low step counts
+    "EulerAncestral": (EulerAncestralDiscreteScheduler, {"timestep_spacing": "trailing"}),
+    # DPM++ 2M Karras for quality
+    "DPMSolverMultistep": (DPMSolverMultistepScheduler, {"use_karras_sigmas": True}),
+}
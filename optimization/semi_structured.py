@@ -0,0 +1,157 @@
+from typing import Iterable, Optional
+
+import torch
+import torch.nn.functional as F
+
+try:
+    from torch.sparse import SparseSemiStructuredTensor, to_sparse_semi_structured
+except ImportError:  # torch < 2.1
+    SparseSemiStructuredTensor = None
+    to_sparse_semi_structured = None
+
+GROUP = 4
+KEEP = 2
+
+
+def is_2_4(weight: torch.Tensor) -> bool:
+    """True if every group of four consecutive weights along the input dim has at most two nonzeros."""
+    if weight.dim() != 2 or weight.shape[1] % GROUP:
+        return False
+    return bool(((weight.view(weight.shape[0], -1, GROUP) != 0).sum(dim=-1) <= KEEP).all())
+
+
+def mask_2_4(weight: torch.Tensor) -> torch.Tensor:
+    """Boolean mask keeping the two largest-magnitude weights of every group of four."""
+    groups = weight.detach().abs().float().view(weight.shape[0], -1, GROUP)
+    keep = groups.topk(KEEP, dim=-1).indices
+    mask = torch.zeros_like(groups, dtype=torch.bool).scatter_(-1, keep, True)
+    return mask.view_as(weight)
+
+
+def encode_2_4(weight: torch.Tensor):
+    """
+    Compress a 2:4 sparse (out, in) weight into its kept values (out, in/2) and
+    their in-group positions, two 2-bit indices per group packed as one nibble,
+    two groups per byte.
+    """
+    out_features, in_features = weight.shape
+    groups = weight.view(out_features, -1, GROUP)
+    # Positions of the (at most two) nonzeros, padded with zeros' positions, in ascending order
+    order = (groups != 0).to(torch.int8).argsort(dim=-1, descending=True, stable=True)
+    positions = order[..., :KEEP].sort(dim=-1).values
+    values = groups.gather(-1, positions).reshape(out_features, -1)
+
+    nibbles = (positions[..., 0] | (positions[..., 1] << 2)).to(torch.uint8)
+    if nibbles.shape[1] % 2:
+        nibbles = F.pad(nibbles, (0, 1))
+    indices = nibbles[:, 0::2] | (nibbles[:, 1::2] << 4)
+    return values.contiguous(), indices.contiguous()
+
+
+def _positions(indices: torch.Tensor, n_groups: int) -> torch.Tensor:
+    nibbles = torch.stack([indices & 0xF, indices >> 4], dim=-1).flatten(1)[:, :n_groups]
+    return torch.stack([nibbles & 0x3, (nibbles >> 2) & 0x3], dim=-1).long()
+
+
+def decode_2_4(values: torch.Tensor, indices: torch.Tensor, shape) -> torch.Tensor:
+    out_features, in_features = shape
+    n_groups = in_features // GROUP
+    dense = values.new_zeros(out_features, n_groups, GROUP)
+    dense.scatter_(-1, _positions(indices, n_groups), values.view(out_features, n_groups, KEEP))
+    return dense.view(out_features, in_features)
+
+
+def linear_2_4_reference(x: torch.Tensor, values: torch.Tensor, indices: torch.Tensor,
+                         bias: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    CPU reference for a linear layer computed straight from the compressed 2:4
+    form: each output gathers the two selected inputs per group. Mirrors what
+    the sparse tensor cores do; meant for correctness checks, not speed.
+    """
+    out_features = values.shape[0]
+    n_groups = values.shape[1] // KEEP
+    positions = _positions(indices, n_groups)  # (out, groups, 2)
+    x_groups = x.reshape(*x.shape[:-1], n_groups, GROUP)
+    selected = x_groups[..., torch.arange(n_groups)[:, None], positions]  # (..., out, groups, 2)
+    y = (selected * values.view(out_features, n_groups, KEEP)).sum(dim=(-2, -1))
+    return y + bias if bias is not None else y
+
+
+def semi_structured_supported(device: torch.device) -> bool:
+    """2:4 sparse tensor cores need Ampere (sm80) or newer."""
+    return (
+        to_sparse_semi_structured is not None
+        and device.type == "cuda"
+        and torch.cuda.get_device_capability(device) >= (8, 0)
+    )
+
+
+class SemiStructuredLinear(torch.nn.Linear):
+    """
+    Linear layer with 2:4 sparse weights. On CPU (and unsupported GPUs) the
+    weight is a dense tensor holding the 2:4 zeros; whenever the module lands
+    on an sm80+ GPU the weight is compressed into a semi-structured sparse
+    tensor so matmuls run on the sparse tensor cores. Moving back (e.g. model
+    CPU offload) restores the dense form, so offload hooks keep working.
+    """
+
+    @classmethod
+    def from_linear(cls, linear: torch.nn.Linear) -> "SemiStructuredLinear":
+        linear.__class__ = cls
+        return linear
+
+    def _apply(self, fn, recurse=True):
+        if SparseSemiStructuredTensor is not None and isinstance(self.weight.data, SparseSemiStructuredTensor):
+            self.weight = torch.nn.Parameter(self.weight.data.to_dense(), requires_grad=False)
+        super()._apply(fn, recurse)
+        if self.weight.dtype in (torch.float16, torch.bfloat16) and semi_structured_supported(self.weight.device):
+            try:
+                self.weight = torch.nn.Parameter(to_sparse_semi_structured(self.weight.data), requires_grad=False)
+            except RuntimeError:
+                pass  # Shape not a multiple of the kernel tile; stays dense
+        return self
+
+
+def prune_2_4(model: torch.nn.Module, min_features: int = 64) -> int:
+    """
+    Zero two of every four consecutive input weights (smallest magnitude) in
+    each Linear layer and switch it to SemiStructuredLinear. Layers narrower
+    than `min_features` or not divisible by four are left dense.
+    Returns the number of layers converted.
+    """
+    converted = 0
+    for module in model.modules():
+        if type(module) is not torch.nn.Linear:
+            continue
+        if module.in_features % GROUP or min(module.in_features, module.out_features) < min_features:
+            continue
+        prune_module_2_4(module)
+        converted += 1
+    return converted
+
+
+@torch.no_grad()
+def prune_module_2_4(linear: torch.nn.Linear) -> "SemiStructuredLinear":
+    """Apply the 2:4 mask to a single Linear layer and switch it to SemiStructuredLinear."""
+    linear.weight.mul_(mask_2_4(linear.weight))
+    return SemiStructuredLinear.from_linear(linear)
+
+
+def convert_2_4(model: torch.nn.Module, names: Optional[Iterable[str]] = None) -> int:
+    """
+    Switch Linear layers whose weights follow the 2:4 pattern to
+    SemiStructuredLinear, e.g. after loading a 2:4 checkpoint.
+
+    Args:
+        names: Weight names known to be 2:4 (from the checkpoint layout); checked if omitted
+    """
+    names = set(names) if names is not None else None
+    converted = 0
+    for name, module in model.named_modules():
+        if type(module) is not torch.nn.Linear:
+            continue
+        weight_name = f"{name}.weight"
+        if (weight_name in names) if names is not None else is_2_4(module.weight):
+            SemiStructuredLinear.from_linear(module)
+            converted += 1
+    return converted
@@ -0,0 +1,229 @@
+from typing import Dict, Optional
+
+import torch
+from accelerate import init_empty_weights
+from diffusers.models.attention import FeedForward
+from diffusers.models.attention_processor import Attention
+from diffusers.models.resnet import ResnetBlock2D
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+# Written next to a component's config.json when its module shapes no longer match the config
+STRUCTURE_MANIFEST_NAME = "structure.json"
+
+
+def _norm(weight: torch.Tensor, dim, p: str) -> torch.Tensor:
+    return torch.linalg.vector_norm(weight.float(), ord=1 if p == "l1" else 2, dim=dim)
+
+
+def _ratio(name: str, amount: float, block_ratios: Optional[Dict[str, float]]) -> float:
+    """Ratio for a module: the longest matching block prefix wins, else `amount`."""
+    best = None
+    for prefix, ratio in (block_ratios or {}).items():
+        if name == prefix or name.startswith(prefix + "."):
+            if best is None or len(prefix) > len(best[0]):
+                best = (prefix, ratio)
+    return best[1] if best else amount
+
+
+def _keep(scores: torch.Tensor, ratio: float) -> torch.Tensor:
+    """Indices of the highest-scoring units after dropping `ratio` of them (at least one survives)."""
+    n_drop = min(int(scores.numel() * ratio), scores.numel() - 1)
+    if n_drop <= 0:
+        return None
+    return scores.argsort(descending=True)[:scores.numel() - n_drop].sort().values
+
+
+def replace_module(root: torch.nn.Module, name: str, module: torch.nn.Module):
+    parent_name, _, attr = name.rpartition(".")
+    setattr(root.get_submodule(parent_name) if parent_name else root, attr, module)
+
+
+def resized_module(module: torch.nn.Module, shape: dict) -> torch.nn.Module:
+    """Uninitialized copy of a Linear/Conv2d/GroupNorm with new feature/channel/group counts."""
+    if isinstance(module, torch.nn.Linear):
+        return torch.nn.Linear(shape["in_features"], shape["out_features"], bias=module.bias is not None,
+                               device=module.weight.device, dtype=module.weight.dtype)
+    if isinstance(module, torch.nn.Conv2d):
+        return torch.nn.Conv2d(shape["in_channels"], shape["out_channels"], module.kernel_size, module.stride,
+                               module.padding, module.dilation, module.groups, bias=module.bias is not None,
+                               padding_mode=module.padding_mode,
+                               device=module.weight.device, dtype=module.weight.dtype)
+    if isinstance(module, torch.nn.GroupNorm):
+        return torch.nn.GroupNorm(shape["num_groups"], shape["num_channels"], module.eps, module.affine,
+                                  device=module.weight.device, dtype=module.weight.dtype)
+    raise TypeError(f"Cannot resize {type(module).__name__}")
+
+
+def _shape(module: torch.nn.Module) -> Optional[dict]:
+    if isinstance(module, (torch.nn.Linear, DynamicQuantizedLinear)):
+        return {"in_features": module.in_features, "out_features": module.out_features}
+    if isinstance(module, torch.nn.Conv2d):
+        return {"in_channels": module.in_channels, "out_channels": module.out_channels}
+    if isinstance(module, torch.nn.GroupNorm):
+        return {"num_groups": module.num_groups, "num_channels": module.num_channels}
+    if isinstance(module, Attention):
+        return {"heads": module.heads}
+    return None
+
+
+@torch.no_grad()
+def _sliced(module: torch.nn.Module, out_idx=None, in_idx=None) -> torch.nn.Module:
+    """Linear/Conv2d keeping only the given output rows and/or input columns."""
+    weight = module.weight
+    if out_idx is not None:
+        weight = weight[out_idx]
+    if in_idx is not None:
+        weight = weight[:, in_idx]
+    if isinstance(module, torch.nn.Linear):
+        new = resized_module(module, {"in_features": weight.shape[1], "out_features": weight.shape[0]})
+    else:
+        new = resized_module(module, {"in_channels": weight.shape[1], "out_channels": weight.shape[0]})
+    new.weight.copy_(weight)
+    if module.bias is not None:
+        new.bias.copy_(module.bias if out_idx is None else module.bias[out_idx])
+    return new
+
+
+@torch.no_grad()
+def prune_attention_heads(attn: Attention, ratio: float, p: str = "l1") -> int:
+    """
+    Drop whole heads from a diffusers Attention: rows of to_q/to_k/to_v and the
+    matching input columns of to_out[0]. Returns the number of heads removed.
+    """
+    if attn.heads < 2 or getattr(attn, "add_k_proj", None) is not None or not hasattr(attn, "to_q"):
+        return 0
+    head_dim = attn.to_q.out_features // attn.heads
+    scores = sum(_norm(proj.weight.view(attn.heads, head_dim, -1), (1, 2), p)
+                 for proj in (attn.to_q, attn.to_k, attn.to_v))
+    scores = scores + _norm(attn.to_out[0].weight.view(attn.to_out[0].out_features, attn.heads, head_dim), (0, 2), p)
+    heads = _keep(scores, ratio)
+    if heads is None:
+        return 0
+
+    idx = (heads[:, None] * head_dim + torch.arange(head_dim)).flatten()
+    attn.to_q = _sliced(attn.to_q, out_idx=idx)
+    attn.to_k = _sliced(attn.to_k, out_idx=idx)
+    attn.to_v = _sliced(attn.to_v, out_idx=idx)
+    attn.to_out[0] = _sliced(attn.to_out[0], in_idx=idx)
+    removed = attn.heads - heads.numel()
+    attn.heads = heads.numel()
+    # Attention slicing splits along heads, so its size must follow them
+    attn.sliceable_head_dim = attn.heads
+    attn.inner_dim = attn.heads * head_dim
+    return removed
+
+
+@torch.no_grad()
+def prune_mlp(fc_in: torch.nn.Linear, fc_out: torch.nn.Linear, ratio: float, p: str = "l1", gated: bool = False):
+    """
+    Drop hidden units between two Linear layers. For gated activations (GEGLU)
+    fc_in produces [hidden, gate] halves and both rows of a unit are removed.
+    Returns the resized pair, or None if nothing was pruned.
+    """
+    hidden = fc_out.in_features
+    rows = fc_in.weight.view(2, hidden, -1) if gated else fc_in.weight.view(1, hidden, -1)
+    scores = _norm(rows, (0, 2), p) + _norm(fc_out.weight, 0, p)
+    units = _keep(scores, ratio)
+    if units is None:
+        return None
+    out_idx = torch.cat([units, units + hidden]) if gated else units
+    return _sliced(fc_in, out_idx=out_idx), _sliced(fc_out, in_idx=units)
+
+
+@torch.no_grad()
+def prune_resnet_channels(resnet: ResnetBlock2D, ratio: float, p: str = "l1") -> int:
+    """
+    Drop conv1 output channels of a ResnetBlock2D in whole GroupNorm groups, so
+    norm2 statistics of the surviving groups are unchanged. time_emb_proj rows,
+    norm2 and conv2 input channels are rewired to match. Returns channels removed.
+    """
+    norm = resnet.norm2
+    if resnet.time_embedding_norm != "default" or norm.num_groups < 2 or not isinstance(resnet.conv1, torch.nn.Conv2d):
+        return 0
+    group_size = norm.num_channels // norm.num_groups
+    scores = _norm(resnet.conv1.weight.view(norm.num_groups, group_size, -1), (1, 2), p)
+    groups = _keep(scores, ratio)
+    if groups is None:
+        return 0
+
+    idx = (groups[:, None] * group_size + torch.arange(group_size)).flatten()
+    resnet.conv1 = _sliced(resnet.conv1, out_idx=idx)
+    if resnet.time_emb_proj is not None:
+        resnet.time_emb_proj = _sliced(resnet.time_emb_proj, out_idx=idx)
+    new_norm = resized_module(norm, {"num_groups": groups.numel(), "num_channels": idx.numel()})
+    if norm.affine:
+        new_norm.weight.copy_(norm.weight[idx])
+        new_norm.bias.copy_(norm.bias[idx])
+    resnet.norm2 = new_norm
+    resnet.conv2 = _sliced(resnet.conv2, in_idx=idx)
+    return norm.num_channels - idx.numel()
+
+
+def prune_structured(model: torch.nn.Module, amount: float = 0.25, block_ratios: Optional[Dict[str, float]] = None,
+                     norm: str = "l1", heads: bool = True, feedforward: bool = True, resnets: bool = True) -> dict:
+    """
+    Structured pruning of a UNet or CLIP text encoder, ranked by L1/L2 norm.
+    Modules are physically shrunk, so the result has fewer FLOPs and smaller
+    tensors; `structure_manifest` records the new shapes for loading.
+
+    Args:
+        model: UNet2DConditionModel or CLIPTextModel(WithProjection)
+        amount: Default fraction of heads / hidden units / channel groups to remove per module
+        block_ratios: Per-block overrides keyed by module-name prefix, e.g. {"mid_block": 0.0}
+        norm: "l1" or "l2"
+        heads, feedforward, resnets: Which structures to prune
+    """
+    removed = {"heads": 0, "ff_units": 0, "resnet_channels": 0}
+    for name, module in list(model.named_modules()):
+        ratio = _ratio(name, amount, block_ratios)
+        if ratio <= 0:
+            continue
+        if heads and isinstance(module, Attention):
+            removed["heads"] += prune_attention_heads(module, ratio, norm)
+        elif feedforward and isinstance(module, FeedForward) and hasattr(module.net[0], "proj"):
+            gated = type(module.net[0]).__name__ == "GEGLU"
+            pair = prune_mlp(module.net[0].proj, module.net[2], ratio, norm, gated)
+            if pair:
+                removed["ff_units"] += module.net[2].in_features - pair[1].in_features
+                module.net[0].proj, module.net[2] = pair
+        elif feedforward and type(module).__name__ == "CLIPMLP":
+            # CLIP attention reshapes its output to the residual width, so only the MLP is shrunk
+            pair = prune_mlp(module.fc1, module.fc2, ratio, norm)
+            if pair:
+                removed["ff_units"] += module.fc2.in_features - pair[1].in_features
+                module.fc1, module.fc2 = pair
+        elif resnets and isinstance(module, ResnetBlock2D):
+            removed["resnet_channels"] += prune_resnet_channels(module, ratio, norm)
+    return removed
+
+
+def empty_from_config(model: torch.nn.Module) -> torch.nn.Module:
+    """Meta-device instance of a model's class built from its config (as loaded, before any surgery)."""
+    with init_empty_weights():
+        if hasattr(type(model), "from_config"):  # diffusers ModelMixin
+            return type(model).from_config(model.config)
+        return type(model)(model.config)
+
+
+def structure_manifest(model: torch.nn.Module) -> dict:
+    """Module name -> shape, for every module whose shape differs from what the config builds."""
+    reference = dict(empty_from_config(model).named_modules())
+    manifest = {}
+    for name, module in model.named_modules():
+        shape = _shape(module)
+        if shape is not None and name in reference and _shape(reference[name]) != shape:
+            manifest[name] = shape
+    return manifest
+
+
+def apply_structure_manifest(model: torch.nn.Module, manifest: dict) -> torch.nn.Module:
+    """Resize a freshly built (meta) model in place so a structurally pruned state dict fits it."""
+    for name, shape in manifest.items():
+        module = model.get_submodule(name)
+        if isinstance(module, Attention):
+            module.inner_dim = module.inner_dim // module.heads * shape["heads"]
+            module.heads = shape["heads"]
+            module.sliceable_head_dim = shape["heads"]
+        else:
+            replace_module(model, name, resized_module(module, shape))
+    return model
@@ -1,69 +1,372 @@
 import torch
 import gc
 import psutil
+import threading
+import time
+import weakref
 from typing import Literal
 
+# Memory savers in the order the adaptive policy reaches for them: cheapest in
+# throughput first. Sequential offload is the last resort (and is sticky).
+SAVERS = ("vae_slicing", "vae_tiling", "cpu_offload", "attention_slicing", "sequential_offload")
+# Steps taken, in order, when a generation still runs out of memory
+OOM_LADDER = ("attention_slicing", "vae_tiling", "sequential_offload", "smaller_batch")
+
+
+def is_out_of_memory(error):
+    """CUDA OOM, CPU allocator failure, ONNX Runtime allocation failure or a plain MemoryError."""
+    if isinstance(error, (torch.cuda.OutOfMemoryError, MemoryError)):
+        return True
+    message = str(error).lower()
+    # ONNX Runtime raises its own exception classes (Fail, RuntimeException), not RuntimeError
+    if "failed to allocate memory" in message:
+        return True
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+
+def _offload_mode(savers):
+    return next((s for s in ("sequential_offload", "cpu_offload") if s in savers), None)
+
 class VRAMManager:
     def __init__(self, device: str = 'cuda'):
         self.device = device if torch.cuda.is_available() else 'cpu'
         self.vram_limit_gb = 7.5
         self.monitor_active = False
+        # Rough per-image working set of an SDXL fp16 forward pass with CFG
+        # (UNet activations + VAE decode), measured at 1024x1024.
+        self.bytes_per_pixel = 1200
+        self.safety_margin_gb = 1.0
+        # Split of that working set for the adaptive policy (fp16, per output pixel
+        # per image): UNet activations with CFG, and VAE decode, which peaks higher.
+        self.unet_bytes_per_pixel = 600
+        self.vae_bytes_per_pixel = 1200
+        # Fraction of UNet activations left with attention slicing on top of SDPA
+        self.attention_slicing_factor = 0.7
+        # Optimizations currently applied to each pipeline
+        self.applied = weakref.WeakKeyDictionary()
+        self.last_plan = None
+        # Memory hygiene: the caching allocator's pool is kept warm between
+        # requests and only released when one of these thresholds is crossed.
+        self.fragmentation_threshold = 0.25  # inactive split blocks / reserved
+        self.reserved_slack_gb = 4.0  # reserved but unallocated pool
+        self.min_reclaim_gb = 0.25  # below this, fragmentation is not worth a flush
+        self.pending_cleanup = None  # reason queued for the next check (e.g. "oom")
+        self.hygiene_lock = threading.Lock()
+        self.hygiene = {"checks": 0, "runs": 0, "reclaimed_bytes": 0, "seconds": 0.0, "reasons": {}, "last": None}
+
+    @staticmethod
+    def component_bytes(pipe):
+        """Weight bytes per pipeline component (modules only)."""
+        sizes = {}
+        for name, module in pipe.components.items():
+            if isinstance(module, torch.nn.Module):
+                tensors = list(module.parameters()) + list(module.buffers())
+                sizes[name] = sum(t.numel() * t.element_size() for t in tensors)
+        return sizes
 
-    def enable_all_optimizations(self, pipe):
+    def estimate_peak_bytes(self, pipe, width: int, height: int, batch_size: int = 1, savers=()):
         """
-        Apply all Diffusers built-in memory optimizations.
-        Crucial for running SDXL on 8GB VRAM.
+        Rough peak device memory of one generation with the given savers:
+        max over the UNet phase (resident weights + UNet activations) and the
+        VAE phase (resident weights + decode activations).
         """
-        print("Enabling VRAM optimizations...")
-        
-        # 1. Model CPU Offload:
-        # Offloads UNet and Text Encoders to CPU when not manually used.
-        # This is the most effective single optimization for low VRAM.
-        pipe.enable_model_cpu_offload()
-        
-        # 2. Sequential CPU Offload (Alternative to model_cpu_offload if strictly needed, 
-        # but model_cpu_offload is usually faster).
-        # pipe.enable_sequential_cpu_offload() 
-        
-        # 3. VAE Slicing:
-        # Processes VAE decoding in chunks.
-        pipe.enable_vae_slicing()
-        
-        # 4. VAE Tiling:
-        # Processes images in tiles during VAE encode/decode.
-        pipe.enable_vae_tiling()
-        
-        # 5. Attention Slicing (useful if standard attention is OOMing):
-        pipe.enable_attention_slicing(slice_size="max")
-        
-        # 6. xFormers (Memory efficient attention):
-        try:
-            pipe.enable_xformers_memory_efficient_attention()
-            print("xFormers enabled.")
-        except Exception as e:
-            print(f"Could not enable xFormers: {e}")
+        sizes = self.component_bytes(pipe)
+        unet = sizes.get("unet", 0)
+        vae = sizes.get("vae", 0)
+        if "sequential_offload" in savers:
+            # Only the layer being executed is resident
+            unet_resident = vae_resident = max(unet, vae) * 0.05
+        elif "cpu_offload" in savers:
+            unet_resident, vae_resident = unet, vae
+        else:
+            unet_resident = vae_resident = sum(sizes.values())
 
+        unet_module = getattr(pipe, "unet", None)
+        weight = next(unet_module.parameters(), None) if isinstance(unet_module, torch.nn.Module) else None
+        dtype_scale = weight.element_size() / 2 if weight is not None else 1.0
+        pixels = width * height
+        unet_act = batch_size * pixels * self.unet_bytes_per_pixel * dtype_scale
+        if "attention_slicing" in savers:
+            unet_act *= self.attention_slicing_factor
+        vae_pixels = pixels
+        if "vae_tiling" in savers:
+            tile = getattr(pipe.vae, "tile_sample_min_size", 512)
+            vae_pixels = min(pixels, tile * tile)
+        vae_images = 1 if "vae_slicing" in savers else batch_size
+        vae_act = vae_images * vae_pixels * self.vae_bytes_per_pixel * dtype_scale
+        return max(unet_resident + unet_act, vae_resident + vae_act)
+
+    def memory_budget_bytes(self, pipe=None):
+        """
+        Device memory a generation of `pipe` may use: free memory, plus what
+        the caching allocator holds unused, plus `pipe`'s own weights already
+        on the device (the estimate counts those), minus the safety margin.
+        Weights of other hot models stay unavailable.
+        """
+        own = 0
+        if pipe is not None:
+            for module in pipe.components.values():
+                if isinstance(module, torch.nn.Module):
+                    own += sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers())
+                               if t.device.type == self.device)
+        if self.device == 'cuda':
+            free, _ = torch.cuda.mem_get_info()
+            available = free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated() + own
+        else:
+            available = psutil.virtual_memory().available + own
+        return available - self.safety_margin_gb * 1024**3
+
+    def plan_optimizations(self, pipe, width: int = 1024, height: int = 1024, batch_size: int = 1, required=()):
+        """
+        Smallest set of memory savers whose estimated peak fits the current
+        memory budget. Savers are tried in SAVERS order and kept only if they
+        lower the estimate, then any that became redundant are dropped, so a
+        24GB card runs with none of them and an 8GB card gets offload and
+        slicing. Offload only exists on CUDA.
+
+        Args:
+            required: Savers to keep regardless of the estimate (e.g. after an OOM at this shape)
+
+        Returns:
+            {"savers": [...], "estimated_peak_gb", "budget_gb", "fits", "width", "height", "batch_size"}
+        """
+        budget = self.memory_budget_bytes(pipe)
+        candidates = [s for s in SAVERS if self.device == 'cuda' or s not in ("cpu_offload", "sequential_offload")]
+        # Sequential offload cannot be undone in place; once a pipeline has it, keep it
+        savers = ["sequential_offload"] if "sequential_offload" in self.applied.get(pipe, ()) else []
+        savers += [s for s in candidates if s in required and s not in savers]
+        peak = self.estimate_peak_bytes(pipe, width, height, batch_size, savers)
+        for saver in candidates:
+            if peak <= budget:
+                break
+            if saver in savers:
+                continue
+            estimate = self.estimate_peak_bytes(pipe, width, height, batch_size, savers + [saver])
+            if estimate < peak:
+                savers.append(saver)
+                peak = estimate
+        # Drop savers made redundant by later ones (e.g. VAE tiling once offload frees the UNet)
+        for saver in reversed(list(savers)):
+            if saver == "sequential_offload" or saver in required or peak > budget:
+                continue
+            rest = [s for s in savers if s != saver]
+            estimate = self.estimate_peak_bytes(pipe, width, height, batch_size, rest)
+            if estimate <= budget:
+                savers, peak = rest, estimate
+
+        plan = {
+            "savers": [s for s in SAVERS if s in savers],
+            "estimated_peak_gb": round(peak / 1024**3, 2),
+            "budget_gb": round(budget / 1024**3, 2),
+            "fits": peak <= budget,
+            "width": width,
+            "height": height,
+            "batch_size": batch_size,
+        }
+        self.last_plan = plan
+        return plan
+
+    def apply_optimizations(self, pipe, plan, force=False):
+        """
+        Switch `pipe` to the savers in `plan`, touching only what changed
+        (offload hooks are only rebuilt when the offload mode changes).
+
+        Args:
+            force: Re-apply everything, e.g. after the pipeline was moved or re-hooked elsewhere
+        """
+        wanted = set(plan["savers"])
+        previous = self.applied.get(pipe)
+        if previous is None:
+            force = True
+        elif previous == wanted and not force:
+            return pipe
+        if previous != wanted:
+            print(f"VRAM plan for {plan['width']}x{plan['height']} x{plan['batch_size']}: "
+                  f"{', '.join(plan['savers']) or 'no savers'} (est. {plan['estimated_peak_gb']} GB "
+                  f"of {plan['budget_gb']} GB budget)")
+        current = set() if force else previous
+
+        if force or _offload_mode(wanted) != _offload_mode(current):
+            if "sequential_offload" not in current:
+                pipe.remove_all_hooks()
+            if _offload_mode(wanted) == "sequential_offload":
+                if "sequential_offload" not in current:
+                    pipe.enable_sequential_cpu_offload()
+            elif _offload_mode(wanted) == "cpu_offload":
+                pipe.enable_model_cpu_offload()
+            else:
+                pipe.to(self.device)
+
+        def changed(saver):
+            return force or (saver in wanted) != (saver in current)
+
+        if changed("vae_slicing"):
+            if "vae_slicing" in wanted:
+                pipe.vae.enable_slicing()
+            else:
+                pipe.vae.disable_slicing()
+        if changed("vae_tiling"):
+            if "vae_tiling" in wanted:
+                pipe.vae.enable_tiling()
+            else:
+                pipe.vae.disable_tiling()
+        if changed("attention_slicing"):
+            if "attention_slicing" in wanted:
+                pipe.enable_attention_slicing(slice_size="max")
+            else:
+                pipe.disable_attention_slicing()
+
+        self.applied[pipe] = wanted
         return pipe
 
-    def pre_generation_cleanup(self):
+    def adapt(self, pipe, width: int = 1024, height: int = 1024, batch_size: int = 1, force=False, required=()):
+        """Plan for this request's shape and apply the result."""
+        plan = self.plan_optimizations(pipe, width, height, batch_size, required)
+        self.apply_optimizations(pipe, plan, force=force)
+        return plan
+
+    def degrade(self, pipe, fallback, batch_size: int, offload=True, savers=True):
         """
-        Aggressive cleanup before a new generation.
+        Move `fallback` ({"savers": [...], "max_batch_size": int or None}) one
+        step down OOM_LADDER after an out-of-memory error. Savers the pipeline
+        already runs with are skipped since retrying with them changes nothing;
+        the batch is halved until it is a single image. With `savers=False`
+        (pipelines without torch modules, e.g. ONNX) only the batch is halved.
+
+        Returns:
+            The step taken, or None once the ladder is exhausted
         """
-        if self.device == 'cpu': pass
-        
-        print("Cleaning VRAM before generation...")
+        active = self.applied.get(pipe, set())
+        for step in OOM_LADDER:
+            if step == "smaller_batch":
+                size = min(fallback["max_batch_size"] or batch_size, batch_size)
+                if size > 1:
+                    fallback["max_batch_size"] = size // 2
+                    return step
+            elif savers and step not in fallback["savers"] and step not in active:
+                if step == "sequential_offload" and (self.device != 'cuda' or not offload):
+                    continue
+                fallback["savers"].append(step)
+                return step
+        return None
+
+    def cleanup_reason(self):
+        """
+        Why the allocator should be flushed right now, or None to keep the pool warm.
+        """
+        if self.pending_cleanup:
+            return self.pending_cleanup
+        if self.device == 'cuda':
+            reserved = torch.cuda.memory_reserved()
+            if not reserved:
+                return None
+            slack = reserved - torch.cuda.memory_allocated()
+            inactive = torch.cuda.memory_stats().get("inactive_split_bytes.all.current", 0)
+            if inactive >= self.min_reclaim_gb * 1024**3 and inactive / reserved > self.fragmentation_threshold:
+                return "fragmentation"
+            if slack > self.reserved_slack_gb * 1024**3:
+                return "reserved_slack"
+            if self.free_memory_bytes() + slack < self.safety_margin_gb * 1024**3:
+                return "low_memory"
+            return None
+        if psutil.virtual_memory().available < self.safety_margin_gb * 1024**3:
+            return "low_memory"
+        return None
+
+    def _in_use_bytes(self):
+        if self.device == 'cuda':
+            return torch.cuda.memory_reserved()
+        return psutil.Process().memory_info().rss
+
+    def cleanup(self, reason: str = "manual"):
+        """
+        Collect garbage and return cached blocks to the driver, recording how
+        much was reclaimed. Use sparingly: the warm pool is lost.
+        """
+        start = time.perf_counter()
+        before = self._in_use_bytes()
         gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
-    
+        if self.device == 'cuda':
+            torch.cuda.empty_cache()
+            torch.cuda.ipc_collect()
+        reclaimed = max(0, before - self._in_use_bytes())
+        seconds = time.perf_counter() - start
+        with self.hygiene_lock:
+            self.pending_cleanup = None
+            stats = self.hygiene
+            stats["runs"] += 1
+            stats["reclaimed_bytes"] += reclaimed
+            stats["seconds"] += seconds
+            stats["reasons"][reason] = stats["reasons"].get(reason, 0) + 1
+            stats["last"] = {"reason": reason, "reclaimed_bytes": reclaimed, "seconds": round(seconds, 4)}
+        print(f"Memory cleanup ({reason}): reclaimed {reclaimed / 1024**2:.0f} MB in {seconds * 1000:.0f} ms")
+        return reclaimed
+
+    def maybe_cleanup(self):
+        """Run cleanup only if a threshold is crossed. Returns the reason, or None."""
+        with self.hygiene_lock:
+            self.hygiene["checks"] += 1
+        reason = self.cleanup_reason()
+        if reason:
+            self.cleanup(reason)
+        return reason
+
+    def recover_from_oom(self):
+        """Flush now after an out-of-memory error, and again before the next generation."""
+        self.cleanup("oom")
+        self.pending_cleanup = "oom"
+
+    def hygiene_stats(self):
+        with self.hygiene_lock:
+            stats = dict(self.hygiene, reasons=dict(self.hygiene["reasons"]))
+        stats["seconds"] = round(stats["seconds"], 4)
+        return stats
+
+    def pre_generation_cleanup(self):
+        """
+        Cleanup before a new generation, only when thresholds call for it.
+        """
+        return self.maybe_cleanup()
+
     def post_generation_cleanup(self):
         """
-        Cleanup after generation to release peaks.
+        Cleanup after generation, only when thresholds call for it.
         """
-        if self.device == 'cpu': pass
-        
-        gc.collect()
-        torch.cuda.empty_cache()
+        return self.maybe_cleanup()
+
+    def free_memory_bytes(self):
+        """
+        Memory currently available for new activations on the compute device.
+        """
+        if self.device == 'cuda':
+            free, _ = torch.cuda.mem_get_info()
+            return free
+        return psutil.virtual_memory().available
+
+    def max_batch_size(self, width: int, height: int, limit: int = 8, pipe=None):
+        """
+        Largest batch that fits in the current memory budget at this resolution.
+        With `pipe`, each batch size is checked with estimate_peak_bytes against
+        memory_budget_bytes, with the savers the pipeline currently runs with.
+        Without it, a flat per-pixel working set is compared with the headroom.
+        Memory the caching allocator holds unused counts as available either way,
+        so a warm pool left by an earlier large batch does not shrink the limit.
+        Always returns at least 1 so a single request is never refused here.
+        """
+        if pipe is not None:
+            budget = self.memory_budget_bytes(pipe)
+            savers = self.applied.get(pipe, ())
+            size = 1
+            while size < limit and self.estimate_peak_bytes(pipe, width, height, size + 1, savers) <= budget:
+                size += 1
+            return size
+        headroom = self.free_memory_bytes() - self.safety_margin_gb * 1024**3
+        if self.device == 'cuda':
+            headroom += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+        per_image = width * height * self.bytes_per_pixel
+        if headroom <= per_image:
+            return 1
+        return max(1, min(limit, int(headroom // per_image)))
 
     def check_memory_status(self):
         """
@@ -87,7 +390,7 @@ class VRAMManager:
         current_usage = self.check_memory_status()
         if current_usage > self.vram_limit_gb:
             print(f"WARNING: VRAM usage ({current_usage:.2f} GB) exceeds limit ({self.vram_limit_gb} GB)")
-            self.post_generation_cleanup()
+            self.cleanup("over_limit")
 
 if __name__ == "__main__":
     vram = VRAMManager()
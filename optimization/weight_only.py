@@ -0,0 +1,289 @@
+import math
+from typing import Callable, Dict, Iterable, Optional
+
+import torch
+import torch.nn.functional as F
+
+from optimization.structured import replace_module
+
+QMAX = {8: 127, 4: 7}
+
+
+def quantize_weight(weight: torch.Tensor, bits: int = 8, group_size: Optional[int] = None):
+    """
+    Symmetric weight-only quantization of an (out, ...) weight, flattened to
+    (out, K). Each row is split into groups of `group_size` along K (the whole
+    row if None) with one scale per group. INT4 values are packed two per byte.
+
+    Returns:
+        qweight: int8 (out, K_padded) for 8 bits, uint8 (out, K_padded / 2) for 4 bits
+        scales: float16 (out, n_groups)
+    """
+    if bits not in QMAX:
+        raise ValueError(f"Unsupported bit width {bits}; use 8 or 4")
+    w = weight.detach().float().reshape(weight.shape[0], -1)
+    k = w.shape[1]
+    group = group_size or k
+    padded = math.ceil(k / group) * group
+    if bits == 4 and padded % 2:
+        padded += group
+    w = F.pad(w, (0, padded - k)).view(w.shape[0], -1, group)
+
+    scales = (w.abs().amax(dim=-1, keepdim=True) / QMAX[bits]).clamp(min=1e-8)
+    # Round the scale to its stored precision first so quantization and dequantization agree
+    scales = scales.half().float()
+    q = (w / scales).round().clamp(-QMAX[bits], QMAX[bits]).to(torch.int8).view(w.shape[0], padded)
+    if bits == 4:
+        nibbles = (q + 8).to(torch.uint8)
+        q = nibbles[:, 0::2] | (nibbles[:, 1::2] << 4)
+    return q.contiguous(), scales.squeeze(-1).half().contiguous()
+
+
+def unpack_int4(packed: torch.Tensor) -> torch.Tensor:
+    low = (packed & 0xF).to(torch.int8) - 8
+    high = (packed >> 4).to(torch.int8) - 8
+    return torch.stack([low, high], dim=-1).flatten(1)
+
+
+def dequantize_weight(qweight: torch.Tensor, scales: torch.Tensor, bits: int, shape, dtype=torch.float16):
+    """Inverse of quantize_weight, producing a dense weight of `shape` in `dtype`."""
+    q = unpack_int4(qweight) if bits == 4 else qweight
+    out = q.shape[0]
+    w = q.view(out, scales.shape[1], -1).to(dtype) * scales.to(dtype).unsqueeze(-1)
+    k = math.prod(shape[1:])
+    return w.view(out, -1)[:, :k].reshape(shape)
+
+
+def linear_weight_only_reference(x: torch.Tensor, qweight: torch.Tensor, scales: torch.Tensor, bits: int,
+                                 in_features: int, bias: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    CPU reference kernel: integer weights times activations per group, with
+    the group scale applied to each partial sum (as a fused GPU kernel does),
+    accumulated in fp32. For correctness checks against WeightOnlyLinear.
+    """
+    q = (unpack_int4(qweight) if bits == 4 else qweight).float()
+    n_groups = scales.shape[1]
+    group = q.shape[1] // n_groups
+    x = F.pad(x.float(), (0, q.shape[1] - in_features))
+    x_groups = x.reshape(*x.shape[:-1], n_groups, group)
+    q_groups = q.view(q.shape[0], n_groups, group)
+    partial = torch.einsum("...gk,ogk->...og", x_groups, q_groups)
+    y = (partial * scales.float()).sum(dim=-1)
+    return y + bias.float() if bias is not None else y
+
+
+class WeightOnlyLinear(torch.nn.Module):
+    """
+    Linear layer storing INT8 or grouped INT4 weights as buffers. The weight is
+    dequantized to the activation dtype (fp16 on GPU) right before a regular
+    matmul, so only one layer's dense weight exists at a time. Buffers move
+    with .to(), so model CPU offload transfers the compressed weights.
+    """
+
+    def __init__(self, in_features: int, out_features: int, bits: int = 8, group_size: Optional[int] = None,
+                 bias: bool = True, device=None, dtype=torch.float16):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        self.weight_shape = (out_features, in_features)
+        self._register_quantized(bias, device, dtype)
+
+    def _register_quantized(self, bias, device, dtype):
+        k = math.prod(self.weight_shape[1:])
+        group = self.group_size or k
+        padded = math.ceil(k / group) * group
+        if self.bits == 4 and padded % 2:
+            padded += group
+        columns = padded // 2 if self.bits == 4 else padded
+        qdtype = torch.uint8 if self.bits == 4 else torch.int8
+        self.register_buffer("qweight", torch.empty(self.weight_shape[0], columns, dtype=qdtype, device=device))
+        self.register_buffer("scales", torch.empty(self.weight_shape[0], padded // group, dtype=torch.float16, device=device))
+        self.register_buffer("bias", torch.empty(self.weight_shape[0], dtype=dtype, device=device) if bias else None)
+
+    @torch.no_grad()
+    def _load_from(self, module: torch.nn.Module):
+        qweight, scales = quantize_weight(module.weight, self.bits, self.group_size)
+        self.qweight.copy_(qweight)
+        self.scales.copy_(scales)
+        if module.bias is not None:
+            self.bias.copy_(module.bias)
+        return self
+
+    @classmethod
+    def from_float(cls, linear: torch.nn.Linear, bits: int = 8, group_size: Optional[int] = None):
+        return cls(linear.in_features, linear.out_features, bits, group_size, linear.bias is not None,
+                   device=linear.weight.device, dtype=linear.weight.dtype)._load_from(linear)
+
+    def dequantize(self, dtype=torch.float16) -> torch.Tensor:
+        return dequantize_weight(self.qweight, self.scales, self.bits, self.weight_shape, dtype)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return F.linear(x, self.dequantize(x.dtype), bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}, group_size={self.group_size}"
+
+
+class WeightOnlyConv2d(WeightOnlyLinear):
+    """Conv2d counterpart of WeightOnlyLinear; groups along in_channels * kh * kw."""
+
+    def __init__(self, in_channels: int, out_channels: int, kernel_size, stride=1, padding=0, dilation=1, groups=1,
+                 bits: int = 8, group_size: Optional[int] = None, bias: bool = True, device=None, dtype=torch.float16):
+        torch.nn.Module.__init__(self)
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.kernel_size = tuple(torch.nn.modules.utils._pair(kernel_size))
+        self.stride = stride
+        self.padding = padding
+        self.dilation = dilation
+        self.groups = groups
+        self.bits = bits
+        self.group_size = group_size
+        self.weight_shape = (out_channels, in_channels // groups, *self.kernel_size)
+        self._register_quantized(bias, device, dtype)
+
+    @classmethod
+    def from_float(cls, conv: torch.nn.Conv2d, bits: int = 8, group_size: Optional[int] = None):
+        return cls(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, conv.dilation,
+                   conv.groups, bits, group_size, conv.bias is not None,
+                   device=conv.weight.device, dtype=conv.weight.dtype)._load_from(conv)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return F.conv2d(x, self.dequantize(x.dtype), bias, self.stride, self.padding, self.dilation, self.groups)
+
+    def extra_repr(self):
+        return (f"{self.in_channels}, {self.out_channels}, kernel_size={self.kernel_size}, stride={self.stride}, "
+                f"bits={self.bits}, group_size={self.group_size}")
+
+
+def module_config(module: WeightOnlyLinear) -> dict:
+    """Constructor arguments of a weight-only module, for the checkpoint layout."""
+    config = {"bits": module.bits, "group_size": module.group_size, "bias": module.bias is not None}
+    if isinstance(module, WeightOnlyConv2d):
+        config.update(kind="conv2d", in_channels=module.in_channels, out_channels=module.out_channels,
+                      kernel_size=list(module.kernel_size), stride=module.stride, padding=module.padding,
+                      dilation=module.dilation, groups=module.groups)
+    else:
+        config.update(kind="linear", in_features=module.in_features, out_features=module.out_features)
+    return config
+
+
+def module_from_config(config: dict, device=None, dtype=torch.float16) -> WeightOnlyLinear:
+    """Empty weight-only module matching `module_config`, buffers left uninitialized."""
+    args = {k: (tuple(v) if isinstance(v, list) else v) for k, v in config.items() if k != "kind"}
+    cls = WeightOnlyConv2d if config["kind"] == "conv2d" else WeightOnlyLinear
+    return cls(**args, device=device, dtype=dtype)
+
+
+def quantizable_layers(model: torch.nn.Module, include_conv: bool = True, min_features: int = 64,
+                       skip: Iterable[str] = ()):
+    """(name, module) of the full-precision Linear / Conv2d layers worth quantizing."""
+    skip = set(skip or ())
+    for name, module in model.named_modules():
+        if name in skip:
+            continue
+        if type(module) is torch.nn.Linear and min(module.in_features, module.out_features) >= min_features:
+            yield name, module
+        elif (include_conv and type(module) is torch.nn.Conv2d and module.padding_mode == "zeros"
+              and min(module.in_channels, module.out_channels) >= min_features):
+            yield name, module
+
+
+def quantize_weight_only(model: torch.nn.Module, bits: int = 8, group_size: Optional[int] = None,
+                         include_conv: bool = True, min_features: int = 64, skip: Iterable[str] = ()) -> int:
+    """
+    Replace Linear (and Conv2d) layers with weight-only INT8/INT4 modules.
+
+    Args:
+        bits: 8 (per-channel by default) or 4
+        group_size: Weights per scale along the input dim; 128 is a good default for INT4
+        include_conv: Also quantize Conv2d layers
+        min_features: Leave layers narrower than this in full precision
+        skip: Module names to leave in full precision (e.g. from calibrate_weight_only)
+    Returns:
+        Number of layers replaced
+    """
+    count = 0
+    for name, module in list(quantizable_layers(model, include_conv, min_features, skip)):
+        cls = WeightOnlyConv2d if isinstance(module, torch.nn.Conv2d) else WeightOnlyLinear
+        replace_module(model, name, cls.from_float(module, bits, group_size))
+        count += 1
+    return count
+
+
+def quantize_layers(model: torch.nn.Module, bits_by_layer: Dict[str, int], group_size: Optional[int] = None) -> int:
+    """Quantize specific layers, each to its own bit width (e.g. from a mixed-precision plan)."""
+    for name, bits in bits_by_layer.items():
+        module = model.get_submodule(name)
+        cls = WeightOnlyConv2d if isinstance(module, torch.nn.Conv2d) else WeightOnlyLinear
+        replace_module(model, name, cls.from_float(module, bits, group_size if bits == 4 else None))
+    return len(bits_by_layer)
+
+
+@torch.no_grad()
+def calibrate_weight_only(model: torch.nn.Module, run: Callable[[], None], bits: int = 8,
+                          group_size: Optional[int] = None, include_conv: bool = True,
+                          min_features: int = 64) -> Dict[str, dict]:
+    """
+    Accuracy of weight-only quantization per layer against the unquantized
+    model. `run()` drives the model on calibration inputs (e.g. a short
+    generation); forward hooks compare every target layer's output with the
+    output it would produce from quantize-dequantized weights.
+
+    Returns:
+        layer name -> {"rel_error": ||y_q - y|| / ||y||, "sqnr_db": ..., "calls": n}
+    """
+    report = {}
+    handles = []
+
+    def hook(name, module):
+        def fn(_, inputs, output):
+            x = inputs[0]
+            # Built per call and dropped right after, so only one layer's copy is ever alive
+            qweight, scales = quantize_weight(module.weight, bits, group_size)
+            dequantized = dequantize_weight(qweight, scales, bits, module.weight.shape, module.weight.dtype).to(x.dtype)
+            del qweight, scales
+            if isinstance(module, torch.nn.Conv2d):
+                approx = F.conv2d(x, dequantized, module.bias, module.stride, module.padding,
+                                  module.dilation, module.groups)
+            else:
+                approx = F.linear(x, dequantized, module.bias)
+            del dequantized
+            signal = output.float().pow(2).sum().item()
+            noise = (approx.float() - output.float()).pow(2).sum().item()
+            entry = report.setdefault(name, {"signal": 0.0, "noise": 0.0, "calls": 0})
+            entry["signal"] += signal
+            entry["noise"] += noise
+            entry["calls"] += 1
+        return fn
+
+    for name, module in quantizable_layers(model, include_conv, min_features):
+        handles.append(module.register_forward_hook(hook(name, module)))
+    try:
+        run()
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    for entry in report.values():
+        signal, noise = entry.pop("signal"), entry.pop("noise")
+        entry["rel_error"] = math.sqrt(noise / signal) if signal > 0 else 0.0
+        entry["sqnr_db"] = 10 * math.log10(signal / noise) if noise > 0 else float("inf")
+    return report
+
+
+def summarize_report(report: Dict[str, dict], worst: int = 5) -> dict:
+    """Mean / max relative error and the worst layers of a calibration report."""
+    if not report:
+        return {"layers": 0}
+    errors = sorted(((entry["rel_error"], name) for name, entry in report.items()), reverse=True)
+    return {
+        "layers": len(report),
+        "mean_rel_error": sum(e for e, _ in errors) / len(errors),
+        "max_rel_error": errors[0][0],
+        "worst": [{"layer": name, "rel_error": e} for e, name in errors[:worst]],
+    }
@@ -1,3 +1,78 @@
-# Benchmark
-if __name__ == "__main__":
+import argparse
+import os
+import sys
+
+import torch
+
+# Benchmark suite: runs a matrix of generation settings and optionally diffs the
+# results against a stored baseline (exit code 1 on regression).
+#
+#   python scripts/benchmark.py --tiny --output benchmarks/cpu.json
+#   python scripts/benchmark.py --tiny --baseline benchmarks/cpu.json
+#   python scripts/benchmark.py --model models/pruned_sdxl --resolutions 1024 --steps 20 \
+#       --optimizations baseline vae_tiling attention_slicing+vae_slicing
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from optimization.benchmark import (OPTIMIZATIONS, SCHEDULERS, benchmark_matrix, build_tiny_pipeline,
+                                    compare_to_baseline, load_results, save_results, summarize_diff)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Prune Juice generation benchmarks")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--tiny", action="store_true",
+                        help="Randomly initialized SDXL-shaped pipeline (default when --model is not given)")
+    source.add_argument("--model", help="Diffusers SDXL model directory or HuggingFace id")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--resolutions", type=int, nargs="+", help="Square sizes (default 64 128 tiny, 1024 model)")
+    parser.add_argument("--steps", type=int, nargs="+", default=[4, 20])
+    parser.add_argument("--schedulers", nargs="+", default=["Euler"], choices=sorted(SCHEDULERS))
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1])
+    parser.add_argument("--optimizations", nargs="+", default=["baseline"],
+                        help=f"Toggle sets joined with '+', or 'baseline'. Toggles: {', '.join(OPTIMIZATIONS)}")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--output", help="Write results JSON here")
+    parser.add_argument("--baseline", help="Compare against this results JSON; exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Relative latency/it/s change allowed")
+    parser.add_argument("--memory-tolerance", type=float, default=0.05, help="Relative peak memory change allowed")
+    return parser.parse_args(argv)
+
+
+def load_pipeline(args):
+    if not args.model:
+        print("Using tiny random SDXL-shaped pipeline.")
+        return build_tiny_pipeline()
+    from diffusers import StableDiffusionXLPipeline
+    from optimization.model_io import custom_components, load_custom_pipeline
+    dtype = torch.float16 if args.device.startswith("cuda") else torch.float32
+    print(f"Loading {args.model}...")
+    if custom_components(args.model):
+        return load_custom_pipeline(StableDiffusionXLPipeline, args.model, torch_dtype=dtype)
+    return StableDiffusionXLPipeline.from_pretrained(args.model, torch_dtype=dtype, use_safetensors=True)
+
+
+def main(argv=None):
+    args = parse_args(argv)
     print("Running Benchmarks...")
+    pipe = load_pipeline(args)
+    resolutions = args.resolutions or ([1024] if args.model else [64, 128])
+    optimizations = [() if spec == "baseline" else tuple(spec.split("+")) for spec in args.optimizations]
+
+    results = benchmark_matrix(pipe, args.device, resolutions, args.steps, args.schedulers, args.batch_sizes,
+                               optimizations, args.warmup, args.trials)
+    results["model"] = args.model or "tiny"
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        save_results(results, args.output)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        diff = compare_to_baseline(results, load_results(args.baseline), args.tolerance, args.memory_tolerance)
+        print(summarize_diff(diff))
+        if diff["regressions"]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,77 +1,384 @@
 import os
-import requests
+import re
+import json
+import time
 import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
 from tqdm import tqdm
 import sys
 
+CHUNK_SIZE = 1024 * 1024  # bytes per file read when hashing
+NETWORK_CHUNK_SIZE = 64 * 1024  # bytes per socket read; at most this much is lost when a connection drops
+MIN_SEGMENT_SIZE = 64 * 1024 * 1024  # files smaller than this are fetched in one stream
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class DownloadError(Exception):
+    pass
+
+
+def remote_info(url, timeout=30):
+    """
+    Size, range support and validator of `url`. HuggingFace serves LFS files
+    with their SHA-256 as the ETag (X-Linked-Etag before the CDN redirect),
+    which is used when the manifest has no hash of its own.
+    """
+    response = requests.head(url, allow_redirects=False, timeout=timeout)
+    linked_etag = response.headers.get("X-Linked-Etag")
+    if response.is_redirect:
+        response = requests.head(url, allow_redirects=True, timeout=timeout)
+    response.raise_for_status()
+    etag = (linked_etag or response.headers.get("ETag") or "").strip('"').removeprefix("W/").strip('"')
+    size = response.headers.get("Content-Length")
+    return {
+        "size": int(size) if size is not None else None,
+        "ranges": response.headers.get("Accept-Ranges", "").lower() == "bytes",
+        "etag": etag or None,
+        "sha256": etag.lower() if SHA256_RE.match(etag.lower()) else None,
+    }
+
+
+def plan_segments(size, segments, min_segment_size=MIN_SEGMENT_SIZE):
+    """[start, end) byte ranges splitting `size` into at most `segments` parts."""
+    count = max(1, min(segments, size // max(1, min_segment_size)))
+    step = -(-size // count)
+    return [[start, min(size, start + step), 0] for start in range(0, size, step)] or [[0, 0, 0]]
+
+
+class HashFollower:
+    """
+    SHA-256 of a file being written by several range segments at once.
+
+    The digest can only be built in file order. A chunk that extends the
+    hashed prefix is hashed straight from memory; bytes of later segments are
+    hashed from the (page-cached) file as soon as the prefix reaches them,
+    on a background thread, so verification finishes with the download
+    instead of needing a second pass over the file.
+    """
+
+    def __init__(self, path, segments):
+        self.path = path
+        self.segments = segments  # shared [start, end, done] lists, updated through feed()
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+        self.reading = False
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="hash-follower", daemon=True)
+        self.thread.start()
+
+    def feed(self, segment, data):
+        """Record that `data` was written at the end of `segment`'s downloaded part."""
+        with self.cond:
+            offset = segment[0] + segment[2]
+            if offset == self.hashed and not self.reading:
+                self.hasher.update(data)
+                self.hashed += len(data)
+            segment[2] += len(data)
+            self.cond.notify_all()
+
+    def _available(self):
+        """End of the contiguous downloaded range starting at the hashed prefix."""
+        for start, end, done in self.segments:
+            if start <= self.hashed < end or (start == self.hashed == end):
+                return start + done
+        return self.hashed
+
+    def _run(self):
+        # Unbuffered: a buffered reader would serve read-ahead bytes from before they were written
+        with open(self.path, "rb", buffering=0) as f:
+            while True:
+                with self.cond:
+                    while self._available() <= self.hashed and not self.closed:
+                        self.cond.wait()
+                    target = self._available()
+                    if target <= self.hashed:
+                        return
+                    self.reading = True
+                    start = self.hashed
+                f.seek(start)
+                remaining = target - start
+                while remaining:
+                    block = f.read(min(CHUNK_SIZE, remaining))
+                    if not block:
+                        break
+                    self.hasher.update(block)
+                    remaining -= len(block)
+                with self.cond:
+                    self.hashed = target - remaining
+                    self.reading = False
+                    self.cond.notify_all()
+
+    def close(self):
+        """Stop following (the download failed; the digest is not needed)."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def hexdigest(self, size):
+        """Wait until `size` bytes are hashed and return the digest."""
+        with self.cond:
+            while self.hashed < size and (self.reading or self._available() > self.hashed):
+                self.cond.wait()
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        if self.hashed != size:
+            raise DownloadError(f"hashed {self.hashed} of {size} bytes")
+        return self.hasher.hexdigest()
+
+
 class ModelDownloader:
-    def __init__(self, model_dir='models'):
+    def __init__(self, model_dir='models', parallel_files=2, segments=8, min_segment_size=MIN_SEGMENT_SIZE,
+                 retries=5, timeout=60):
+        """
+        Args:
+            parallel_files: Manifest entries downloaded at the same time
+            segments: Parallel HTTP range requests per large file
+            min_segment_size: Files are only split into segments of at least this size
+            retries: Attempts per segment after a dropped connection (resuming where it stopped)
+            timeout: Socket timeout per request, in seconds
+        """
         self.model_dir = model_dir
+        self.parallel_files = parallel_files
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.retries = retries
+        self.timeout = timeout
         if not os.path.exists(self.model_dir):
             os.makedirs(self.model_dir)
 
         # Manifest of models to download
-        # Using ByteDance's SDXL Lightning as the base for "optimized" behavior out of box if pruning isn't run yet
+        # Using ByteDance's SDXL Lightning as the base for "optimized" behavior out of box if pruning isn't run yet.
+        # sha256=None: use the SHA-256 HuggingFace reports for the LFS file.
         self.manifest = {
             "sdxl_lightning": {
                 "url": "https://huggingface.co/ByteDance/SDXL-Lightning/resolve/main/sdxl_lightning_4step_unet.safetensors",
                 "filename": "sdxl_lightning_4step_unet.safetensors",
-                "sha256": "placeholder_hash_for_now", # In prod, put real hash
+                "sha256": None,
                 "required": True
             },
             "sdxl_vae": {
                 "url": "https://huggingface.co/madebyollin/sdxl-vae-fp16-fix/resolve/main/diffusion_pytorch_model.safetensors",
                 "filename": "sdxl_vae.safetensors",
-                "sha256": "placeholder_hash_vae",
+                "sha256": None,
                 "required": True
             }
         }
 
+    @staticmethod
+    def _record_path(filepath):
+        return filepath + ".sha256.json"
+
     def verify_file(self, filepath, expected_hash):
-        if expected_hash.startswith("placeholder"): return True
-        
+        """
+        Check a finished file against `expected_hash`. A record written after
+        a verified download (size, mtime, digest) avoids re-reading multi-GB
+        files on every run; otherwise the file is hashed once.
+        """
+        stat = os.stat(filepath)
+        try:
+            with open(self._record_path(filepath)) as f:
+                record = json.load(f)
+            if record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns:
+                return expected_hash is None or record["sha256"] == expected_hash
+        except (OSError, ValueError, KeyError):
+            pass
+        if expected_hash is None:
+            return True
+
         print(f"Verifying {os.path.basename(filepath)}...")
         sha256_hash = hashlib.sha256()
         with open(filepath, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
+            for byte_block in iter(lambda: f.read(CHUNK_SIZE), b""):
                 sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest() == expected_hash
+        digest = sha256_hash.hexdigest()
+        if digest == expected_hash:
+            self._write_record(filepath, digest)
+        return digest == expected_hash
 
-    def download_file(self, url, filename, expected_hash):
+    def _write_record(self, filepath, digest):
+        stat = os.stat(filepath)
+        with open(self._record_path(filepath), "w") as f:
+            json.dump({"sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}, f)
+
+    def _load_state(self, state_path, info):
+        """Segments of an interrupted download of the same remote file, or None."""
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get("size") != info["size"] or state.get("etag") != info["etag"]:
+            return None
+        return state["segments"]
+
+    def _save_state(self, state_path, info, segments, lock):
+        with lock:
+            state = {"size": info["size"], "etag": info["etag"], "segments": [list(s) for s in segments]}
+        tmp_path = state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+    def _fetch_segment(self, url, part_path, segment, follower, progress, on_chunk):
+        """Download one [start, end) range, resuming from what it already has after a drop."""
+        for attempt in range(self.retries + 1):
+            start, end, done = segment
+            if start + done >= end:
+                return
+            headers = {"Range": f"bytes={start + done}-{end - 1}"}
+            try:
+                with requests.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    if response.status_code != 206:
+                        raise DownloadError(f"server ignored the range request (HTTP {response.status_code})")
+                    with open(part_path, "r+b") as f:
+                        f.seek(start + done)
+                        for data in response.iter_content(NETWORK_CHUNK_SIZE):
+                            data = data[:end - (segment[0] + segment[2])]
+                            if not data:
+                                break
+                            f.write(data)
+                            # Flushed before it counts, so the saved state never runs ahead of the file
+                            f.flush()
+                            follower.feed(segment, data)
+                            progress.update(len(data))
+                            on_chunk()
+                if segment[0] + segment[2] < end:
+                    raise DownloadError("connection closed early")
+                return
+            except (requests.RequestException, DownloadError) as e:
+                if attempt == self.retries:
+                    raise DownloadError(f"bytes {start}-{end - 1}: {e}") from e
+                time.sleep(min(30, 2 ** attempt))
+
+    def _download_ranges(self, url, filepath, info, position=0):
+        """Parallel range download into `<file>.part`, resumable through `<file>.part.json`."""
+        part_path = filepath + ".part"
+        state_path = part_path + ".json"
+        segments = self._load_state(state_path, info) if os.path.exists(part_path) else None
+        if segments is None:
+            segments = plan_segments(info["size"], self.segments, self.min_segment_size)
+            with open(part_path, "wb") as f:
+                f.truncate(info["size"])
+        resumed = sum(s[2] for s in segments)
+        if resumed:
+            print(f"↩️ Resuming {os.path.basename(filepath)} at {resumed / 1024**2:.0f} MiB")
+
+        lock = threading.Lock()
+        follower = HashFollower(part_path, segments)
+        progress = tqdm(total=info["size"], initial=resumed, unit='iB', unit_scale=True,
+                        desc=os.path.basename(filepath), position=position)
+        last_save = [time.monotonic()]
+
+        def on_chunk():
+            # Persist progress about once a second
+            if time.monotonic() - last_save[0] >= 1.0:
+                last_save[0] = time.monotonic()
+                self._save_state(state_path, info, segments, lock)
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+                futures = [pool.submit(self._fetch_segment, url, part_path, segment, follower, progress, on_chunk)
+                           for segment in segments]
+                for future in as_completed(futures):
+                    future.result()
+        except BaseException:
+            follower.close()
+            raise
+        finally:
+            progress.close()
+            self._save_state(state_path, info, segments, lock)
+        digest = follower.hexdigest(info["size"])
+        return part_path, state_path, digest
+
+    def _download_stream(self, url, filepath, position=0):
+        """Single stream for servers without range support or a known size (not resumable)."""
+        part_path = filepath + ".part"
+        sha256_hash = hashlib.sha256()
+        with requests.get(url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            total = int(response.headers.get('content-length', 0))
+            progress = tqdm(total=total, unit='iB', unit_scale=True, desc=os.path.basename(filepath), position=position)
+            received = 0
+            with open(part_path, 'wb') as file:
+                for data in response.iter_content(NETWORK_CHUNK_SIZE):
+                    file.write(data)
+                    sha256_hash.update(data)
+                    received += len(data)
+                    progress.update(len(data))
+            progress.close()
+        if total and received != total:
+            raise DownloadError(f"received {received} of {total} bytes")
+        return part_path, None, sha256_hash.hexdigest()
+
+    def download_file(self, url, filename, expected_hash, position=0):
+        """
+        Download `url` to `model_dir/filename` and check its SHA-256 against
+        `expected_hash` (or the server-reported LFS hash when None).
+
+        Returns:
+            True when the file is in place and verified
+        """
         filepath = os.path.join(self.model_dir, filename)
-        
+        info = remote_info(url, self.timeout)
+        expected_hash = expected_hash or info["sha256"]
+
         if os.path.exists(filepath):
             if self.verify_file(filepath, expected_hash):
                 print(f"✅ {filename} already exists and is valid.")
-                return
+                return True
             else:
                 print(f"⚠️ {filename} exists but hash mismatch. Redownloading.")
-        
+
         print(f"⬇️ Downloading {filename}...")
-        
-        response = requests.get(url, stream=True)
-        total_size_in_bytes = int(response.headers.get('content-length', 0))
-        block_size = 1024 # 1 Kibibyte
-        progress_bar = tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True)
-        
-        with open(filepath, 'wb') as file:
-            for data in response.iter_content(block_size):
-                progress_bar.update(len(data))
-                file.write(data)
-        progress_bar.close()
-        
-        if total_size_in_bytes != 0 and progress_bar.n != total_size_in_bytes:
-            print("ERROR, something went wrong")
-            os.remove(filepath)
+        if info["ranges"] and info["size"]:
+            part_path, state_path, digest = self._download_ranges(url, filepath, info, position)
         else:
-            print(f"✅ {filename} downloaded.")
+            part_path, state_path, digest = self._download_stream(url, filepath, position)
+
+        if expected_hash is not None and digest != expected_hash:
+            # Corrupt data: the partial file cannot be trusted for a resume either
+            os.remove(part_path)
+            if state_path and os.path.exists(state_path):
+                os.remove(state_path)
+            print(f"❌ {filename} failed verification (got {digest}, expected {expected_hash}).")
+            return False
+
+        os.replace(part_path, filepath)
+        if state_path and os.path.exists(state_path):
+            os.remove(state_path)
+        self._write_record(filepath, digest)
+        print(f"✅ {filename} downloaded{' and verified' if expected_hash else ''}.")
+        return True
 
     def download_all(self):
         print("🚀 Starting Model Downloads...")
-        for key, info in self.manifest.items():
-            if info['required']:
-                self.download_file(info['url'], info['filename'], info['sha256'])
+        entries = [info for info in self.manifest.values() if info['required']]
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.parallel_files) as pool:
+            futures = {
+                pool.submit(self.download_file, info['url'], info['filename'], info['sha256'], position): info
+                for position, info in enumerate(entries)
+            }
+            for future in as_completed(futures):
+                filename = futures[future]['filename']
+                try:
+                    if not future.result():
+                        failed.append(filename)
+                except Exception as e:
+                    # The partial file and its state are kept: the next run resumes
+                    print(f"❌ {filename}: {e}. Run again to resume.")
+                    failed.append(filename)
+        if failed:
+            print(f"Failed: {', '.join(failed)}")
+            return False
         print("✨ All required models downloaded.")
+        return True
 
 if __name__ == "__main__":
     # Ensure requests and tqdm are installed
@@ -81,6 +388,12 @@ if __name__ == "__main__":
     except ImportError:
         print("Please run: pip install requests tqdm")
         sys.exit(1)
-        
-    downloader = ModelDownloader()
-    downloader.download_all()
+
+    parser = argparse.ArgumentParser(description="Download the Prune Juice base models")
+    parser.add_argument("--model-dir", default="models")
+    parser.add_argument("--parallel-files", type=int, default=2)
+    parser.add_argument("--segments", type=int, default=8, help="Parallel range requests per large file")
+    args = parser.parse_args()
+
+    downloader = ModelDownloader(args.model_dir, parallel_files=args.parallel_files, segments=args.segments)
+    sys.exit(0 if downloader.download_all() else 1)
@@ -0,0 +1,41 @@
+import argparse
+import os
+import sys
+
+import torch
+
+# Exports a model directory (dense, pruned or INT8 quantized) to ONNX, by default
+# into <model>/onnx where the backend finds it (see PRUNEJUICE_ONNX_MODELS).
+#
+#   python scripts/export-onnx.py models/pruned_sdxl
+#   python scripts/export-onnx.py models/quantized_sdxl --output /tmp/quantized_onnx
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from optimization.onnx_backend import ONNX_DIR_NAME, export_pipeline_onnx
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export a Prune Juice model to ONNX")
+    parser.add_argument("model", help="Diffusers SDXL model directory")
+    parser.add_argument("--output", help=f"Export directory (default: <model>/{ONNX_DIR_NAME})")
+    parser.add_argument("--fp16", action="store_true", help="Export float16 graphs (GPU execution providers only)")
+    parser.add_argument("--opset", type=int, default=18)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    from diffusers import StableDiffusionXLPipeline
+    from optimization.model_io import custom_components, load_custom_pipeline
+    print(f"Loading {args.model}...")
+    if custom_components(args.model):
+        pipe = load_custom_pipeline(StableDiffusionXLPipeline, args.model, torch_dtype=torch.float32)
+    else:
+        pipe = StableDiffusionXLPipeline.from_pretrained(args.model, torch_dtype=torch.float32, use_safetensors=True)
+    export_pipeline_onnx(pipe, args.output or os.path.join(args.model, ONNX_DIR_NAME),
+                         dtype=torch.float16 if args.fp16 else torch.float32, opset=args.opset)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
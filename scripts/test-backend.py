@@ -19,5 +19,1437 @@ class TestPruneJuiceBackend(unittest.TestCase):
         self.assertIn("photographic", PRESETS)
         self.assertIn("prompt_suffix", PRESETS["photographic"])
 
+    def test_micro_batcher_groups_compatible_requests(self):
+        try:
+            from bridge.batching import MicroBatcher
+        except ImportError:
+            print("Skipping Micro Batcher test (Diffusers not installed)")
+            return
+        import threading
+
+        class FakeVRAM:
+            def max_batch_size(self, width, height, limit=8, pipe=None):
+                return limit
+
+        class FakeConnector:
+            current_model_id = "fake"
+            pipe = None
+            vram_manager = FakeVRAM()
+            calls = []
+
+            def generate(self, prompt, negative_prompt, width, height, steps, guidance, seed, wait_for_output=True):
+                self.calls.append(list(prompt))
+                return [{"prompt": p, "width": width} for p in prompt]
+
+        connector = FakeConnector()
+        batcher = MicroBatcher(connector, window_ms=200, max_batch_size=2)
+        results = {}
+        jobs = [("a", 512), ("b", 512), ("c", 512), ("d", 768)]
+        threads = [
+            threading.Thread(target=lambda p=p, w=w: results.update({p: batcher.submit(p, width=w, height=w)}))
+            for p, w in jobs
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual({p: r["prompt"] for p, r in results.items()}, {"a": "a", "b": "b", "c": "c", "d": "d"})
+        self.assertEqual(results["d"]["width"], 768)
+        self.assertTrue(all(len(call) <= 2 for call in connector.calls))
+        self.assertIn(2, [len(call) for call in connector.calls])
+
+    def test_embedding_cache_lru_byte_budget(self):
+        try:
+            import torch
+            from bridge.embedding_cache import PromptEmbeddingCache
+        except ImportError:
+            print("Skipping Embedding Cache test (Torch not installed)")
+            return
+
+        entry = (torch.zeros(1, 4), torch.zeros(1, 4), torch.zeros(1, 2), torch.zeros(1, 2))  # 48 bytes
+        cache = PromptEmbeddingCache(max_bytes=100)
+        cache.put(("m", "a", ""), entry)
+        cache.put(("m", "b", ""), entry)
+        self.assertIsNotNone(cache.get(("m", "a", "")))  # "a" is now most recent
+        cache.put(("m", "c", ""), entry)  # evicts "b"
+
+        self.assertIsNone(cache.get(("m", "b", "")))
+        self.assertIsNotNone(cache.get(("m", "c", "")))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (2, 1, 1))
+        self.assertLessEqual(stats["bytes"], 100)
+
+        cache.clear()
+        self.assertEqual(cache.stats()["entries"], 0)
+
+        # Rows of a batched encode are cached as their own tensors, not views of the batch
+        try:
+            from bridge.fooocus_connector import FooocusConnector
+            from optimization.benchmark import build_tiny_pipeline
+        except ImportError:
+            print("Skipping Embedding Cache connector part (Diffusers not installed)")
+            return
+        connector = FooocusConnector()
+        connector.pipe, connector.current_model_id = build_tiny_pipeline(), "tiny"
+        connector.encode_prompts(["a cat", "a dog"], ["", ""])
+        for tensor in connector.embedding_cache.get(("tiny", "a cat", "")):
+            self.assertEqual(tensor.untyped_storage().nbytes(), tensor.numel() * tensor.element_size())
+
+    def test_scheduler_pool_isolates_requests(self):
+        try:
+            from diffusers import EulerDiscreteScheduler
+            from bridge.scheduler_pool import SchedulerPool
+        except ImportError:
+            print("Skipping Scheduler Pool test (Diffusers not installed)")
+            return
+
+        pool = SchedulerPool(EulerDiscreteScheduler().config, warm_steps=(20,))
+        with pool.checkout("DPMSolverMultistep") as first:
+            with pool.checkout("DPMSolverMultistep") as second:
+                self.assertIsNot(first, second)
+            first.set_timesteps(20)
+            expected = first.timesteps.clone()
+            first.model_outputs[0] = "dirty"
+
+        with pool.checkout("DPMSolverMultistep") as reused:
+            reused.set_timesteps(20)
+            self.assertTrue((reused.timesteps == expected).all())
+            self.assertIsNone(reused.model_outputs[0])
+            self.assertIsNone(reused.step_index)
+
+    def test_job_queue_priority_and_backpressure(self):
+        import asyncio
+        from bridge.job_queue import JobQueue, QueueFull
+
+        order = []
+
+        def run_batch(jobs):
+            order.append([job.params["prompt"] for job in jobs])
+            return [{"prompt": job.params["prompt"]} for job in jobs]
+
+        async def scenario():
+            queue = JobQueue(run_batch, batch_key=lambda p: p["prompt"][0], max_queued=3)
+            queue.start()
+            bulk = queue.submit({"prompt": "b1"}, "bulk")
+            cancelled = queue.submit({"prompt": "c1"}, "bulk")
+            interactive = queue.submit({"prompt": "i1"}, "interactive")
+            with self.assertRaises(QueueFull):
+                queue.submit({"prompt": "i2"}, "interactive")
+            self.assertEqual(queue.position(interactive), 0)
+            queue.cancel(cancelled.id)
+
+            while queue.queued_count() or queue.current:
+                await asyncio.sleep(0.01)
+            await queue.stop()
+            return bulk, cancelled, interactive
+
+        bulk, cancelled, interactive = asyncio.run(scenario())
+        self.assertEqual(order, [["i1"], ["b1"]])
+        self.assertEqual(interactive.result, {"prompt": "i1"})
+        self.assertEqual(bulk.status, "completed")
+        self.assertEqual(cancelled.status, "cancelled")
+
+    def test_model_residency_lru_tiers(self):
+        try:
+            import torch
+            from bridge.model_residency import ModelResidencyManager
+        except ImportError:
+            print("Skipping Model Residency test (Torch not installed)")
+            return
+
+        vae = torch.nn.Linear(4, 4)  # 80 bytes, shared by every model
+
+        class FakePipe:
+            def __init__(self):
+                self.components = {"unet": torch.nn.Linear(4, 4), "vae": vae}
+
+            def remove_all_hooks(self):
+                pass
+
+            def to(self, device):
+                return self
+
+        loads, activations = [], []
+
+        def load_fn(model_id, shared):
+            loads.append(model_id)
+            return FakePipe()
+
+        def activate_fn(pipe):
+            activations.append(pipe)
+            return pipe
+
+        # Room for one model on the GPU and two parked in RAM
+        manager = ModelResidencyManager(load_fn, activate_fn, vram_budget_bytes=160, ram_budget_bytes=240)
+        a = manager.acquire("a")
+        manager.acquire("b")
+        self.assertEqual(manager.stats()["gpu"], ["b"])
+        self.assertEqual(manager.stats()["cpu"], ["a"])
+
+        self.assertIs(manager.acquire("a"), a)  # promoted from RAM, not reloaded
+        manager.acquire("c")
+        manager.acquire("d")
+        self.assertEqual(loads, ["a", "b", "c", "d"])
+        self.assertNotIn("b", manager.models)  # least recently used, evicted to disk
+        self.assertEqual(len(activations), 5)
+
+    def test_sparse_checkpoint_roundtrip(self):
+        try:
+            import tempfile
+            import torch
+            from accelerate import init_empty_weights
+            from safetensors.torch import save_file
+            from optimization.model_io import (
+                SparseCheckpoint, load_component_tensors, save_sparse_state_dict, pack_bitmask, unpack_bitmask,
+            )
+        except ImportError:
+            print("Skipping Sparse Checkpoint test (Torch not installed)")
+            return
+
+        mask = torch.rand(37) > 0.5
+        self.assertTrue(torch.equal(unpack_bitmask(pack_bitmask(mask), 37), mask))
+
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Linear(64, 64), torch.nn.LayerNorm(64))
+        with torch.no_grad():
+            weight = model[0].weight
+            weight[weight.abs() < weight.abs().median()] = 0
+
+        with tempfile.TemporaryDirectory() as tmp:
+            sparse_path = os.path.join(tmp, "sparse.safetensors")
+            dense_path = os.path.join(tmp, "dense.safetensors")
+            save_sparse_state_dict(model.state_dict(), sparse_path)
+            save_file(model.state_dict(), dense_path)
+            self.assertLess(os.path.getsize(sparse_path), 0.7 * os.path.getsize(dense_path))
+
+            checkpoint = SparseCheckpoint(sparse_path)
+            self.assertEqual(checkpoint.layout["0.weight"]["encoding"], "bitmask")
+            self.assertEqual(checkpoint.layout["1.weight"]["encoding"], "dense")
+
+            with init_empty_weights():
+                restored = torch.nn.Sequential(torch.nn.Linear(64, 64), torch.nn.LayerNorm(64))
+            load_component_tensors(restored, checkpoint.get, checkpoint.keys())
+            for name, tensor in model.state_dict().items():
+                self.assertTrue(torch.equal(restored.state_dict()[name], tensor))
+
+    def test_structured_pruning_shrinks_modules(self):
+        try:
+            import copy
+            import torch
+            from diffusers import UNet2DConditionModel
+            from diffusers.models.attention import BasicTransformerBlock
+            from optimization.structured import (
+                apply_structure_manifest, empty_from_config, prune_structured, structure_manifest,
+            )
+        except ImportError:
+            print("Skipping Structured Pruning test (Diffusers not installed)")
+            return
+
+        torch.manual_seed(0)
+        block = BasicTransformerBlock(dim=32, num_attention_heads=4, attention_head_dim=8, cross_attention_dim=16).eval()
+        original = copy.deepcopy(block)
+        removed = prune_structured(block, amount=0.5)
+        self.assertEqual(removed["heads"], 4)  # two from each of attn1 and attn2
+        self.assertEqual(block.attn1.to_q.out_features, 16)
+        self.assertEqual((block.attn1.heads, block.attn1.sliceable_head_dim), (2, 2))
+        self.assertEqual(block.ff.net[2].in_features, 64)
+
+        # Removing heads / hidden units == zeroing their output columns in the original
+        with torch.no_grad():
+            for name in ("attn1", "attn2"):
+                kept = {tuple(row.tolist()) for row in getattr(block, name).to_q.weight}
+                attn = getattr(original, name)
+                for h in range(4):
+                    if tuple(attn.to_q.weight[h * 8].tolist()) not in kept:
+                        attn.to_out[0].weight[:, h * 8:(h + 1) * 8] = 0
+            kept = {tuple(col.tolist()) for col in block.ff.net[2].weight.T}
+            for j, col in enumerate(original.ff.net[2].weight.T):
+                if tuple(col.tolist()) not in kept:
+                    original.ff.net[2].weight[:, j] = 0
+            x, context = torch.randn(1, 6, 32), torch.randn(1, 3, 16)
+            self.assertTrue(torch.allclose(block(x, encoder_hidden_states=context),
+                                           original(x, encoder_hidden_states=context), atol=1e-5))
+
+        # A config-built UNet resized by the manifest accepts the pruned weights
+        unet = UNet2DConditionModel(
+            block_out_channels=(32, 64), layers_per_block=1, sample_size=8, cross_attention_dim=16,
+            down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+            up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"), attention_head_dim=4,
+        ).eval()
+        prune_structured(unet, amount=0.5, block_ratios={"mid_block": 0.0})
+        self.assertNotIn("mid_block.resnets.0.conv1", structure_manifest(unet))
+        rebuilt = apply_structure_manifest(empty_from_config(unet), structure_manifest(unet))
+        rebuilt.load_state_dict(unet.state_dict(), assign=True)
+        with torch.no_grad():
+            args = (torch.randn(1, 4, 8, 8), 10, torch.randn(1, 3, 16))
+            self.assertTrue(torch.equal(rebuilt(*args).sample, unet(*args).sample))
+            # Attention slicing sizes its slices from the pruned head counts
+            expected = unet(*args).sample
+            for model in (unet, rebuilt):
+                model.set_attention_slice("max")
+                self.assertTrue(torch.allclose(model(*args).sample, expected, atol=1e-5))
+
+    def test_semi_structured_2_4_codec(self):
+        try:
+            import torch
+            from optimization.semi_structured import (
+                SemiStructuredLinear, decode_2_4, encode_2_4, is_2_4, linear_2_4_reference, prune_2_4,
+            )
+        except ImportError:
+            print("Skipping 2:4 Sparsity test (Torch not installed)")
+            return
+
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Linear(64, 96), torch.nn.GELU(), torch.nn.Linear(96, 8))
+        self.assertEqual(prune_2_4(model, min_features=32), 1)  # the 8-wide head is left dense
+        layer = model[0]
+        self.assertIsInstance(layer, SemiStructuredLinear)
+        self.assertTrue(is_2_4(layer.weight))
+        self.assertFalse(is_2_4(model[2].weight))
+
+        values, indices = encode_2_4(layer.weight.detach())
+        self.assertEqual(tuple(values.shape), (96, 32))
+        self.assertEqual(tuple(indices.shape), (96, 8))
+        self.assertTrue(torch.equal(decode_2_4(values, indices, layer.weight.shape), layer.weight))
+
+        # The compressed-form reference matches the dense layer the GPU kernel replaces
+        x = torch.randn(2, 5, 64)
+        with torch.no_grad():
+            expected = layer(x)
+            self.assertTrue(torch.allclose(linear_2_4_reference(x, values, indices, layer.bias), expected, atol=1e-5))
+            layer.to("cpu")  # stays dense off sm80+ GPUs
+            self.assertTrue(torch.equal(layer(x), expected))
+
+    def test_quantized_checkpoint_roundtrip(self):
+        try:
+            import json
+            import tempfile
+            import torch
+            from accelerate import init_empty_weights
+            from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+            from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+            from safetensors import safe_open
+            from optimization.model_io import load_quantized_tensors, save_quantized_state_dict
+            from optimization.semi_structured import SemiStructuredLinear, prune_module_2_4
+        except ImportError:
+            print("Skipping Quantized Checkpoint test (Torch not installed)")
+            return
+
+        def build():
+            return torch.nn.Sequential(torch.nn.Linear(32, 64), torch.nn.LayerNorm(64), torch.nn.Linear(64, 8))
+
+        torch.manual_seed(0)
+        quantized = quantize_dynamic(build(), {torch.nn.Linear: per_channel_dynamic_qconfig}, dtype=torch.qint8)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "quantized_model.safetensors")
+            save_quantized_state_dict(quantized, path)
+            with init_empty_weights():
+                restored = build()
+            load_quantized_tensors(restored, path)
+
+        self.assertIsInstance(restored[0], DynamicQuantizedLinear)
+        self.assertEqual(restored[0].weight().qscheme(), torch.per_channel_affine)
+        self.assertTrue(torch.equal(restored[0].weight().int_repr(), quantized[0].weight().int_repr()))
+        x = torch.randn(4, 32)
+        self.assertTrue(torch.equal(restored(x), quantized(x)))
+
+        # Mixed plan: the first layer INT8, the last kept 2:4 sparse; the 2:4 layer keeps its format on save
+        mixed = build()
+        prune_module_2_4(mixed[2])
+        mixed = quantize_dynamic(mixed, {"0": per_channel_dynamic_qconfig}, dtype=torch.qint8)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "quantized_model.safetensors")
+            save_quantized_state_dict(mixed, path)
+            layout = json.loads(safe_open(path, framework="pt").metadata()["layout"])
+            self.assertEqual(layout["2.weight"], {"encoding": "2:4", "shape": [8, 64]})
+            with init_empty_weights():
+                restored = build()
+            load_quantized_tensors(restored, path)
+        self.assertIsInstance(restored[0], DynamicQuantizedLinear)
+        self.assertIsInstance(restored[2], SemiStructuredLinear)
+        self.assertTrue(torch.equal(restored[2].weight, mixed[2].weight))
+        self.assertTrue(torch.equal(restored(x), mixed(x)))
+
+    def test_weight_only_quantization(self):
+        try:
+            import tempfile
+            import torch
+            from accelerate import init_empty_weights
+            from optimization.model_io import load_quantized_tensors, save_quantized_state_dict
+            from optimization.weight_only import (
+                WeightOnlyConv2d, WeightOnlyLinear, calibrate_weight_only, linear_weight_only_reference,
+                quantize_weight_only,
+            )
+        except ImportError:
+            print("Skipping Weight-Only Quantization test (Torch not installed)")
+            return
+
+        def build():
+            return torch.nn.Sequential(torch.nn.Conv2d(64, 64, 3, padding=1), torch.nn.Flatten(2),
+                                       torch.nn.Linear(16, 96), torch.nn.GELU(), torch.nn.Linear(96, 80))
+
+        torch.manual_seed(0)
+        x = torch.randn(2, 64, 4, 4)
+        for bits, group_size, tolerance in ((8, None, 0.01), (4, 32, 0.15)):
+            model = build()
+            model[2] = torch.nn.Linear(16, 96)  # narrower than min_features, stays full precision
+            report = calibrate_weight_only(model, lambda: model(x), bits, group_size, min_features=64)
+            self.assertEqual(set(report), {"0", "4"})
+            self.assertLess(max(entry["rel_error"] for entry in report.values()), tolerance)
+
+            expected = model(x)
+            self.assertEqual(quantize_weight_only(model, bits, group_size, min_features=64), 2)
+            self.assertIsInstance(model[0], WeightOnlyConv2d)
+            self.assertIsInstance(model[4], WeightOnlyLinear)
+            self.assertEqual(model[4].qweight.element_size() * model[4].qweight.numel(), 80 * 96 * bits // 8)
+            out = model(x)
+            self.assertLess(((out - expected).norm() / expected.norm()).item(), tolerance)
+
+            # Integer reference kernel agrees with dequantize + matmul
+            layer, hidden = model[4], torch.randn(5, 96)
+            reference = linear_weight_only_reference(hidden, layer.qweight, layer.scales, bits, 96, layer.bias)
+            self.assertTrue(torch.allclose(reference, layer(hidden), atol=1e-4))
+
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "quantized_model.safetensors")
+                save_quantized_state_dict(model, path)
+                with init_empty_weights():
+                    restored = build()
+                load_quantized_tensors(restored, path, torch.float32)
+            self.assertTrue(torch.equal(restored(x), out))
+
+        # Calibration builds each dequantized weight inside its hook, not a second model up front
+        from unittest import mock
+        import optimization.weight_only as weight_only
+        model, before_run = build(), []
+        with mock.patch.object(weight_only, "quantize_weight", wraps=weight_only.quantize_weight) as quantize:
+            calibrate_weight_only(model, lambda: (before_run.append(quantize.call_count), model(x)), min_features=64)
+        self.assertEqual((before_run, quantize.call_count), ([0], 2))
+
+        # The quantizer casts only the components it quantizes, and refuses dynamic INT8 ones
+        try:
+            from optimization.benchmark import build_tiny_pipeline
+            from optimization.quantization import ModelQuantizer
+        except ImportError:
+            print("Skipping Model Quantizer part (Diffusers not installed)")
+            return
+        quantizer = ModelQuantizer.__new__(ModelQuantizer)
+        quantizer.pipe = build_tiny_pipeline()
+        quantizer.quantize_weight_only(calibration_steps=1)
+        self.assertEqual((quantizer.pipe.unet.dtype, quantizer.pipe.vae.dtype), (torch.float16, torch.float32))
+        quantizer.pipe = build_tiny_pipeline()
+        quantizer.quantize_unet()
+        with self.assertRaisesRegex(RuntimeError, "unet already dynamically quantized"):
+            quantizer.quantize_weight_only()
+
+    def test_mixed_precision_planner_meets_budget(self):
+        try:
+            import torch
+            from optimization.planner import MixedPrecisionPlanner
+        except ImportError:
+            print("Skipping Mixed-Precision Planner test (Torch not installed)")
+            return
+
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Linear(64, 128), torch.nn.GELU(), torch.nn.Linear(128, 128),
+                                    torch.nn.GELU(), torch.nn.Linear(128, 64))
+        with torch.no_grad():
+            model[2].weight[:, :8] *= 40  # outlier columns make this layer sensitive to quantization
+        x = torch.randn(32, 64)
+
+        planner = MixedPrecisionPlanner(model, group_size=32, min_features=64)
+        report = planner.calibrate(lambda: model(x))
+        self.assertEqual(set(report), {"0", "2", "4"})
+        self.assertLess(report["0"]["errors"]["int8"], report["0"]["errors"]["int4"])
+        self.assertEqual(report["0"]["macs"], 32 * 64 * 128)
+
+        fp16_bytes = sum(p.numel() * 2 for p in model.parameters())
+        self.assertEqual(set(planner.plan(fp16_bytes)["layers"].values()), {"fp16"})
+        errors = []
+        for fraction in (0.8, 0.6, 0.4):
+            plan = planner.plan(fraction * fp16_bytes, kind="vram")
+            self.assertLessEqual(plan["estimate"]["vram"], fraction * fp16_bytes)
+            errors.append(plan["error"])
+        self.assertEqual(errors, sorted(errors))  # tighter budgets never buy back quality
+        # Under a loose budget the outlier layer is the one left in fp16
+        self.assertEqual(planner.plan(0.8 * fp16_bytes)["layers"], {"0": "int8", "2": "fp16", "4": "int8"})
+
+        with self.assertRaises(ValueError):
+            planner.plan(0.1 * fp16_bytes)
+
+    def test_quality_metrics_and_streaming_stats(self):
+        try:
+            import torch
+            from optimization.quality import RunningStats, frechet_distance, latent_distance, psnr, ssim
+        except ImportError:
+            print("Skipping Quality Metrics test (Torch not installed)")
+            return
+
+        torch.manual_seed(0)
+        images = torch.rand(3, 3, 32, 32)
+        noisy = (images + 0.05 * torch.randn_like(images)).clamp(0, 1)
+        self.assertTrue(torch.allclose(psnr(images, images), torch.full((3,), 100.0)))
+        self.assertTrue(torch.allclose(ssim(images, images), torch.ones(3), atol=1e-5))
+        self.assertTrue((psnr(noisy, images) < 30).all() and (psnr(noisy, images) > 20).all())
+        self.assertTrue((ssim(noisy, images) < 1).all())
+        self.assertTrue(torch.allclose(latent_distance(2 * images, images), torch.ones(3)))
+
+        # Streaming in batches matches the statistics of the whole set
+        features = torch.randn(500, 8, dtype=torch.float64) * torch.arange(1, 9) + 3
+        stats = RunningStats(8)
+        for batch in features.split(64):
+            stats.update(batch)
+        self.assertTrue(torch.allclose(stats.mean(), features.mean(dim=0)))
+        self.assertTrue(torch.allclose(stats.covariance(), features.T.cov()))
+
+        self.assertAlmostEqual(frechet_distance(stats, stats), 0.0, places=6)
+        shifted = RunningStats(8)
+        shifted.update(features + 1)
+        self.assertAlmostEqual(frechet_distance(shifted, stats), 8.0, places=6)
+
+    def test_benchmark_harness_and_baseline_diff(self):
+        try:
+            import time
+            import torch
+            from optimization.benchmark import (PeakMemorySampler, benchmark_matrix, build_tiny_pipeline,
+                                                compare_to_baseline)
+        except ImportError:
+            print("Skipping Benchmark test (Torch not installed)")
+            return
+
+        # Peak RAM is the growth within a configuration; a big earlier allocation does not carry over
+        with PeakMemorySampler() as first:
+            buffer = torch.ones(64 * 1024 ** 2, dtype=torch.uint8)
+            time.sleep(0.05)  # several sampling intervals
+            del buffer
+        with PeakMemorySampler() as second:
+            pass
+        self.assertGreaterEqual(first.growth, 60 * 1024 ** 2)
+        self.assertLess(second.growth, 16 * 1024 ** 2)
+
+        # The tokenizer's vocabulary directory does not outlive the build
+        import glob
+        import tempfile
+        pattern = os.path.join(tempfile.gettempdir(), "prunejuice-tokenizer-*")
+        leftovers = set(glob.glob(pattern))
+        pipe = build_tiny_pipeline()
+        self.assertEqual(set(glob.glob(pattern)), leftovers)
+        self.assertTrue(pipe.tokenizer("a cat").input_ids)
+        results = benchmark_matrix(pipe, "cpu", resolutions=(64,), steps=(2,), schedulers=("Euler", "EulerAncestral"),
+                                   optimizations=((), ("vae_slicing", "attention_slicing"), ("cpu_offload",)),
+                                   warmup=1, trials=2)
+        by_key = {r["key"]: r for r in results["results"]}
+        self.assertEqual(len(by_key), 6)
+        baseline = by_key["64px/2steps/Euler/bs1/baseline"]
+        self.assertLessEqual(baseline["latency_p50"], baseline["latency_p95"])
+        self.assertGreater(baseline["its"], 0)
+        self.assertGreaterEqual(baseline["peak_ram_mb"], 0)
+        self.assertIsNone(baseline["peak_vram_mb"])
+        self.assertIn("64px/2steps/Euler/bs1/attention_slicing+vae_slicing", by_key)
+        self.assertIn("skipped", by_key["64px/2steps/Euler/bs1/cpu_offload"])
+
+        # Baseline diff: a 50% slower p50 is a regression, 2% is noise
+        slower = {"results": [dict(r, latency_p50=r["latency_p50"] * 1.5) if "skipped" not in r else r
+                              for r in results["results"]]}
+        diff = compare_to_baseline(slower, results, tolerance=0.10)
+        self.assertEqual({e["metric"] for e in diff["regressions"]}, {"latency_p50"})
+        self.assertEqual(len(diff["regressions"]), 4)
+        noisy = {"results": [dict(r, its=r["its"] * 0.98) if "skipped" not in r else r for r in results["results"]]}
+        self.assertEqual(compare_to_baseline(noisy, results)["regressions"], [])
+
+        # Benchmarking the quantizer's pipeline leaves the state it saves untouched
+        from diffusers.models.attention_processor import AttnProcessor
+        from optimization.quantization import ModelQuantizer
+        quantizer = ModelQuantizer.__new__(ModelQuantizer)
+        quantizer.pipe = pipe = build_tiny_pipeline()
+        pipe.unet.set_attn_processor(AttnProcessor())
+        pipe.vae.enable_tiling()
+        scheduler = pipe.scheduler
+        quantizer.benchmark_speed(resolution=64, steps=1, warmup=0, trials=1)
+        self.assertIs(pipe.scheduler, scheduler)
+        self.assertTrue(all(type(p) is AttnProcessor for p in pipe.unet.attn_processors.values()))
+        self.assertTrue(pipe.vae.use_tiling)
+
+    def test_stage_instrumentation_and_metrics(self):
+        try:
+            import torch
+            from bridge.instrumentation import Instrumentation, NullRecorder
+        except ImportError:
+            print("Skipping Instrumentation test (Torch not installed)")
+            return
+        import tempfile
+
+        trace_dir = tempfile.mkdtemp()
+        instrumentation = Instrumentation(enabled=True, profile_request=2, trace_dir=trace_dir)
+        vae = torch.nn.Module()
+        vae.decoder = torch.nn.Linear(4, 4)
+        instrumentation.install_probes(type("Pipe", (), {"vae": vae})())
+
+        # Offload hooks of the probed pipeline only; accelerate's class is not patched
+        import types
+        transfers = []
+        hook = types.SimpleNamespace(pre_forward=lambda module, *args: transfers.append("in"))
+        pipe = types.SimpleNamespace(_all_hooks=[types.SimpleNamespace(hook=hook)],
+                                     maybe_free_model_hooks=lambda: transfers.append("out"))
+
+        with instrumentation.uncounted(), instrumentation.generation():
+            with instrumentation.request("cpu") as recorder:  # e.g. warm-up: not a numbered request
+                pass
+        for _ in range(2):
+            with instrumentation.generation():
+                with instrumentation.request("cpu") as recorder:
+                    with recorder.stage("text_encode"):
+                        torch.ones(8).sum()
+                    instrumentation.probe_offload(pipe)
+                    recorder.start_denoise()
+                    hook.pre_forward(vae)
+                    for _ in range(3):
+                        recorder.step_end()
+                    vae.decoder(torch.zeros(1, 4))
+                    vae.decoder(torch.zeros(1, 4))  # e.g. VAE slicing: calls are summed
+                    pipe.maybe_free_model_hooks()
+                instrumentation.observe(recorder, 0.2, 1)
+        self.assertEqual(instrumentation.requests, 2)
+
+        timings = recorder.summary()
+        self.assertEqual(timings["vae_decode"]["calls"], 2)
+        self.assertEqual(timings["offload_transfer"]["calls"], 2)
+        self.assertEqual(transfers, ["in", "out"] * 2)
+        self.assertEqual(len(timings["denoise"]["steps"]), 3)
+        self.assertEqual(timings["memory"], "process_rss")
+        self.assertTrue(os.path.exists(recorder.trace_path))
+        try:
+            from accelerate.hooks import CpuOffload
+            self.assertFalse(hasattr(CpuOffload, "_prunejuice_probe"))
+        except ImportError:
+            pass
+
+        # Several pipeline calls of one generation (chunks, OOM retries) are a single request
+        with instrumentation.generation():
+            for _ in range(3):
+                with instrumentation.request("cpu"):
+                    pass
+        self.assertEqual(instrumentation.requests, 3)
+
+        text = instrumentation.render_metrics()
+        self.assertIn('prunejuice_stage_seconds_count{stage="denoise_step"} 6', text)
+        self.assertIn('prunejuice_generation_seconds_bucket{le="0.25"} 2', text)
+        self.assertIn('prunejuice_generation_seconds_bucket{le="0.1"} 0', text)
+        self.assertIn("prunejuice_images_total 2", text)
+
+        # Disabled: no stage data, only end-to-end metrics
+        disabled = Instrumentation()
+        with disabled.request("cpu") as recorder:
+            self.assertIsInstance(recorder, NullRecorder)
+            with recorder.stage("text_encode"):
+                pass
+        disabled.observe(recorder, 1.0, 1)
+        self.assertNotIn("prunejuice_stage_seconds_count", disabled.render_metrics())
+
+    def test_vram_policy_enables_minimum_savers(self):
+        try:
+            from optimization.benchmark import build_tiny_pipeline
+            from optimization.vram_manager import VRAMManager
+        except ImportError:
+            print("Skipping VRAM Policy test (Torch not installed)")
+            return
+
+        pipe = build_tiny_pipeline()
+        manager = VRAMManager("cpu")
+        budget = {"bytes": 100 * 1024**3}
+        manager.memory_budget_bytes = lambda pipe=None: budget["bytes"]
+
+        self.assertEqual(manager.adapt(pipe, 256, 256, 4, force=True)["savers"], [])
+        self.assertFalse(pipe.vae.use_slicing)
+
+        # Tight enough that decoding four images at once no longer fits, but one at a time does
+        full = manager.estimate_peak_bytes(pipe, 256, 256, 4)
+        sliced = manager.estimate_peak_bytes(pipe, 256, 256, 4, ["vae_slicing"])
+        self.assertLess(sliced, full)
+        budget["bytes"] = sliced
+        plan = manager.adapt(pipe, 256, 256, 4)
+        self.assertEqual(plan["savers"], ["vae_slicing"])
+        self.assertTrue(plan["fits"])
+        self.assertTrue(pipe.vae.use_slicing)
+        self.assertIs(manager.last_plan, plan)
+
+        # A single image fits without savers again; offload is never planned on CPU
+        self.assertEqual(manager.adapt(pipe, 256, 256, 1)["savers"], [])
+        self.assertFalse(pipe.vae.use_slicing)
+        budget["bytes"] = 0
+        self.assertNotIn("cpu_offload", manager.plan_optimizations(pipe, 256, 256, 4)["savers"])
+
+        # The micro-batch limit follows the same estimate and budget
+        self.assertEqual(manager.max_batch_size(256, 256, 8, pipe=pipe), 1)
+        budget["bytes"] = manager.estimate_peak_bytes(pipe, 256, 256, 3)
+        self.assertEqual(manager.max_batch_size(256, 256, 8, pipe=pipe), 3)
+        self.assertEqual(manager.max_batch_size(256, 256, 2, pipe=pipe), 2)
+
+    def test_memory_cleanup_only_on_thresholds(self):
+        try:
+            from unittest import mock
+            from optimization.vram_manager import VRAMManager
+        except ImportError:
+            print("Skipping Memory Hygiene test (Torch not installed)")
+            return
+
+        manager = VRAMManager("cpu")
+        manager.safety_margin_gb = 0
+        with mock.patch("optimization.vram_manager.gc.collect") as collect:
+            self.assertIsNone(manager.pre_generation_cleanup())
+            self.assertIsNone(manager.post_generation_cleanup())
+            collect.assert_not_called()
+
+            # An OOM flushes immediately and once more before the next generation
+            manager.recover_from_oom()
+            self.assertEqual(manager.pre_generation_cleanup(), "oom")
+            self.assertIsNone(manager.post_generation_cleanup())
+            self.assertEqual(collect.call_count, 2)
+
+            manager.safety_margin_gb = 1e6
+            self.assertEqual(manager.maybe_cleanup(), "low_memory")
+
+        stats = manager.hygiene_stats()
+        self.assertEqual(stats["checks"], 5)
+        self.assertEqual(stats["runs"], 3)
+        self.assertEqual(stats["reasons"], {"oom": 2, "low_memory": 1})
+        self.assertEqual(stats["last"]["reason"], "low_memory")
+        self.assertGreaterEqual(stats["reclaimed_bytes"], 0)
+
+    def test_oom_retry_ladder_remembers_fallback(self):
+        try:
+            import torch
+            from bridge.fooocus_connector import FooocusConnector
+            from optimization.benchmark import build_tiny_pipeline
+        except ImportError:
+            print("Skipping OOM Retry test (Torch not installed)")
+            return
+
+        connector = FooocusConnector()
+        connector.pipe = connector.activate_pipeline(build_tiny_pipeline())
+        connector.current_model_id = "tiny"
+        ooms = []
+
+        def fail_on_batches(module, args, kwargs):
+            # UNet input is doubled by classifier-free guidance
+            if kwargs.get("sample", args[0] if args else None).shape[0] > 2:
+                ooms.append(1)
+                raise torch.cuda.OutOfMemoryError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        handle = connector.pipe.unet.register_forward_pre_hook(fail_on_batches, with_kwargs=True)
+
+        params = dict(width=64, height=64, steps=1, save_output=False)
+        results = connector.generate(["a", "b", "c", "d"], negative_prompt=[""] * 4, seed=[1, 2, 3, 4], **params)
+        self.assertEqual([r["metadata"]["seed"] for r in results], [1, 2, 3, 4])
+        # attention slicing, VAE tiling (no sequential offload on CPU), then batches of 2 and 1
+        fallback = results[0]["metadata"]["oom_fallback"]
+        self.assertEqual(fallback["savers"], ["attention_slicing", "vae_tiling"])
+        self.assertEqual(fallback["max_batch_size"], 1)
+        self.assertEqual(fallback["retries"], 4)
+        self.assertEqual(len(ooms), 4)
+
+        # The next request at this model and resolution starts from the working settings
+        results = connector.generate(["e", "f"], negative_prompt=[""] * 2, seed=[None, None], **params)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]["metadata"]["oom_fallback"]["retries"], 0)
+        self.assertEqual(len(ooms), 4)
+        self.assertEqual(connector.vram_manager.hygiene_stats()["reasons"].get("oom"), 4)
+
+        # An OOM in a later chunk keeps the finished chunks instead of denoising them again
+        connector.oom_fallbacks[("tiny", 96, 96)] = {"savers": [], "max_batch_size": 2}
+        handle.remove()
+        batches = []
+
+        def fail_last_chunk_once(module, args):
+            batches.append(args[0].shape[0])
+            if batches == [4, 2]:
+                raise torch.cuda.OutOfMemoryError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        resume = connector.pipe.unet.register_forward_pre_hook(fail_last_chunk_once)
+        results = connector.generate(["h", "i", "j"], negative_prompt=[""] * 3, seed=[5, 6, 7],
+                                     **dict(params, width=96, height=96))
+        self.assertEqual([r["metadata"]["seed"] for r in results], [5, 6, 7])
+        self.assertEqual(batches, [4, 2, 2])
+        self.assertEqual(results[2]["metadata"]["oom_fallback"]["retries"], 1)
+        resume.remove()
+
+        # Other errors are not retried
+        connector.pipe.unet.register_forward_pre_hook(lambda module, args: 1 / 0)
+        with self.assertRaises(ZeroDivisionError):
+            connector.generate("g", **params)
+
+    def test_output_writer_background_atomic_writes(self):
+        try:
+            from PIL import Image
+            from bridge.output_writer import OutputWriter, chain
+        except ImportError:
+            print("Skipping Output Writer test (Pillow not installed)")
+            return
+        import asyncio
+        import tempfile
+        from bridge.job_queue import JobQueue
+
+        output_dir = tempfile.mkdtemp()
+        timings = []
+        writer = OutputWriter(output_dir, "png", compress_level=1, workers=3,
+                              observe=lambda stage, seconds: timings.append(stage))
+        image = Image.new("RGB", (32, 32), (200, 40, 90))
+        submitted = [writer.submit(image) for _ in range(12)]
+        paths = [future.result()["image_url"] for _, future in submitted]
+
+        # Names are known up front, never collide, and only complete files are visible
+        self.assertEqual(paths, [output["image_url"] for output, _ in submitted])
+        self.assertEqual(len(set(paths)), 12)
+        self.assertEqual(sorted(os.listdir(output_dir)), sorted(os.path.basename(p) for p in paths))
+        with Image.open(paths[0]) as written:
+            self.assertEqual(written.getpixel((0, 0)), (200, 40, 90))
+        self.assertEqual(writer.stats()["written"], 12)
+        self.assertEqual(timings.count("image_encode"), 12)
+
+        for image_format, extension in (("webp", ".webp"), ("jpeg", ".jpg")):
+            lossy = OutputWriter(output_dir, image_format, quality=80)
+            output, future = lossy.submit(image.convert("RGBA"))
+            path = future.result()["image_url"]
+            self.assertTrue(path.endswith(extension))
+            with Image.open(path) as written:
+                self.assertEqual(written.format, image_format.upper())
+            lossy.close()
+        with self.assertRaises(ValueError):
+            OutputWriter(output_dir, "bmp")
+
+        # The job queue completes a job once its write lands, without waiting in the worker
+        def run_batch(jobs):
+            return [chain(writer.submit(image)[1], {"prompt": job.params["prompt"]}) for job in jobs]
+
+        async def scenario():
+            queue = JobQueue(run_batch, batch_key=lambda p: p["prompt"])
+            queue.start()
+            job = queue.submit({"prompt": "a"})
+            while job.status != "completed":
+                await asyncio.sleep(0.01)
+            await queue.stop()
+            return job
+
+        self.assertEqual(asyncio.run(scenario()).result, {"prompt": "a"})
+        writer.close()
+
+    def test_result_store_ttl_budget_and_zero_disk(self):
+        try:
+            from PIL import Image
+            from bridge.output_writer import OutputWriter
+            from bridge.result_store import ResultStore
+        except ImportError:
+            print("Skipping Result Store test (Pillow not installed)")
+            return
+        import tempfile
+        import time
+
+        store = ResultStore(max_bytes=10, ttl_seconds=60)
+        self.assertTrue(store.put("a", b"1234", "image/png"))
+        self.assertTrue(store.put("b", b"1234", "image/png"))
+        self.assertTrue(store.put("c", b"1234", "image/png"))  # over budget: evicts "a"
+        self.assertFalse(store.put("big", b"x" * 11, "image/png"))
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.get("c"), (b"1234", "image/png"))
+        self.assertEqual(store.stats()["evictions"], 1)
+
+        store = ResultStore(max_bytes=10, ttl_seconds=0.05)
+        store.put("d", b"12", "image/webp")
+        time.sleep(0.1)
+        self.assertIsNone(store.get("d"))
+        self.assertEqual((store.stats()["entries"], store.stats()["expirations"]), (0, 1))
+
+        # Zero-disk mode: bytes only in the store, nothing written
+        output_dir = tempfile.mkdtemp()
+        store = ResultStore(max_bytes=1024**2, ttl_seconds=60)
+        writer = OutputWriter(output_dir, "png", store=store, persist=False)
+        output, future = writer.submit(Image.new("RGB", (16, 16), (1, 2, 3)))
+        self.assertEqual(future.result(), output)
+        self.assertIsNone(output["image_url"])
+        data, media_type = store.get(output["image_id"])
+        self.assertEqual(media_type, "image/png")
+        self.assertTrue(data.startswith(b"\x89PNG"))
+        self.assertEqual(os.listdir(output_dir), [])
+        with self.assertRaises(ValueError):
+            OutputWriter(output_dir, persist=False)
+        writer.close()
+
+        # An image larger than the whole store never gets an id that cannot be fetched
+        image = Image.new("RGB", (16, 16), (1, 2, 3))
+        tiny = ResultStore(max_bytes=8, ttl_seconds=60)
+        writer = OutputWriter(output_dir, "png", store=tiny)
+        result = {"prompt": "a"}
+        output, future = writer.submit(image, result)
+        self.assertIs(output, result)
+        self.assertIsNone(future.result()["image_id"])
+        self.assertTrue(os.path.exists(result["image_url"]))
+        writer.close()
+        writer = OutputWriter(output_dir, "png", store=tiny, persist=False)
+        with self.assertRaises(RuntimeError):
+            writer.submit(image)[1].result()
+        self.assertEqual((writer.stats()["rejected"], writer.stats()["failed"]), (1, 1))
+        writer.close()
+
+    def test_binary_response_needs_result_store(self):
+        try:
+            import tempfile
+            from fastapi.testclient import TestClient
+        except ImportError:
+            print("Skipping Response Format test (FastAPI not installed)")
+            return
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                import bridge.python_server as server
+            finally:
+                os.chdir(cwd)
+
+        calls = []
+
+        class FakeConnector:
+            def generate(self, **params):
+                calls.append(params)
+                return {"image_url": None, "image_id": None, "metadata": {}}
+
+        headers = {"X-Bridge-Token": server.BRIDGE_TOKEN}
+        originals = server.connector, server.batcher, server.result_store
+        server.connector, server.batcher, server.result_store = FakeConnector(), None, None
+        try:
+            client = TestClient(server.app)
+            for response_format in ("binary", "multipart", "base64"):
+                response = client.post("/generate", headers=headers,
+                                       json={"prompt": "a cat", "response_format": response_format})
+                self.assertEqual(response.status_code, 422)
+                self.assertEqual(response.json()["detail"]["error_code"], "INVALID_RESPONSE_FORMAT")
+            self.assertEqual(calls, [])
+            response = client.post("/generate", headers=headers, json={"prompt": "a cat"})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(calls), 1)
+        finally:
+            server.connector, server.batcher, server.result_store = originals
+
+    def test_model_downloader_parallel_resume_and_verify(self):
+        try:
+            import requests  # noqa: F401
+            import tqdm  # noqa: F401
+        except ImportError:
+            print("Skipping Model Downloader test (requests/tqdm not installed)")
+            return
+        import hashlib
+        import importlib.util
+        import tempfile
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        spec = importlib.util.spec_from_file_location(
+            "download_models", os.path.join(os.path.dirname(os.path.abspath(__file__)), "download-models.py"))
+        download_models = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(download_models)
+
+        payload = os.urandom(3 * 1024**2 + 123)
+        digest = hashlib.sha256(payload).hexdigest()
+        served = {"bytes": 0, "ranges": 0, "drop_after": None}
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(payload)))
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("ETag", f'"{digest}"')
+                self.end_headers()
+
+            def do_GET(self):
+                start, end = self.headers["Range"].split("=")[1].split("-")
+                start, end = int(start), int(end) + 1
+                served["ranges"] += 1
+                self.send_response(206)
+                self.send_header("Content-Length", str(end - start))
+                self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(payload)}")
+                self.end_headers()
+                body = payload[start:end]
+                if served["drop_after"] is not None:
+                    body = body[:served["drop_after"]]  # connection drops mid-segment
+                served["bytes"] += len(body)
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/model.safetensors"
+        model_dir = tempfile.mkdtemp()
+        try:
+            # First run: every segment drops halfway and there are no retries, the partial stays
+            served["drop_after"] = 256 * 1024
+            downloader = download_models.ModelDownloader(model_dir, segments=6, min_segment_size=512 * 1024,
+                                                         retries=0)
+            with self.assertRaises(download_models.DownloadError):
+                downloader.download_file(url, "model.safetensors", None)
+            self.assertEqual(served["ranges"], 6)
+            self.assertTrue(os.path.exists(os.path.join(model_dir, "model.safetensors.part.json")))
+
+            # Resume: only the missing bytes are fetched, hash taken from the ETag
+            served.update(bytes=0, drop_after=None)
+            self.assertTrue(downloader.download_file(url, "model.safetensors", None))
+            self.assertEqual(served["bytes"], len(payload) - 6 * 256 * 1024)
+            with open(os.path.join(model_dir, "model.safetensors"), "rb") as f:
+                self.assertEqual(f.read(), payload)
+            self.assertFalse(os.path.exists(os.path.join(model_dir, "model.safetensors.part")))
+
+            # Verified record: no re-download; a wrong expected hash discards the download
+            served["bytes"] = 0
+            self.assertTrue(downloader.download_file(url, "model.safetensors", digest))
+            self.assertEqual(served["bytes"], 0)
+            self.assertFalse(downloader.download_file(url, "other.safetensors", "0" * 64))
+            self.assertFalse(os.path.exists(os.path.join(model_dir, "other.safetensors")))
+            self.assertFalse(os.path.exists(os.path.join(model_dir, "other.safetensors.part")))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_mapped_safetensors_loading_is_zero_copy(self):
+        try:
+            import tempfile
+            import torch
+            from diffusers import StableDiffusionXLPipeline
+            from optimization.benchmark import build_tiny_pipeline
+            from optimization.model_io import DenseCheckpoint, load_mapped_pipeline, weight_files
+        except ImportError:
+            print("Skipping Mapped Loading test (Torch/diffusers not installed)")
+            return
+
+        pipe = build_tiny_pipeline()
+        with tempfile.TemporaryDirectory() as tmp:
+            pipe.save_pretrained(tmp, safe_serialization=True)
+            pipe.to(torch.float16).save_pretrained(tmp, safe_serialization=True, variant="fp16")
+            unet_dir = os.path.join(tmp, "unet")
+            self.assertEqual([os.path.basename(f) for f in weight_files(unet_dir, "fp16")],
+                             ["diffusion_pytorch_model.fp16.safetensors"])
+            self.assertEqual([os.path.basename(f) for f in weight_files(unet_dir)],
+                             ["diffusion_pytorch_model.safetensors"])
+
+            loaded = load_mapped_pipeline(StableDiffusionXLPipeline, tmp, torch_dtype=torch.float16, variant="fp16",
+                                          workers=4)
+            for name in ("unet", "vae", "text_encoder", "text_encoder_2"):
+                expected = getattr(pipe, name).state_dict()
+                restored = getattr(loaded, name).state_dict()
+                self.assertTrue(all(torch.equal(restored[k], v) for k, v in expected.items()), name)
+
+            # Parameters are views of one file mapping, not copies
+            weight, bias = loaded.unet.conv_in.weight, loaded.unet.conv_in.bias
+            self.assertEqual(weight.untyped_storage().data_ptr(), bias.untyped_storage().data_ptr())
+            self.assertEqual(weight.untyped_storage().nbytes(),
+                             os.path.getsize(os.path.join(unet_dir, "diffusion_pytorch_model.fp16.safetensors")))
+
+            # Copy-on-write: writing to a parameter never reaches the file
+            original = weight.detach().clone()
+            with torch.no_grad():
+                weight.zero_()
+            reread = DenseCheckpoint(unet_dir, "fp16").get("conv_in.weight")
+            self.assertTrue(torch.equal(reread, original))
+            del loaded, weight, bias, reread
+
+    def test_compiled_buckets_pad_route_and_cache(self):
+        try:
+            import tempfile
+            import types
+            from unittest import mock
+            import torch
+            from optimization.compiled import ShapeBucketCompiler, module_fingerprint, parse_buckets
+        except ImportError:
+            print("Skipping Compiled Mode test (Torch not installed)")
+            return
+
+        self.assertEqual(parse_buckets("1024x1024x2, 832x1216"), [(1024, 1024, 2), (832, 1216, 1)])
+
+        class TinyUNet(torch.nn.Module):
+            # Same call convention as the UNet: sample first, per-sample conditioning as kwargs
+            def __init__(self):
+                super().__init__()
+                self.conv = torch.nn.Conv2d(4, 4, 1)
+
+            def forward(self, sample, timestep, encoder_hidden_states=None, return_dict=True):
+                return (self.conv(sample) * timestep + encoder_hidden_states.mean(dim=(1, 2)).view(-1, 1, 1, 1),)
+
+        torch.manual_seed(0)
+        unet = TinyUNet()
+        sample, hidden = torch.randn(1, 4, 8, 8), torch.randn(1, 3, 5)
+        with torch.no_grad():
+            expected = unet(sample, torch.tensor(3.0), encoder_hidden_states=hidden)[0]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            compiler = ShapeBucketCompiler([(64, 64, 2), (64, 96, 1)], cache_dir, snap=True)
+            self.assertEqual(compiler.nearest_resolution(70, 100), (64, 96))
+            compiler.attach(types.SimpleNamespace(unet=unet, vae=None))
+            with torch.no_grad():
+                # Batch 1 at a bucket's latent size: padded to the bucket batch of 2 and compiled
+                output = unet(sample, torch.tensor(3.0), encoder_hidden_states=hidden)[0]
+                self.assertEqual(output.shape, (1, 4, 8, 8))
+                self.assertTrue(torch.allclose(output, expected, atol=1e-5))
+                # Off-bucket size: eager, no compile
+                unet(torch.randn(1, 4, 16, 16), torch.tensor(3.0), encoder_hidden_states=hidden)
+            stats = compiler.stats()
+            self.assertEqual((stats["compiles"], stats["padded_calls"], stats["eager_calls"]), (1, 1, 1))
+
+            # A restart (new compiler, same architecture) loads the saved artifacts instead of starting cold
+            artifact_dir = compiler.artifact_dir(module_fingerprint(unet))
+            self.assertEqual(os.listdir(artifact_dir), ["unet_b2_8x8_float32.bin"])
+            restarted = ShapeBucketCompiler([(64, 64, 2)], cache_dir)
+            restarted.attach(types.SimpleNamespace(unet=TinyUNet(), vae=None))
+            self.assertEqual(restarted.stats()["artifacts_loaded"], 1)
+
+        # Torch without cache artifacts: buckets still compile, nothing is persisted
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch("optimization.compiled.PERSISTENT_CACHE", False), \
+                mock.patch.object(torch.compiler, "save_cache_artifacts", side_effect=AttributeError):
+            compiler = ShapeBucketCompiler([(64, 64, 1)], cache_dir, backend="eager")
+            unet = TinyUNet()
+            compiler.attach(types.SimpleNamespace(unet=unet, vae=None))
+            with torch.no_grad():
+                unet(sample, torch.tensor(3.0), encoder_hidden_states=hidden)
+            self.assertEqual((compiler.stats()["compiles"], compiler.failed), (1, set()))
+            self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_onnx_export_and_runtime_backend(self):
+        try:
+            import json
+            import tempfile
+            import numpy as np
+            import torch
+            import onnxruntime  # noqa: F401
+            from diffusers import StableDiffusionXLPipeline
+            from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+            from bridge.fooocus_connector import FooocusConnector
+            from optimization.benchmark import build_tiny_pipeline
+            from optimization.onnx_backend import (ONNX_MANIFEST_NAME, export_pipeline_onnx, is_onnx_pipeline,
+                                                   load_onnx_pipeline)
+            from optimization.weight_only import quantize_weight_only
+        except ImportError:
+            print("Skipping ONNX Backend test (Torch/ONNX Runtime not installed)")
+            return
+        from unittest import mock
+
+        pipe = build_tiny_pipeline()
+        # Torch before 2.6 has no Dim.AUTO: a clear error instead of a failure halfway through the export
+        with tempfile.TemporaryDirectory() as export_dir, mock.patch.object(torch.export, "Dim", object()):
+            with self.assertRaisesRegex(RuntimeError, "torch >= 2.6"):
+                export_pipeline_onnx(pipe, export_dir)
+        # One dynamic INT8 encoder (re-quantized in ONNX) and one weight-only encoder (exported as is)
+        pipe.text_encoder = quantize_dynamic(pipe.text_encoder, {torch.nn.Linear: per_channel_dynamic_qconfig},
+                                             dtype=torch.qint8)
+        quantize_weight_only(pipe.text_encoder_2, 8, min_features=16)
+        with tempfile.TemporaryDirectory() as models_dir:
+            export_dir = export_pipeline_onnx(pipe, os.path.join(models_dir, "tiny", "onnx"))
+            with open(os.path.join(export_dir, ONNX_MANIFEST_NAME)) as f:
+                components = json.load(f)["components"]
+            self.assertEqual({name: c["quantized"] for name, c in components.items()},
+                             {"text_encoder": True, "text_encoder_2": False, "unet": False, "vae_decoder": False})
+
+            onnx_pipe = load_onnx_pipeline(StableDiffusionXLPipeline, export_dir, providers=["CPUExecutionProvider"])
+            self.assertTrue(is_onnx_pipeline(onnx_pipe))
+            with torch.no_grad():
+                prompts = dict(prompt=["a cat", "a dog"], negative_prompt=["", ""], do_classifier_free_guidance=True)
+                expected, encoded = pipe.encode_prompt(**prompts), onnx_pipe.encode_prompt(**prompts)
+                # Weight-only pooled output matches; the INT8 encoder differs by activation quantization only
+                self.assertTrue(torch.allclose(encoded[2], expected[2], atol=1e-4))
+                self.assertLess(((encoded[0] - expected[0]).norm() / expected[0].norm()).item(), 0.1)
+
+                # Same embeddings through the UNet and VAE decoder, at two resolutions and batch sizes
+                embeds = dict(zip(("prompt_embeds", "negative_prompt_embeds", "pooled_prompt_embeds",
+                                   "negative_pooled_prompt_embeds"), expected))
+                for width, rows in ((64, 2), (96, 1)):
+                    kwargs = {k: v[:rows] for k, v in embeds.items()}
+                    kwargs.update(width=width, height=64, num_inference_steps=2, output_type="np")
+                    reference = pipe(generator=torch.Generator().manual_seed(0), **kwargs).images
+                    images = onnx_pipe(generator=torch.Generator().manual_seed(0), **kwargs).images
+                    self.assertEqual(images.shape, (rows, 64, width, 3))
+                    self.assertLess(abs(images - reference).max(), 1e-3)
+
+            # The connector serves selected models from their export
+            os.makedirs(os.path.join(models_dir, "unexported"))
+            connector = FooocusConnector(onnx_models=["tiny", "unexported"], onnx_providers=["CPUExecutionProvider"])
+            connector.models_dir = models_dir
+            self.assertTrue(connector.load_model("tiny"))
+            self.assertEqual(connector.backend(), "onnx")
+            results = connector.generate(["a", "b"], negative_prompt=[""] * 2, seed=[1, 2], width=64, height=64,
+                                         steps=2, save_output=False)
+            self.assertEqual([r["metadata"]["seed"] for r in results], [1, 2])
+
+            # An ONNX Runtime allocation failure is an OOM; there are no savers to try, so the batch is split
+            run, failures = connector.pipe.unet.run, []
+
+            def allocation_failure(**inputs):
+                if inputs["sample"].shape[0] > 2 and not failures:
+                    failures.append(1)
+                    raise Fail("[ONNXRuntimeError] : 6 : RUNTIME_EXCEPTION : Failed to allocate memory for requested buffer")
+                return run(**inputs)
+
+            class Fail(Exception):  # onnxruntime.capi.onnxruntime_pybind11_state.Fail is not a RuntimeError
+                pass
+
+            connector.pipe.unet.run = allocation_failure
+            results = connector.generate(["a", "b"], negative_prompt=[""] * 2, seed=[1, 2], width=64, height=64,
+                                         steps=2, save_output=False)
+            self.assertEqual(failures, [1])
+            self.assertEqual(results[0]["metadata"]["oom_fallback"], {"savers": [], "max_batch_size": 1, "retries": 1})
+            self.assertFalse(connector.load_model("unexported"))
+            self.assertEqual(connector.state, "error")
+
+            # fp16 graphs load and run; the exported decoder must not be upcast like a torch SDXL VAE
+            self.assertTrue(pipe.vae.config.force_upcast)
+            export_dir = export_pipeline_onnx(build_tiny_pipeline(), os.path.join(models_dir, "fp16"),
+                                              dtype=torch.float16)
+            onnx_pipe = load_onnx_pipeline(StableDiffusionXLPipeline, export_dir, providers=["CPUExecutionProvider"])
+            self.assertEqual((onnx_pipe.unet.dtype, onnx_pipe.vae.dtype), (torch.float16, torch.float16))
+            self.assertFalse(onnx_pipe.vae.config.force_upcast)
+            images = onnx_pipe("a cat", width=64, height=64, num_inference_steps=2, output_type="np").images
+            self.assertEqual(images.shape, (1, 64, 64, 3))
+            self.assertTrue(np.isfinite(images).all())
+
+    def test_cancellation_within_one_step(self):
+        try:
+            from bridge.fooocus_connector import FooocusConnector
+            from bridge.progress import CancellationToken, GenerationCancelled
+            from optimization.benchmark import build_tiny_pipeline
+        except ImportError:
+            print("Skipping Cancellation test (Torch not installed)")
+            return
+
+        connector = FooocusConnector()
+        connector.pipe = connector.activate_pipeline(build_tiny_pipeline())
+        connector.current_model_id = "tiny"
+        unet_calls = []
+        connector.pipe.unet.register_forward_pre_hook(lambda module, args: unet_calls.append(1))
+        params = dict(width=64, height=64, steps=6, save_output=False)
+
+        # Cancelled during step 2: the run stops at the end of that step
+        token, events = CancellationToken(), []
+
+        def on_progress(event):
+            events.append(event)
+            if event["step"] == 2:
+                token.cancel()
+
+        with self.assertRaises(GenerationCancelled):
+            connector.generate("a", cancel_token=token, on_progress=on_progress, **params)
+        self.assertEqual([e["step"] for e in events], [1, 2])
+        self.assertEqual(len(unet_calls), 2)  # one CFG-batched UNet call per step
+        self.assertEqual({e["event"] for e in events}, {"step"})
+        self.assertTrue(all(e["total"] == 6 and e["elapsed"] > 0 and e["it_per_s"] > 0 for e in events))
+
+        # A batch runs on while any of its requests is live...
+        tokens, progress = [CancellationToken(), CancellationToken()], [[], []]
+        tokens[0].cancel()
+        del unet_calls[:]
+        results = connector.generate(["a", "b"], negative_prompt=["", ""], seed=[1, 2], cancel_token=tokens,
+                                     on_progress=[progress[0].append, progress[1].append], **params)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(unet_calls), 6)
+        self.assertEqual([len(p) for p in progress], [6, 6])
+
+        # ...and stops once every one of them is cancelled
+        tokens = [CancellationToken(), CancellationToken()]
+        del unet_calls[:]
+
+        def cancel_both(event):
+            if event["step"] == 3:
+                for t in tokens:
+                    t.cancel()
+
+        with self.assertRaises(GenerationCancelled):
+            connector.generate(["a", "b"], negative_prompt=["", ""], seed=[1, 2], cancel_token=tokens,
+                               on_progress=[cancel_both, None], **params)
+        self.assertEqual(len(unet_calls), 3)
+
+    def test_job_events_stream_over_sse(self):
+        try:
+            import json
+            import tempfile
+            import threading
+            import time
+            from fastapi.testclient import TestClient
+            from optimization.benchmark import build_tiny_pipeline
+        except ImportError:
+            print("Skipping Job Events test (FastAPI/Torch not installed)")
+            return
+        # The server writes its bridge token to the working directory on import
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                import bridge.python_server as server
+            finally:
+                os.chdir(cwd)
+
+        connector = server.connector
+        connector.pipe = connector.activate_pipeline(build_tiny_pipeline())
+        connector.current_model_id = "tiny"
+        connector.output_writer.persist = False
+        # Hold the job at its first UNet call until the stream is subscribed
+        gate = threading.Event()
+
+        def hold(module, args):
+            gate.wait(10)
+
+        hook = connector.pipe.unet.register_forward_pre_hook(hold)
+
+        def open_gate():
+            deadline = time.time() + 10
+            while not server.job_queue.events.subscribers and time.time() < deadline:
+                time.sleep(0.01)
+            gate.set()
+
+        headers = {"X-Bridge-Token": server.BRIDGE_TOKEN}
+        try:
+            with TestClient(server.app) as client:
+                job = client.post("/jobs", headers=headers, json={
+                    "prompt": "a", "width": 64, "height": 64, "num_inference_steps": 3, "seed": 1
+                }).json()
+                threading.Thread(target=open_gate, daemon=True).start()
+                with client.stream("GET", f"/jobs/{job['job_id']}/events", headers=headers) as response:
+                    self.assertEqual(response.headers["content-type"].split(";")[0], "text/event-stream")
+                    events = [json.loads(line[len("data: "):]) for line in response.iter_lines()
+                              if line.startswith("data: ")]
+                status = client.get(f"/jobs/{job['job_id']}", headers=headers).json()
+                self.assertEqual(status["status"], "completed", status)
+        finally:
+            hook.remove()
+            connector.pipe = None
+
+        # Status snapshot first, then step progress, then the terminal event
+        self.assertIn(events[0]["status"], ("queued", "running"))
+        steps = [e for e in events[1:] if e.get("event") == "step"]
+        self.assertEqual([e["step"] for e in steps], [1, 2, 3])
+        self.assertTrue(all(e["total"] == 3 and e["elapsed"] > 0 and e["it_per_s"] > 0 for e in steps))
+        self.assertEqual(events[-1], {"event": "completed"})
+
+    def test_preload_warmup_and_readiness_states(self):
+        try:
+            import tempfile
+            import threading
+            import time
+            from fastapi.testclient import TestClient
+            from bridge.fooocus_connector import FooocusConnector
+            from optimization.benchmark import build_tiny_pipeline
+        except ImportError:
+            print("Skipping Preload/Readiness test (FastAPI/Torch not installed)")
+            return
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                import bridge.python_server as server
+            finally:
+                os.chdir(cwd)
+
+        connector = FooocusConnector()
+        connector.warmup_resolutions = [(64, 64)]
+        connector.warmup_steps = 1
+        loading, warming = threading.Event(), threading.Event()
+        warmup_calls = []
+
+        def hold_warmup(module, args):
+            warmup_calls.append(args[0].shape[-1])
+            warming.wait(10)
+
+        def load(model_id, shared_components):
+            loading.wait(10)
+            pipe = build_tiny_pipeline()
+            pipe.unet.register_forward_pre_hook(hold_warmup)
+            return pipe
+
+        def wait_for(state):
+            deadline = time.time() + 10
+            while connector.state != state and time.time() < deadline:
+                time.sleep(0.01)
+
+        connector.residency.load_fn = load
+        original, server.connector = server.connector, connector
+        try:
+            client = TestClient(server.app)
+            self.assertEqual(connector.warmup_shapes(), [(64, 64, 1)])
+            thread = connector.start_preload("tiny")
+            response = client.get("/ready")
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.json()["detail"]["readiness"], "loading")
+            self.assertEqual(client.get("/health").json()["model"]["readiness"], "loading")
+
+            loading.set()
+            wait_for("warming")
+            response = client.get("/ready")
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.json()["detail"]["readiness"], "warming")
+
+            warming.set()
+            thread.join(30)
+            self.assertEqual(client.get("/ready").json(), {"readiness": "ready"})
+            self.assertEqual(client.get("/health").json()["model"]["current"], "tiny")
+            self.assertEqual(warmup_calls, [32])  # 64px at the tiny VAE's scale of 2
+
+            # A failed load is reported until the next successful one
+            def fail(model_id, shared_components):
+                raise RuntimeError("checkpoint is corrupt")
+
+            connector.residency.load_fn = fail
+            self.assertFalse(connector.load_model("broken"))
+            response = client.get("/ready")
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.json()["detail"]["readiness"], "error")
+            self.assertEqual(client.get("/health").json()["model"]["readiness"], "error")
+        finally:
+            server.connector = original
+
+    def test_quality_gate_and_reference_cache(self):
+        try:
+            import tempfile
+            import torch
+            from optimization.benchmark import build_tiny_pipeline
+            from optimization.pruning import ModelPruner
+            from optimization.quality import QualityEvaluator, pipeline_fingerprint
+        except ImportError:
+            print("Skipping Quality Gate test (Torch not installed)")
+            return
+
+        # Saving is gated on a passed validation, not just on the absence of a failed one
+        pruner = ModelPruner.__new__(ModelPruner)
+        pruner.quality_report = None
+        with self.assertRaises(RuntimeError):
+            pruner.save_pruned_model("/nonexistent/pruned")
+
+        # A passed validation does not cover pruning done after it
+        pruner.pipe, pruner.device, pruner.model_path = build_tiny_pipeline(seed=0), "cpu", "tiny"
+        pruner._load = lambda model_path: build_tiny_pipeline(seed=0)
+        report = pruner.validate_quality(["a cat"], steps=1, resolution=64, batch_size=1, thresholds={})
+        self.assertTrue(report["passed"])
+        pruner.prune_unet(0.3)
+        self.assertIsNone(pruner.quality_report)
+        with self.assertRaises(RuntimeError):
+            pruner.save_pruned_model("/nonexistent/pruned")
+
+        reference, other = build_tiny_pipeline(seed=0), build_tiny_pipeline(seed=1)
+        self.assertEqual(pipeline_fingerprint(reference), pipeline_fingerprint(build_tiny_pipeline(seed=0)))
+        self.assertNotEqual(pipeline_fingerprint(reference), pipeline_fingerprint(other))
+        settings = dict(prompts=["a cat", "a dog"], steps=1, resolution=64, batch_size=2)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            evaluator = QualityEvaluator(cache_dir=cache_dir, **settings)
+            evaluator.record_reference(reference)
+            self.assertTrue(evaluator.compare(reference, thresholds={})["passed"])
+            written = os.path.getmtime(os.path.join(cache_dir, "reference.json"))
+            # Same settings and model reuse the cache; another reference model regenerates it
+            QualityEvaluator(cache_dir=cache_dir, **settings).record_reference(reference)
+            self.assertEqual(os.path.getmtime(os.path.join(cache_dir, "reference.json")), written)
+            QualityEvaluator(cache_dir=cache_dir, **settings).record_reference(other)
+            self.assertNotEqual(os.path.getmtime(os.path.join(cache_dir, "reference.json")), written)
+
+        # Without a cache_dir the reference lives in a temp dir removed by close()
+        evaluator = QualityEvaluator(**settings)
+        evaluator.record_reference(reference, reference_id="tiny")
+        temp_dir = evaluator.cache_dir
+        self.assertTrue(os.listdir(temp_dir))
+        evaluator.close()
+        self.assertFalse(os.path.exists(temp_dir))
+
 if __name__ == '__main__':
     unittest.main()